@@ -31,6 +31,7 @@ from sphinx.domains import ObjType, BUILTIN_DOMAINS
 from sphinx.domains.std import GenericObject, Target, StandardDomain
 from sphinx.builders import BUILTIN_BUILDERS
 from sphinx.environment import BuildEnvironment, SphinxStandaloneReader
+from sphinx.pycode import ModuleAnalyzer
 from sphinx.util import pycompat  # imported for side-effects
 from sphinx.util.tags import Tags
 from sphinx.util.osutil import ENOENT
@@ -42,11 +43,13 @@ events = {
     'builder-inited': '',
     'env-get-outdated': 'env, added, changed, removed',
     'env-purge-doc': 'env, docname',
+    'env-merge-info': 'env, docnames, other',
     'source-read': 'docname, source text',
     'doctree-read': 'the doctree before being pickled',
     'missing-reference': 'env, node, contnode',
     'doctree-resolved': 'doctree, docname',
     'env-updated': 'env',
+    'write-started': 'docnames',
     'html-collect-pages': 'builder',
     'html-page-context': 'pagename, context, doctree or None',
     'build-finished': 'exception',
@@ -60,9 +63,11 @@ class Sphinx(object):
 
     def __init__(self, srcdir, confdir, outdir, doctreedir, buildername,
                  confoverrides=None, status=sys.stdout, warning=sys.stderr,
-                 freshenv=False, warningiserror=False, tags=None):
+                 freshenv=False, warningiserror=False, tags=None,
+                 parallel=0):
         self.next_listener_id = 0
         self._extensions = {}
+        self._extension_metadata = {}
         self._listeners = {}
         self.domains = BUILTIN_DOMAINS.copy()
         self.builderclasses = BUILTIN_BUILDERS.copy()
@@ -87,6 +92,8 @@ class Sphinx(object):
             self._warning = warning
         self._warncount = 0
         self.warningiserror = warningiserror
+        # number of processes to use for reading; 0 or 1 mean serial
+        self.parallel = parallel
 
         self._events = events.copy()
 
@@ -177,6 +184,8 @@ class Sphinx(object):
                 return self._init_env(freshenv=True)
 
         self.env.set_warnfunc(self.warn)
+        # keep the results of analyzing Python source files across builds
+        ModuleAnalyzer.cachedir = path.join(self.doctreedir, 'pycode')
 
     def _init_builder(self, buildername):
         if buildername is None:
@@ -253,15 +262,37 @@ class Sphinx(object):
                       'a Sphinx extension module?' % extension)
         else:
             try:
-                mod.setup(self)
+                ext_meta = mod.setup(self)
             except VersionRequirementError, err:
                 # add the extension name to the version required
                 raise VersionRequirementError(
                     'The %s extension used by this project needs at least '
                     'Sphinx v%s; it therefore cannot be built with this '
                     'version.' % (extension, err))
+            if isinstance(ext_meta, dict):
+                self._extension_metadata[extension] = ext_meta
         self._extensions[extension] = mod
 
+    def is_parallel_allowed(self, typ):
+        """Check if parallel processing of the given *typ* ('read' or
+        'write') is allowed by all loaded extensions.
+
+        Extensions that don't say otherwise are assumed to be safe for
+        parallel writing, but not for parallel reading.
+        """
+        for extname in self._extensions:
+            meta = self._extension_metadata.get(extname, {})
+            allowed = meta.get('parallel_%s_safe' % typ,
+                               typ == 'write' or None)
+            if allowed is None:
+                self.warn('the %s extension does not declare if it is safe '
+                          'for parallel %sing, assuming it isn\'t; doing '
+                          'serial %s' % (extname, typ, typ))
+                return False
+            elif not allowed:
+                return False
+        return True
+
     def require_sphinx(self, version):
         # check the Sphinx version if requested
         if version > sphinx.__version__[:3]:
@@ -522,6 +553,15 @@ class TemplateBridge(object):
         """
         return 0
 
+    def templates_digest(self):
+        """Called by the builder instead of :meth:`newest_template_mtime`
+        if :confval:`use_content_digests` is set.  Return a string digest of
+        the names and contents of all template files, or ``None`` if it can't
+        be determined; then the mtimes are used.  The default implementation
+        returns ``None``.
+        """
+        return None
+
     def render(self, template, context):
         """Called by the builder to render a template given as a filename with
         a specified context (a Python dictionary).
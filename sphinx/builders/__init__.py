@@ -16,6 +16,9 @@ from docutils import nodes
 
 from sphinx.util.osutil import SEP, relative_uri
 from sphinx.util.console import bold, purple, darkgreen, term_width_line
+from sphinx.util.parallel import ParallelTasks, parallel_available, \
+     make_chunks
+from sphinx.util.rendercache import wait_for_render, save_string_caches
 
 # side effect: registers roles and directives
 from sphinx import roles
@@ -33,6 +36,8 @@ class Builder(object):
     format = ''
     # doctree versioning method
     versioning_method = 'none'
+    # allow parallel write_doc() calls
+    allow_parallel = False
 
     def __init__(self, app):
         self.env = app.env
@@ -54,6 +59,12 @@ class Builder(object):
         # images that need to be copied over (source -> dest)
         self.images = {}
 
+        # whether documents can be written in parallel worker processes
+        self.parallel_ok = False
+        if parallel_available and self.app.parallel > 1 and \
+               self.allow_parallel:
+            self.parallel_ok = self.app.is_parallel_allowed('write')
+
         self.init()
 
     # helper methods
@@ -250,9 +261,12 @@ class Builder(object):
         # another indirection to support builders that don't build
         # files individually
         self.write(docnames, list(updated_docnames), method)
+        # files rendered in the background must be complete for finish()
+        wait_for_render(self)
 
         # finish (write static files etc.)
         self.finish()
+        save_string_caches(self)
         status = (self.app.statuscode == 0 and 'succeeded'
                                            or 'finished with problems')
         if self.app._warncount:
@@ -282,24 +296,93 @@ class Builder(object):
         self.info(bold('preparing documents... '), nonl=True)
         self.prepare_writing(docnames)
         self.info('done')
+        self.app.emit('write-started', docnames)
 
         # write target files
         warnings = []
         self.env.set_warnfunc(lambda *args: warnings.append(args))
+        if self.parallel_ok and len(docnames) > 5:
+            # the worker processes can't wait for the external programs that
+            # the main process runs in the background for write-started
+            wait_for_render(self)
+            iterator = self._write_parallel(sorted(docnames), warnings,
+                                            self.app.parallel)
+        else:
+            iterator = self._write_serial(sorted(docnames))
         for docname in self.status_iterator(
-            sorted(docnames), 'writing output... ', darkgreen, len(docnames)):
-            doctree = self.env.get_and_resolve_doctree(docname, self)
-            self.write_doc(docname, doctree)
+            iterator, 'writing output... ', darkgreen, len(docnames)):
+            pass
         for warning in warnings:
             self.warn(*warning)
         self.env.set_warnfunc(self.warn)
 
+    def _write_serial(self, docnames):
+        for docname in docnames:
+            yield docname
+            doctree = self.env.get_and_resolve_doctree(docname, self)
+            self.write_doc(docname, doctree)
+
+    def _write_parallel(self, docnames, warnings, nproc):
+        """Resolve and write *docnames* in up to *nproc* worker processes,
+        yielding each docname once the results of its worker are merged.
+        """
+        def write_process(docs):
+            local_warnings = []
+            warnfunc = lambda *args: local_warnings.append(args)
+            self.env.set_warnfunc(warnfunc)
+            self.warn = warnfunc
+            self.init_parallel_write()
+            for docname in docs:
+                doctree = self.env.get_and_resolve_doctree(docname, self)
+                self.write_doc(docname, doctree)
+            return docs, local_warnings, self.get_parallel_write_data()
+
+        written = []
+        def merge(result):
+            docs, local_warnings, data = result
+            warnings.extend(local_warnings)
+            self.merge_parallel_write_data(data)
+            written.extend(docs)
+
+        tasks = ParallelTasks(nproc)
+        for chunk in make_chunks(docnames, nproc):
+            tasks.add_task(write_process, chunk, merge)
+            while written:
+                yield written.pop(0)
+        tasks.join()
+        for docname in written:
+            yield docname
+
     def prepare_writing(self, docnames):
         raise NotImplementedError
 
     def write_doc(self, docname, doctree):
         raise NotImplementedError
 
+    def init_parallel_write(self):
+        """Called in a worker process before it writes its documents when
+        writing in parallel.  Reset all builder state here that is collected
+        by write_doc() and must be sent back to the main process.
+
+        The default implementation resets the images to copy, and makes
+        the worker run external programs for images one at a time.
+        """
+        self.images = {}
+        self._render_tasks = None
+
+    def get_parallel_write_data(self):
+        """Return the (picklable) builder state collected by a worker process
+        when writing in parallel; it is given to
+        :meth:`merge_parallel_write_data` in the main process.
+        """
+        return self.images
+
+    def merge_parallel_write_data(self, data):
+        """Merge the state returned by :meth:`get_parallel_write_data` of a
+        worker process into this builder.
+        """
+        self.images.update(data)
+
     def finish(self):
         """Finish the building process.
 
@@ -36,9 +36,10 @@ from sphinx.util.osutil import SEP, os_path, relative_uri, ensuredir, \
 from sphinx.util.nodes import inline_all_toctrees
 from sphinx.util.matching import patmatch, compile_matchers
 from sphinx.util.pycompat import any, b
+from sphinx.util.rendercache import get_string_cache
 from sphinx.errors import SphinxError
 from sphinx.locale import _
-from sphinx.search import js_index
+from sphinx.search import js_index, js_terms, split_terms
 from sphinx.theming import Theme
 from sphinx.builders import Builder
 from sphinx.application import ENV_PICKLE_FILENAME
@@ -63,11 +64,13 @@ class StandaloneHTMLBuilder(Builder):
     out_suffix = '.html'
     link_suffix = '.html'  # defaults to matching out_suffix
     indexer_format = js_index
+    indexer_shard_format = js_terms
     indexer_dumps_unicode = True
     supported_image_types = ['image/svg+xml', 'image/png',
                              'image/gif', 'image/jpeg']
     searchindex_filename = 'searchindex.js'
     add_permalinks = True
+    allow_parallel = True
     embedded = False  # for things like HTML help or Qt help: suppresses sidebar
 
     # This is a class attribute because it is mutated by Sphinx.add_javascript.
@@ -86,6 +89,8 @@ class StandaloneHTMLBuilder(Builder):
         # a hash of all config values that, if changed, cause a full rebuild
         self.config_hash = ''
         self.tags_hash = ''
+        # a digest of all templates, if content digests are used
+        self.templates_digest = None
         # section numbers for headings in the currently visited document
         self.secnumbers = {}
         # currently written docname
@@ -140,7 +145,9 @@ class StandaloneHTMLBuilder(Builder):
         else:
             style = 'sphinx'
         self.highlighter = PygmentsBridge('html', style,
-                                          self.config.trim_doctest_flags)
+                                          self.config.trim_doctest_flags,
+                                          get_string_cache(self,
+                                                           'highlight-html'))
 
     def init_translator_class(self):
         if self.config.html_translator_class:
@@ -159,7 +166,10 @@ class StandaloneHTMLBuilder(Builder):
         self.config_hash = md5(unicode(cfgdict).encode('utf-8')).hexdigest()
         self.tags_hash = md5(unicode(sorted(self.tags)).encode('utf-8')) \
                 .hexdigest()
-        old_config_hash = old_tags_hash = ''
+        self.templates_digest = None
+        if self.templates and self.config.use_content_digests:
+            self.templates_digest = self.templates.templates_digest()
+        old_config_hash = old_tags_hash = old_templates_digest = ''
         try:
             fp = open(path.join(self.outdir, '.buildinfo'))
             try:
@@ -173,6 +183,10 @@ class StandaloneHTMLBuilder(Builder):
                 tag, old_tags_hash = fp.readline().strip().split(': ')
                 if tag != 'tags':
                     raise ValueError
+                # optional, only written when using content digests
+                line = fp.readline().strip()
+                if line.startswith('templates: '):
+                    old_templates_digest = line[11:]
             finally:
                 fp.close()
         except ValueError:
@@ -186,7 +200,11 @@ class StandaloneHTMLBuilder(Builder):
                 yield docname
             return
 
-        if self.templates:
+        if self.templates_digest is not None and \
+               self.templates_digest == old_templates_digest:
+            # the templates are the same, whatever their mtimes say
+            template_mtime = 0
+        elif self.templates:
             template_mtime = self.templates.newest_template_mtime()
         else:
             template_mtime = 0
@@ -200,9 +218,12 @@ class StandaloneHTMLBuilder(Builder):
             except Exception:
                 targetmtime = 0
             try:
-                srcmtime = max(path.getmtime(self.env.doc2path(docname)),
-                               template_mtime)
-                if srcmtime > targetmtime:
+                srcmtime = path.getmtime(self.env.doc2path(docname))
+                if srcmtime > targetmtime and self.env.digest_unchanged(
+                        docname, self.env.doc2path(docname, None)):
+                    # the source is unchanged since it was last read
+                    srcmtime = self.env.all_docs[docname]
+                if max(srcmtime, template_mtime) > targetmtime:
                     yield docname
             except EnvironmentError:
                 # source doesn't exist anymore
@@ -425,6 +446,26 @@ class StandaloneHTMLBuilder(Builder):
         self.index_page(docname, doctree, ctx.get('title', ''))
         self.handle_page(docname, ctx, event_arg=doctree)
 
+    def init_parallel_write(self):
+        Builder.init_parallel_write(self)
+        # only collect the search index data of this worker's documents
+        self.indexer = self.indexer.new_fragment()
+        if self.highlighter.cache is not None:
+            self.highlighter.cache.new_fragment()
+
+    def get_parallel_write_data(self):
+        cachedata = None
+        if self.highlighter.cache is not None:
+            cachedata = self.highlighter.cache.get_fragment()
+        return self.images, self.indexer.get_fragment(), cachedata
+
+    def merge_parallel_write_data(self, data):
+        images, fragment, cachedata = data
+        Builder.merge_parallel_write_data(self, images)
+        self.indexer.merge_fragment(fragment)
+        if cachedata is not None:
+            self.highlighter.cache.merge_fragment(cachedata)
+
     def finish(self):
         self.info(bold('writing additional files...'), nonl=1)
 
@@ -596,6 +637,8 @@ class StandaloneHTMLBuilder(Builder):
                      ' these files. When it is not found, a full rebuild will'
                      ' be done.\nconfig: %s\ntags: %s\n' %
                      (self.config_hash, self.tags_hash))
+            if self.templates_digest is not None:
+                fp.write('templates: %s\n' % self.templates_digest)
         finally:
             fp.close()
 
@@ -627,16 +670,61 @@ class StandaloneHTMLBuilder(Builder):
             node.replace_self(reference)
             reference.append(node)
 
+    def get_indexer_state_filename(self):
+        """Return the file name of the indexer state kept between builds."""
+        return path.join(self.doctreedir, 'searchindex-%s.pickle' % self.name)
+
+    def load_indexer_state(self):
+        """Load the indexer state written together with the search index,
+        which is much faster than reading the index itself.
+        """
+        searchindexfn = path.join(self.outdir, self.searchindex_filename)
+        f = open(self.get_indexer_state_filename(), 'rb')
+        try:
+            # the state is only valid for the index written with it
+            outdir, mtime = pickle.load(f)
+            if outdir != self.outdir or \
+                   mtime != os.stat(searchindexfn).st_mtime:
+                raise ValueError('state is out of date')
+            self.indexer.load_state(f)
+        finally:
+            f.close()
+
     def load_indexer(self, docnames):
         keep = set(self.env.all_docs) - set(docnames)
+        try:
+            self.load_indexer_state()
+        except Exception:
+            # missing, out of date or from an incompatible version
+            self.load_indexer_index(keep)
+        # delete all entries for files that will be rebuilt
+        self.indexer.prune(keep)
+
+    def open_searchindex(self, filename, mode):
+        if self.indexer_dumps_unicode:
+            return codecs.open(filename, mode, encoding='utf-8')
+        return open(filename, mode + 'b')
+
+    def get_searchindex_shard_filename(self, shard):
+        """Return the file name of a shard of the search index terms."""
+        base, ext = path.splitext(self.searchindex_filename)
+        return path.join(self.outdir, '%s-%d%s' % (base, shard, ext))
+
+    def load_searchindex_shard(self, shard):
+        f = self.open_searchindex(self.get_searchindex_shard_filename(shard),
+                                  'r')
+        try:
+            return self.indexer_shard_format.load(f)
+        finally:
+            f.close()
+
+    def load_indexer_index(self, keep):
         try:
             searchindexfn = path.join(self.outdir, self.searchindex_filename)
-            if self.indexer_dumps_unicode:
-                f = codecs.open(searchindexfn, 'r', encoding='utf-8')
-            else:
-                f = open(searchindexfn, 'rb')
+            f = self.open_searchindex(searchindexfn, 'r')
             try:
-                self.indexer.load(f, self.indexer_format)
+                self.indexer.load(f, self.indexer_format,
+                                  self.load_searchindex_shard)
             finally:
                 f.close()
         except (IOError, OSError, ValueError):
@@ -644,8 +732,6 @@ class StandaloneHTMLBuilder(Builder):
                 self.warn('search index couldn\'t be loaded, but not all '
                           'documents will be built: the index will be '
                           'incomplete.')
-        # delete all entries for files that will be rebuilt
-        self.indexer.prune(keep)
 
     def index_page(self, pagename, doctree, title):
         # only index pages with title
@@ -789,18 +875,43 @@ class StandaloneHTMLBuilder(Builder):
         self.info(bold('dumping search index... '), nonl=True)
         self.indexer.prune(self.env.all_docs)
         searchindexfn = path.join(self.outdir, self.searchindex_filename)
+        frozen = self.indexer.freeze()
+        if self.config.html_search_shards:
+            # the terms are written to separate files, which the search page
+            # loads only as needed
+            shards = split_terms(frozen, self.config.html_search_shards)
+            for shard in shards:
+                self.dump_searchindex_file(
+                    self.get_searchindex_shard_filename(shard['shard']),
+                    shard, self.indexer_shard_format)
+        self.dump_searchindex_file(searchindexfn, frozen, self.indexer_format)
+        self.dump_indexer_state(searchindexfn)
+        self.info('done')
+
+    def dump_searchindex_file(self, filename, data, format):
         # first write to a temporary file, so that if dumping fails,
         # the existing index won't be overwritten
-        if self.indexer_dumps_unicode:
-            f = codecs.open(searchindexfn + '.tmp', 'w', encoding='utf-8')
-        else:
-            f = open(searchindexfn + '.tmp', 'wb')
+        f = self.open_searchindex(filename + '.tmp', 'w')
         try:
-            self.indexer.dump(f, self.indexer_format)
+            format.dump(data, f)
         finally:
             f.close()
-        movefile(searchindexfn + '.tmp', searchindexfn)
-        self.info('done')
+        movefile(filename + '.tmp', filename)
+
+    def dump_indexer_state(self, searchindexfn):
+        statefn = self.get_indexer_state_filename()
+        try:
+            f = open(statefn + '.tmp', 'wb')
+            try:
+                pickle.dump((self.outdir, os.stat(searchindexfn).st_mtime),
+                            f, pickle.HIGHEST_PROTOCOL)
+                self.indexer.dump_state(f)
+            finally:
+                f.close()
+            movefile(statefn + '.tmp', statefn)
+        except (IOError, OSError):
+            # the state is only an optimization
+            pass
 
 
 class DirectoryHTMLBuilder(StandaloneHTMLBuilder):
@@ -964,6 +1075,7 @@ class SerializingHTMLBuilder(StandaloneHTMLBuilder):
     def init(self):
         self.config_hash = ''
         self.tags_hash = ''
+        self.templates_digest = None
         self.theme = None       # no theme necessary
         self.templates = None   # no template bridge necessary
         self.init_translator_class()
@@ -1017,10 +1129,10 @@ class SerializingHTMLBuilder(StandaloneHTMLBuilder):
         # super here to dump the search index
         StandaloneHTMLBuilder.handle_finish(self)
 
-        # copy the environment file from the doctree dir to the output dir
-        # as needed by the web app
-        copyfile(path.join(self.doctreedir, ENV_PICKLE_FILENAME),
-                 path.join(self.outdir, ENV_PICKLE_FILENAME))
+        # write a complete environment pickle (the one in the doctree dir
+        # is segmented) to the output dir as needed by the web app
+        self.env.topickle(path.join(self.outdir, ENV_PICKLE_FILENAME),
+                          segmented=False)
 
         # touch 'last build' file, used by the web application to determine
         # when to reload its environment and clear the cache
@@ -1034,7 +1146,7 @@ class PickleHTMLBuilder(SerializingHTMLBuilder):
     implementation = pickle
     implementation_dumps_unicode = False
     additional_dump_args = (pickle.HIGHEST_PROTOCOL,)
-    indexer_format = pickle
+    indexer_format = indexer_shard_format = pickle
     indexer_dumps_unicode = False
     name = 'pickle'
     out_suffix = '.fpickle'
@@ -1051,7 +1163,7 @@ class JSONHTMLBuilder(SerializingHTMLBuilder):
     """
     implementation = jsonimpl
     implementation_dumps_unicode = True
-    indexer_format = jsonimpl
+    indexer_format = indexer_shard_format = jsonimpl
     indexer_dumps_unicode = True
     name = 'json'
     out_suffix = '.fjson'
@@ -11,62 +11,312 @@
 
 import re
 import sys
+import time
 import Queue
 import socket
+import httplib
 import threading
+import cPickle as pickle
 from os import path
-from urllib2 import build_opener, unquote, Request
+from urllib import getproxies, proxy_bypass
+from urllib2 import unquote
+from urlparse import urlsplit, urljoin
+from collections import deque
+from email.utils import parsedate_tz, mktime_tz
 from HTMLParser import HTMLParser, HTMLParseError
 
 from docutils import nodes
 
 from sphinx.builders import Builder
+from sphinx.util.osutil import movefile
 from sphinx.util.console import purple, red, darkgreen, darkgray
 
-# create an opener that will simulate a browser user-agent
-opener = build_opener()
-opener.addheaders = [('User-agent', 'Mozilla/5.0')]
+# headers sent with every request, to simulate a browser user-agent
+request_headers = {'User-Agent': 'Mozilla/5.0'}
 
+# redirects followed at most for a single link
+MAX_REDIRECTS = 10
+# how often a link is checked again if the server asks to retry later, and
+# the longest delay accepted for that
+MAX_RETRIES = 3
+MAX_RETRY_AFTER = 300
 
-class HeadRequest(Request):
-    """Subclass of urllib2.Request that sends a HEAD request."""
-    def get_method(self):
-        return 'HEAD'
+# pages that were not read completely keep their connection open, so that
+# they can be read further for other anchors; if there are more, the
+# oldest are read to the end
+MAX_SUSPENDED_PAGES = 20
 
+# file in the doctree directory that keeps the results between builds
+CACHE_FILENAME = 'linkcheck.pickle'
+CACHE_VERSION = 1
 
-class AnchorCheckParser(HTMLParser):
-    """Specialized HTML parser that looks for a specific anchor."""
 
-    def __init__(self, search_anchor):
-        HTMLParser.__init__(self)
+class RetryLater(Exception):
+    """Raised if the server asked to repeat the request after a delay."""
+    def __init__(self, message, delay):
+        Exception.__init__(self, message)
+        self.delay = delay
+
+
+def parse_retry_after(value):
+    """Return the delay in seconds given by a Retry-After header value, or
+    None if it cannot be parsed.
+    """
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - time.time())
 
-        self.search_anchor = search_anchor
-        self.found = False
+
+class ConnectionPool(object):
+    """
+    Keeps persistent HTTP connections to reuse them for further requests to
+    the same host.  Connections are made through the proxies configured in the
+    environment, like urllib does.
+    """
+
+    def __init__(self, timeout=None):
+        self.kwargs = {}
+        if sys.version_info >= (2, 6) and timeout:
+            self.kwargs['timeout'] = timeout
+        self.proxies = getproxies()
+        self.lock = threading.Lock()
+        # (scheme, netloc) -> list of idle connections
+        self.idle = {}
+
+    def get_proxy(self, scheme, netloc):
+        proxy = self.proxies.get(scheme)
+        if not proxy or proxy_bypass(netloc.split(':')[0]):
+            return None
+        return urlsplit(proxy)[1] or proxy
+
+    def connect(self, scheme, netloc):
+        """Return a new connection to *netloc*, and whether requests must
+        be sent with the full URL (that is the case for HTTP proxies).
+        """
+        proxy = self.get_proxy(scheme, netloc)
+        if scheme == 'https':
+            if proxy and hasattr(httplib.HTTPSConnection, 'set_tunnel'):
+                conn = httplib.HTTPSConnection(proxy, **self.kwargs)
+                conn.set_tunnel(netloc)
+            else:
+                conn = httplib.HTTPSConnection(netloc, **self.kwargs)
+            return conn, False
+        if proxy:
+            return httplib.HTTPConnection(proxy, **self.kwargs), True
+        return httplib.HTTPConnection(netloc, **self.kwargs), False
+
+    def get(self, scheme, netloc):
+        """Return a tuple ``(connection, fullurl, reused)`` for *netloc*."""
+        self.lock.acquire()
+        try:
+            idle = self.idle.get((scheme, netloc))
+            if idle:
+                return idle.pop() + (True,)
+        finally:
+            self.lock.release()
+        return self.connect(scheme, netloc) + (False,)
+
+    def put(self, scheme, netloc, conn, fullurl, response):
+        """Give back a connection after *response* has been handled."""
+        if response.will_close or not response.isclosed():
+            # the connection can't be used for a further request
+            conn.close()
+            return
+        self.lock.acquire()
+        try:
+            self.idle.setdefault((scheme, netloc), []).append((conn, fullurl))
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            for idle in self.idle.itervalues():
+                for conn, fullurl in idle:
+                    conn.close()
+            self.idle.clear()
+        finally:
+            self.lock.release()
+
+
+class HostScheduler(object):
+    """
+    A queue of links to check, grouped by host.  :meth:`get` only hands out
+    links for hosts that have less than *maxactive* checks running and that
+    were not contacted in the last *delay* seconds.
+    """
+
+    def __init__(self, maxactive, delay):
+        self.maxactive = max(1, maxactive)
+        self.delay = delay
+        self.cond = threading.Condition()
+        self.pending = {}       # host -> deque of items
+        self.hosts = deque()    # hosts with pending items, in turn
+        self.active = {}        # host -> number of running checks
+        self.nactive = 0
+        self.not_before = {}    # host -> earliest time of the next request
+        self.closed = False
+
+    def put(self, host, item, first=False):
+        """Queue *item*; if *first* is true, before all others for *host*."""
+        self.cond.acquire()
+        try:
+            if host not in self.pending:
+                self.pending[host] = deque()
+                self.hosts.append(host)
+            if first:
+                self.pending[host].appendleft(item)
+            else:
+                self.pending[host].append(item)
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def get(self):
+        """Return the next ``(host, item)`` to check, or None if the queue is
+        closed and empty.  :meth:`done` must be called when the check is done.
+        """
+        self.cond.acquire()
+        try:
+            while True:
+                now = time.time()
+                timeout = None
+                for i in range(len(self.hosts)):
+                    host = self.hosts.popleft()
+                    self.hosts.append(host)
+                    if self.active.get(host, 0) >= self.maxactive:
+                        continue
+                    wait = self.not_before.get(host, 0) - now
+                    if wait > 0:
+                        if timeout is None or wait < timeout:
+                            timeout = wait
+                        continue
+                    items = self.pending[host]
+                    item = items.popleft()
+                    if not items:
+                        del self.pending[host]
+                        self.hosts.pop()
+                    self.active[host] = self.active.get(host, 0) + 1
+                    self.nactive += 1
+                    self.not_before[host] = now + self.delay
+                    return host, item
+                if self.closed and not self.pending and not self.nactive:
+                    return None
+                self.cond.wait(timeout)
+        finally:
+            self.cond.release()
+
+    def done(self, host, delay=0):
+        """Note that a check for *host* is done; if *delay* is given, the
+        host is not contacted again for that many seconds.
+        """
+        self.cond.acquire()
+        try:
+            self.active[host] -= 1
+            self.nactive -= 1
+            if delay:
+                self.not_before[host] = max(self.not_before.get(host, 0),
+                                            time.time() + delay)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def retry(self, host, item, delay):
+        """Note that a check for *host* is done, and queue *item* to be
+        checked again first, but not before *delay* seconds.
+        """
+        self.cond.acquire()
+        try:
+            # no other worker may get the item before the delay is set
+            self.not_before[host] = max(self.not_before.get(host, 0),
+                                        time.time() + delay)
+            self.put(host, item, first=True)
+            self.done(host)
+        finally:
+            self.cond.release()
+
+    def close(self):
+        """Let :meth:`get` return None once all queued items are done."""
+        self.cond.acquire()
+        try:
+            self.closed = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+
+class AnchorCollector(HTMLParser):
+    """Specialized HTML parser that collects the anchors of a page."""
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.anchors = set()
 
     def handle_starttag(self, tag, attrs):
         for key, value in attrs:
-            if key in ('id', 'name') and value == self.search_anchor:
-                self.found = True
+            if key in ('id', 'name'):
+                self.anchors.add(value)
 
 
-def check_anchor(f, hash):
-    """Reads HTML data from a filelike object 'f' searching for anchor 'hash'.
-    Returns True if anchor was found, False otherwise.
+class PageAnchors(object):
+    """
+    The anchors of a remote page, shared by all links to the page.  The page
+    is downloaded only once, and only as far as needed to find the anchors
+    that were looked for so far.  The :attr:`lock` must be held while using
+    the object.
     """
-    parser = AnchorCheckParser(hash)
-    try:
-        # Read file in chunks of 8192 bytes. If we find a matching anchor, we
-        # break the loop early in hopes not to have to download the whole thing.
-        chunk = f.read(8192)
-        while chunk and not parser.found:
-            parser.feed(chunk)
-            chunk = f.read(8192)
-        parser.close()
-    except HTMLParseError:
-        # HTMLParser is usually pretty good with sloppy HTML, but it tends to
-        # choke on EOF. But we're done then anyway.
-        pass
-    return parser.found
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # URL after redirects
+        self.url = None
+        # ETag and Last-Modified of the response
+        self.validators = None
+        # validators the server confirmed with "304 Not Modified"
+        self.not_modified = None
+        # error message, if the page couldn't be fetched
+        self.error = None
+        self.response = self.release = None
+        self.parser = AnchorCollector()
+        self.complete = False
+
+    def set_response(self, url, response, release):
+        self.url = url
+        self.response = response
+        self.release = release
+        self.validators = (response.getheader('etag'),
+                           response.getheader('last-modified'))
+
+    def read_chunk(self):
+        try:
+            chunk = self.response.read(8192)
+            if chunk:
+                self.parser.feed(chunk)
+                return
+            self.parser.close()
+        except HTMLParseError:
+            # HTMLParser is usually pretty good with sloppy HTML, but it tends
+            # to choke on EOF.  But we're done then anyway.
+            pass
+        except (httplib.HTTPException, socket.error):
+            pass
+        self.complete = True
+        self.release()
+        self.response = self.release = None
+
+    def find(self, anchor):
+        """Return whether the page has *anchor*."""
+        while anchor not in self.parser.anchors and not self.complete:
+            self.read_chunk()
+        return anchor in self.parser.anchors
+
+    def read_all(self):
+        while not self.complete:
+            self.read_chunk()
 
 
 class CheckExternalLinksBuilder(Builder):
@@ -80,13 +330,28 @@ class CheckExternalLinksBuilder(Builder):
         self.good = set()
         self.broken = {}
         self.redirected = {}
+        # uri -> list of (docname, lineno) of links whose check is running
+        self.pending = {}
+        # uri -> (status, info, time of check, etag, last-modified) of the
+        # previous builds; only the links found in this build are kept
+        self.cachefile = path.join(self.doctreedir, CACHE_FILENAME)
+        self.old_results = self.load_results()
+        self.results = {}
+        # URL -> PageAnchors, for checking anchors
+        self.anchor_pages = {}
+        self.suspended_pages = deque()
+        self.anchor_lock = threading.Lock()
         # set a timeout for non-responding servers
         socket.setdefaulttimeout(5.0)
         # create output file
         open(path.join(self.outdir, 'output.txt'), 'w').close()
 
-        # create queues and worker threads
-        self.wqueue = Queue.Queue()
+        # all links are collected first and checked by the worker threads
+        # as long as the documents are traversed; results are reported as
+        # they come in
+        self.pool = ConnectionPool(self.app.config.linkcheck_timeout)
+        self.wqueue = HostScheduler(self.app.config.linkcheck_host_workers,
+                                    self.app.config.linkcheck_host_delay)
         self.rqueue = Queue.Queue()
         self.workers = []
         for i in range(self.app.config.linkcheck_workers):
@@ -95,68 +360,284 @@ class CheckExternalLinksBuilder(Builder):
             thread.start()
             self.workers.append(thread)
 
-    def check_thread(self):
-        kwargs = {}
-        if sys.version_info > (2, 5) and self.app.config.linkcheck_timeout:
-            kwargs['timeout'] = self.app.config.linkcheck_timeout
-
-        def check():
-            # check for various conditions without bothering the network
-            if len(uri) == 0 or uri[0] == '#' or \
-               uri[0:7] == 'mailto:' or uri[0:4] == 'ftp:':
-                return 'unchecked', ''
-            elif not (uri[0:5] == 'http:' or uri[0:6] == 'https:'):
-                return 'local', ''
-            elif uri in self.good:
-                return 'working', ''
-            elif uri in self.broken:
-                return 'broken', self.broken[uri]
-            elif uri in self.redirected:
-                return 'redirected', self.redirected[uri]
-            for rex in self.to_ignore:
-                if rex.match(uri):
-                    return 'ignored', ''
-
-            if '#' in uri:
-                req_url, hash = uri.split('#', 1)
+    def load_results(self):
+        try:
+            f = open(self.cachefile, 'rb')
+            try:
+                version, results = pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            return {}
+        if version != CACHE_VERSION:
+            return {}
+        return results
+
+    def save_results(self):
+        tmpname = self.cachefile + '.tmp'
+        try:
+            f = open(tmpname, 'wb')
+            try:
+                pickle.dump((CACHE_VERSION, self.results), f,
+                            pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            movefile(tmpname, self.cachefile)
+        except (IOError, OSError), err:
+            self.warn('could not save link check results: %s' % err)
+
+    def open_url(self, method, url, headers={}):
+        """Send a request for *url*, following redirects.
+
+        Return a tuple ``(url, response, release)``, where *url* is the URL
+        after redirects and *release* must be called after the response has
+        been read.
+        """
+        headers = dict(request_headers, **headers)
+        for i in range(MAX_REDIRECTS + 1):
+            scheme, netloc, urlpath, query, _ = urlsplit(url)
+            while True:
+                conn, fullurl, reused = self.pool.get(scheme, netloc)
+                if fullurl:
+                    selector = url.split('#', 1)[0]
+                else:
+                    selector = (urlpath or '/') + (query and '?' + query or '')
+                try:
+                    conn.request(method, selector, headers=headers)
+                    response = conn.getresponse()
+                except (httplib.HTTPException, socket.error):
+                    conn.close()
+                    # the server may have closed a kept-alive connection
+                    if reused:
+                        continue
+                    raise
+                break
+            def release(conn=conn, fullurl=fullurl, response=response,
+                        key=(scheme, netloc)):
+                self.pool.put(key[0], key[1], conn, fullurl, response)
+            location = response.getheader('location')
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.read()
+                release()
+                url = urljoin(url, location)
+                continue
+            if response.status >= 400:
+                response.read()
+                release()
+                message = 'HTTP Error %d: %s' % (response.status,
+                                                  response.reason)
+                retry_after = response.getheader('retry-after')
+                if response.status in (429, 503) and retry_after:
+                    delay = parse_retry_after(retry_after)
+                    if delay is not None:
+                        raise RetryLater(message, delay)
+                raise Exception(message)
+            return url, response, release
+        raise Exception('too many redirects')
+
+    def check_anchor(self, req_url, anchor, validators, headers):
+        """Check whether the page *req_url* has *anchor*.
+
+        Return a tuple ``(url, found, validators)``.
+        """
+        self.anchor_lock.acquire()
+        try:
+            page = self.anchor_pages.get(req_url)
+            if page is None:
+                page = self.anchor_pages[req_url] = PageAnchors()
+        finally:
+            self.anchor_lock.release()
+
+        page.lock.acquire()
+        try:
+            if page.error is not None:
+                raise Exception(page.error)
+            if validators and validators == page.not_modified:
+                return page.url, True, validators
+            if page.response is None and not page.complete:
+                if page.not_modified is not None:
+                    # only unconditional requests get the page
+                    headers = {}
+                try:
+                    url, response, release = self.open_url('GET', req_url,
+                                                           headers)
+                except RetryLater:
+                    raise
+                except Exception, err:
+                    page.error = str(err)
+                    raise
+                if response.status == 304:
+                    response.read()
+                    release()
+                    page.url = url
+                    page.not_modified = validators
+                    return url, True, validators
+                page.set_response(url, response, release)
+                suspend = True
             else:
-                req_url = uri
-                hash = None
-
-            # need to actually check the URI
+                suspend = False
+            found = page.find(anchor)
+            result = page.url, found, page.validators
+        finally:
+            page.lock.release()
+
+        if suspend and not page.complete:
+            self.anchor_lock.acquire()
             try:
-                if hash and self.app.config.linkcheck_anchors:
-                    # Read the whole document and see if #hash exists
-                    f = opener.open(Request(req_url), **kwargs)
-                    found = check_anchor(f, unquote(hash))
-                    f.close()
-
-                    if not found:
-                        raise Exception("Anchor '%s' not found" % hash)
+                self.suspended_pages.append(page)
+                if len(self.suspended_pages) > MAX_SUSPENDED_PAGES:
+                    oldest = self.suspended_pages.popleft()
                 else:
-                    f = opener.open(HeadRequest(req_url), **kwargs)
-                    f.close()
-
-            except Exception, err:
-                self.broken[uri] = str(err)
-                return 'broken', str(err)
-            if f.url.rstrip('/') == req_url.rstrip('/'):
-                self.good.add(uri)
-                return 'working', 'new'
+                    oldest = None
+            finally:
+                self.anchor_lock.release()
+            if oldest is not None:
+                oldest.lock.acquire()
+                try:
+                    oldest.read_all()
+                finally:
+                    oldest.lock.release()
+        return result
+
+    def check_uri(self, uri, validators=None):
+        """Check the http(s) *uri*; return a tuple ``(status, info,
+        validators)``.
+
+        *validators* is a tuple ``(etag, last_modified)`` of a previous check
+        that found the link working; if the server says that the page has not
+        been modified since, it is still working.
+        """
+        if '#' in uri:
+            req_url, hash = uri.split('#', 1)
+        else:
+            req_url = uri
+            hash = None
+
+        headers = {}
+        if validators:
+            etag, last_modified = validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        # need to actually check the URI
+        try:
+            if hash and self.app.config.linkcheck_anchors:
+                # see if the page (read only once) has the anchor
+                new_url, found, validators = self.check_anchor(
+                    req_url, unquote(hash), validators, headers)
+                if not found:
+                    raise Exception("Anchor '%s' not found" % hash)
             else:
-                new_url = f.url
-                if hash:
-                    new_url += '#' + hash
-
-                self.redirected[uri] = new_url
-                return 'redirected', new_url
+                new_url, response, release = self.open_url('HEAD', req_url,
+                                                           headers)
+                response.read()
+                release()
+                if response.status != 304:
+                    # otherwise, the validators of the previous check apply
+                    validators = (response.getheader('etag'),
+                                  response.getheader('last-modified'))
+        except RetryLater:
+            raise
+        except Exception, err:
+            return 'broken', str(err), None
+        if new_url.rstrip('/') == req_url.rstrip('/'):
+            return 'working', 'new', validators
+        if hash:
+            new_url += '#' + hash
+        return 'redirected', new_url, None
 
+    def check_thread(self):
         while True:
-            uri, docname, lineno = self.wqueue.get()
-            if uri is None:
+            job = self.wqueue.get()
+            if job is None:
                 break
-            status, info = check()
-            self.rqueue.put((uri, docname, lineno, status, info))
+            host, (uri, validators, retries) = job
+            try:
+                status, info, validators = self.check_uri(uri, validators)
+            except RetryLater, err:
+                if retries < MAX_RETRIES and err.delay <= MAX_RETRY_AFTER:
+                    # check again when the server wants us to
+                    self.wqueue.retry(host, (uri, validators, retries + 1),
+                                      err.delay)
+                    continue
+                status, info, validators = 'broken', str(err), None
+            except Exception, err:
+                status, info, validators = 'broken', str(err), None
+            self.wqueue.done(host)
+            self.rqueue.put((uri, status, info, validators))
+
+    def queue_link(self, uri, docname, lineno):
+        """Report the link, or queue it to be checked by the workers."""
+        # check for various conditions without bothering the network
+        if len(uri) == 0 or uri[0] == '#' or \
+           uri[0:7] == 'mailto:' or uri[0:4] == 'ftp:':
+            return
+        elif not (uri[0:5] == 'http:' or uri[0:6] == 'https:'):
+            self.process_result((uri, docname, lineno, 'local', ''))
+            return
+        elif uri in self.good:
+            return
+        elif uri in self.broken:
+            self.process_result((uri, docname, lineno, 'broken',
+                                 self.broken[uri]))
+            return
+        elif uri in self.redirected:
+            self.process_result((uri, docname, lineno, 'redirected',
+                                 self.redirected[uri]))
+            return
+        for rex in self.to_ignore:
+            if rex.match(uri):
+                self.process_result((uri, docname, lineno, 'ignored', ''))
+                return
+        if uri in self.pending:
+            self.pending[uri].append((docname, lineno))
+            return
+        self.pending[uri] = [(docname, lineno)]
+        validators = None
+        if uri in self.old_results:
+            status, info, checked, etag, last_modified = \
+                self.old_results[uri]
+            ttl = self.app.config.linkcheck_cache_ttl.get(status)
+            if self.app.config.linkcheck_only_new or \
+                   (ttl is not None and checked + ttl > time.time()):
+                # trust the result of the previous check
+                self.results[uri] = self.old_results[uri]
+                self.record_result(uri, status, info)
+                return
+            if status == 'working':
+                validators = (etag, last_modified)
+        self.wqueue.put(urlsplit(uri)[1].lower(), (uri, validators, 0))
+
+    def record_result(self, uri, status, info):
+        """Report the result of checking *uri* for all its pending links."""
+        if status == 'working':
+            self.good.add(uri)
+        elif status == 'broken':
+            self.broken[uri] = info
+            self.app.statuscode = 1
+        elif status == 'redirected':
+            self.redirected[uri] = info
+        for docname, lineno in self.pending.pop(uri):
+            self.process_result((uri, docname, lineno, status, info))
+            if status == 'working':
+                # report only once
+                info = ''
+
+    def process_results(self, block):
+        """Report the results of finished checks; if *block* is true, wait
+        for at least one.
+        """
+        while self.pending:
+            try:
+                uri, status, info, validators = self.rqueue.get(block)
+            except Queue.Empty:
+                return
+            block = False
+            self.results[uri] = (status, info, time.time()) + \
+                (validators or (None, None))
+            self.record_result(uri, status, info)
 
     def process_result(self, result):
         uri, docname, lineno, status, info = result
@@ -194,7 +675,6 @@ class CheckExternalLinksBuilder(Builder):
 
     def write_doc(self, docname, doctree):
         self.info()
-        n = 0
         for node in doctree.traverse(nodes.reference):
             if 'refuri' not in node:
                 continue
@@ -205,15 +685,8 @@ class CheckExternalLinksBuilder(Builder):
                 if node is None:
                     break
                 lineno = node.line
-            self.wqueue.put((uri, docname, lineno), False)
-            n += 1
-        done = 0
-        while done < n:
-            self.process_result(self.rqueue.get())
-            done += 1
-
-        if self.broken:
-            self.app.statuscode = 1
+            self.queue_link(uri, docname, lineno)
+        self.process_results(block=False)
 
     def write_entry(self, what, docname, line, uri):
         output = open(path.join(self.outdir, 'output.txt'), 'a')
@@ -222,5 +695,13 @@ class CheckExternalLinksBuilder(Builder):
         output.close()
 
     def finish(self):
+        self.wqueue.close()
+        while self.pending:
+            self.process_results(block=True)
         for worker in self.workers:
-            self.wqueue.put((None, None, None), False)
+            worker.join()
+        for page in self.suspended_pages:
+            if page.release is not None:
+                page.release()
+        self.pool.close()
+        self.save_results()
@@ -27,6 +27,8 @@ class WebSupportBuilder(PickleHTMLBuilder):
     """
     name = 'websupport'
     versioning_method = 'commentable'
+    # the search adapter and storage backend are not process safe
+    allow_parallel = False
 
     def init(self):
         PickleHTMLBuilder.init(self)
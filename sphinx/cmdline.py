@@ -39,6 +39,7 @@ new and changed files
          -t <tag>  -- include "only" blocks with <tag>
          -d <path> -- path for the cached environment and doctree files
                       (default: outdir/.doctrees)
+         -j <N>    -- build in parallel with N processes where possible
          -c <path> -- path where configuration file (conf.py) is located
                       (default: same as sourcedir)
          -C        -- use no config file at all, only -D options
@@ -63,7 +64,7 @@ def main(argv):
         nocolor()
 
     try:
-        opts, args = getopt.getopt(argv[1:], 'ab:t:d:c:CD:A:ng:NEqQWw:P')
+        opts, args = getopt.getopt(argv[1:], 'ab:t:d:c:CD:A:ng:NEqQWw:Pj:')
         allopts = set(opt[0] for opt in opts)
         srcdir = confdir = path.abspath(args[0])
         if not path.isdir(srcdir):
@@ -108,6 +109,7 @@ def main(argv):
     confoverrides = {}
     tags = []
     doctreedir = path.join(outdir, '.doctrees')
+    parallel = 0
     for opt, val in opts:
         if opt == '-b':
             buildername = val
@@ -177,6 +179,13 @@ def main(argv):
             warnfile = val
         elif opt == '-P':
             use_pdb = True
+        elif opt == '-j':
+            try:
+                parallel = int(val)
+            except ValueError:
+                print >>sys.stderr, ('Error: -j option argument must be an '
+                                     'integer.')
+                return 1
 
     if warning and warnfile:
         warnfp = open(warnfile, 'w')
@@ -186,7 +195,7 @@ def main(argv):
     try:
         app = Sphinx(srcdir, confdir, outdir, doctreedir, buildername,
                      confoverrides, status, warning, freshenv,
-                     warningiserror, tags)
+                     warningiserror, tags, parallel)
         app.build(force_all, filenames)
         return app.statuscode
     except KeyboardInterrupt:
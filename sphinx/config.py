@@ -73,6 +73,12 @@ class Config(object):
         needs_sphinx = (None, None),
         nitpicky = (False, 'env'),
         nitpick_ignore = ([], 'env'),
+        doctree_cache_entries = (100, None),
+        doctree_cache_memory = (128, None),
+        use_content_digests = (False, None),
+        render_cache_dir = (None, None),
+        render_cache_size = (256, None),
+        render_workers = (None, None),
 
         # HTML options
         html_theme = ('default', 'html'),
@@ -110,6 +116,7 @@ class Config(object):
         html_secnumber_suffix = ('. ', 'html'),
         html_search_language = (None, 'html'),
         html_search_options = ({}, 'html'),
+        html_search_shards = (0, 'html'),
 
         # HTML help only options
         htmlhelp_basename = (lambda self: make_filename(self.project), None),
@@ -181,6 +188,10 @@ class Config(object):
         linkcheck_timeout = (None, None),
         linkcheck_workers = (5, None),
         linkcheck_anchors = (True, None),
+        linkcheck_host_workers = (2, None),
+        linkcheck_host_delay = (0, None),
+        linkcheck_cache_ttl = ({}, None),
+        linkcheck_only_new = (False, None),
 
         # gettext options
         gettext_compact = (True, 'gettext'),
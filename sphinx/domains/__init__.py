@@ -12,6 +12,7 @@
 
 from sphinx.errors import SphinxError
 from sphinx.locale import _
+from sphinx.util import DocIndexedDict
 
 
 class ObjType(object):
@@ -138,6 +139,10 @@ class Domain(object):
     initial_data = {}
     #: data version, bump this when the format of `self.data` changes
     data_version = 0
+    #: keys of `self.data` that are dictionaries mapping to docnames or to
+    #: tuples whose first item is a docname; they are indexed by docname, so
+    #: that the default :meth:`clear_doc` only touches the document's entries
+    indexed_data = ()
 
     def __init__(self, env):
         self.env = env
@@ -150,6 +155,9 @@ class Domain(object):
             self.data = env.domaindata[self.name]
             if self.data['version'] != self.data_version:
                 raise IOError('data of %r domain out of date' % self.label)
+        for key in self.indexed_data:
+            if not isinstance(self.data[key], DocIndexedDict):
+                self.data[key] = DocIndexedDict(self.data[key])
         self._role_cache = {}
         self._directive_cache = {}
         self._role2type = {}
@@ -195,7 +203,16 @@ class Domain(object):
 
     def clear_doc(self, docname):
         """Remove traces of a document in the domain-specific inventories."""
-        pass
+        for key in self.indexed_data:
+            self.data[key].purge_doc(docname)
+
+    def merge_domaindata(self, docnames, otherdata):
+        """Merge in data regarding *docnames* from a different domaindata
+        inventory (coming from a worker process in parallel builds).
+        """
+        raise NotImplementedError('merge_domaindata must be implemented in %s '
+                                  'to be able to do parallel builds!' %
+                                  self.__class__)
 
     def process_doc(self, env, docname, document):
         """Process a document after it is read by the environment."""
@@ -224,11 +224,12 @@ class CDomain(Domain):
     initial_data = {
         'objects': {},  # fullname -> docname, objtype
     }
+    indexed_data = ('objects',)
 
-    def clear_doc(self, docname):
-        for fullname, (fn, _) in self.data['objects'].items():
-            if fn == docname:
-                del self.data['objects'][fullname]
+    def merge_domaindata(self, docnames, otherdata):
+        for fullname, (fn, objtype) in otherdata['objects'].items():
+            if fn in docnames:
+                self.data['objects'][fullname] = (fn, objtype)
 
     def resolve_xref(self, env, fromdocname, builder,
                      typ, target, node, contnode):
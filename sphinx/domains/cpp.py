@@ -1207,11 +1207,12 @@ class CPPDomain(Domain):
     initial_data = {
         'objects': {},  # fullname -> docname, objtype
     }
+    indexed_data = ('objects',)
 
-    def clear_doc(self, docname):
-        for fullname, (fn, _, _) in self.data['objects'].items():
-            if fn == docname:
-                del self.data['objects'][fullname]
+    def merge_domaindata(self, docnames, otherdata):
+        for fullname, data in otherdata['objects'].items():
+            if data[0] in docnames:
+                self.data['objects'][fullname] = data
 
     def resolve_xref(self, env, fromdocname, builder,
                      typ, target, node, contnode):
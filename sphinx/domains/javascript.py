@@ -181,11 +181,12 @@ class JavaScriptDomain(Domain):
     initial_data = {
         'objects': {}, # fullname -> docname, objtype
     }
+    indexed_data = ('objects',)
 
-    def clear_doc(self, docname):
-        for fullname, (fn, _) in self.data['objects'].items():
-            if fn == docname:
-                del self.data['objects'][fullname]
+    def merge_domaindata(self, docnames, otherdata):
+        for fullname, (fn, objtype) in otherdata['objects'].items():
+            if fn in docnames:
+                self.data['objects'][fullname] = (fn, objtype)
 
     def find_obj(self, env, obj, name, typ, searchorder=0):
         if name[-2:] == '()':
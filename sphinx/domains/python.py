@@ -597,17 +597,52 @@ class PythonDomain(Domain):
         'objects': {},  # fullname -> docname, objtype
         'modules': {},  # modname -> docname, synopsis, platform, deprecated
     }
+    indexed_data = ('objects', 'modules')
     indices = [
         PythonModuleIndex,
     ]
 
+    def __init__(self, env):
+        Domain.__init__(self, env)
+        # last component of the name -> set of full names, for "fuzzy"
+        # lookups; built on first use and kept up to date afterwards
+        self._suffix_index = None
+
+    def _index_names(self, fullnames):
+        if self._suffix_index is None:
+            return
+        for fullname in fullnames:
+            lastname = fullname.rpartition('.')[2]
+            self._suffix_index.setdefault(lastname, set()).add(fullname)
+
+    def _get_suffix_index(self):
+        if self._suffix_index is None:
+            self._suffix_index = {}
+            self._index_names(self.data['objects'])
+        return self._suffix_index
+
     def clear_doc(self, docname):
-        for fullname, (fn, _) in self.data['objects'].items():
-            if fn == docname:
-                del self.data['objects'][fullname]
-        for modname, (fn, _, _, _) in self.data['modules'].items():
-            if fn == docname:
-                del self.data['modules'][modname]
+        if self._suffix_index is not None:
+            for fullname in self.data['objects'].keys_for_doc(docname):
+                lastname = fullname.rpartition('.')[2]
+                fullnames = self._suffix_index.get(lastname)
+                if fullnames is not None:
+                    fullnames.discard(fullname)
+                    if not fullnames:
+                        del self._suffix_index[lastname]
+        Domain.clear_doc(self, docname)
+
+    def process_doc(self, env, docname, document):
+        self._index_names(self.data['objects'].keys_for_doc(docname))
+
+    def merge_domaindata(self, docnames, otherdata):
+        for fullname, (fn, objtype) in otherdata['objects'].items():
+            if fn in docnames:
+                self.data['objects'][fullname] = (fn, objtype)
+                self._index_names([fullname])
+        for modname, data in otherdata['modules'].items():
+            if data[0] in docnames:
+                self.data['modules'][modname] = data
 
     def find_obj(self, env, modname, classname, name, type, searchmode=0):
         """Find a Python object for "name", perhaps using the given module
@@ -638,10 +673,15 @@ class PythonDomain(Domain):
                     elif name in objects and objects[name][1] in objtypes:
                         newname = name
                     else:
-                        # "fuzzy" searching mode
+                        # "fuzzy" searching mode: only objects with the
+                        # same last name component can match
                         searchname = '.' + name
-                        matches = [(oname, objects[oname]) for oname in objects
+                        candidates = self._get_suffix_index().get(
+                            name.rpartition('.')[2], ())
+                        matches = [(oname, objects[oname])
+                                   for oname in sorted(candidates)
                                    if oname.endswith(searchname)
+                                   and oname in objects
                                    and objects[oname][1] in objtypes]
         else:
             # NOTE: searching for exact match, object type is not considered
@@ -115,11 +115,12 @@ class ReSTDomain(Domain):
     initial_data = {
         'objects': {},  # fullname -> docname, objtype
     }
+    indexed_data = ('objects',)
 
-    def clear_doc(self, docname):
-        for (typ, name), doc in self.data['objects'].items():
-            if doc == docname:
-                del self.data['objects'][typ, name]
+    def merge_domaindata(self, docnames, otherdata):
+        for (typ, name), doc in otherdata['objects'].items():
+            if doc in docnames:
+                self.data['objects'][typ, name] = doc
 
     def resolve_xref(self, env, fromdocname, builder, typ, target, node,
                      contnode):
@@ -450,6 +450,7 @@ class StandardDomain(Domain):
             'search':   ('search', ''),
         },
     }
+    indexed_data = ('progoptions', 'objects', 'labels', 'anonlabels')
 
     dangling_warnings = {
         'term': 'term not in glossary: %(target)s',
@@ -458,19 +459,11 @@ class StandardDomain(Domain):
         'keyword': 'unknown keyword: %(target)s',
     }
 
-    def clear_doc(self, docname):
-        for key, (fn, _) in self.data['progoptions'].items():
-            if fn == docname:
-                del self.data['progoptions'][key]
-        for key, (fn, _) in self.data['objects'].items():
-            if fn == docname:
-                del self.data['objects'][key]
-        for key, (fn, _, _) in self.data['labels'].items():
-            if fn == docname:
-                del self.data['labels'][key]
-        for key, (fn, _) in self.data['anonlabels'].items():
-            if fn == docname:
-                del self.data['anonlabels'][key]
+    def merge_domaindata(self, docnames, otherdata):
+        for key in ('progoptions', 'objects', 'labels', 'anonlabels'):
+            for name, data in otherdata[key].items():
+                if data[0] in docnames:
+                    self.data[key][name] = data
 
     def process_doc(self, env, docname, document):
         labels, anonlabels = self.data['labels'], self.data['anonlabels']
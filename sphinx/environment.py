@@ -20,6 +20,11 @@ import string
 import unicodedata
 import cPickle as pickle
 from os import path
+try:
+    from hashlib import md5
+except ImportError:
+    # 2.4 compatibility
+    from md5 import md5
 from glob import glob
 from itertools import izip, groupby
 
@@ -38,12 +43,15 @@ from docutils.transforms.parts import ContentsFilter
 
 from sphinx import addnodes
 from sphinx.util import url_re, get_matching_docs, docname_join, split_into, \
-     FilenameUniqDict
+     FilenameUniqDict, DocIndexedDict, SegmentedDict, LRUCache, key_segment
 from sphinx.util.nodes import clean_astext, make_refnode, extract_messages, \
      WarningStream
-from sphinx.util.osutil import movefile, SEP, ustrftime, find_catalog
+from sphinx.util.osutil import movefile, SEP, ustrftime, find_catalog, \
+     ensuredir, file_digest
 from sphinx.util.matching import compile_matchers
 from sphinx.util.pycompat import all, class_types
+from sphinx.util.parallel import ParallelTasks, parallel_available, \
+     make_chunks
 from sphinx.util.websupport import is_commentable
 from sphinx.errors import SphinxError, ExtensionError
 from sphinx.locale import _, init as init_locale
@@ -71,7 +79,12 @@ default_settings = {
 
 # This is increased every time an environment attribute is added
 # or changed to properly invalidate pickle files.
-ENV_VERSION = 41
+ENV_VERSION = 44
+
+# the per-document inventories are pickled in segments of about this many
+# documents, but in no more than ENV_MAX_SEGMENTS segments
+ENV_SEGMENT_SIZE = 20
+ENV_MAX_SEGMENTS = 256
 
 
 default_substitutions = set([
@@ -265,6 +278,12 @@ class SphinxContentsFilter(ContentsFilter):
         raise nodes.SkipNode
 
 
+def segments_dir(filename):
+    """Return the directory for the segment files of an environment pickled
+    to *filename*."""
+    return path.splitext(filename)[0] + '.segments'
+
+
 class BuildEnvironment:
     """
     The environment in which the ReST files are translated.
@@ -274,6 +293,13 @@ class BuildEnvironment:
 
     # --------- ENVIRONMENT PERSISTENCE ----------------------------------------
 
+    # per-document inventories that are not stored in the environment pickle
+    # itself, but in segment files that are only loaded when needed; each is
+    # mostly looked up by docname (unlike e.g. indexentries, which is only
+    # used as a whole) and has its own segment files
+    _segmented_attrs = ['metadata', 'titles', 'longtitles', 'tocs',
+                        'toc_num_entries']
+
     @staticmethod
     def frompickle(config, filename):
         picklefile = open(filename, 'rb')
@@ -284,9 +310,21 @@ class BuildEnvironment:
         if env.version != ENV_VERSION:
             raise IOError('env version not current')
         env.config.values = config.values
+        env._init_segments(segments_dir(filename))
+        for segfile in env._segments.itervalues():
+            if not path.isfile(path.join(env._segdir, segfile)):
+                raise IOError('env segment %s is missing' % segfile)
+        env._init_doctree_cache(config)
         return env
 
-    def topickle(self, filename):
+    def topickle(self, filename, segmented=True):
+        """Pickle the environment to *filename*.
+
+        If *segmented* is true, the per-document inventories are written to
+        segment files in a directory next to *filename*; of these, only the
+        segments that were loaded since unpickling are pickled again, and only
+        those that changed are written.  Otherwise, the pickle is complete.
+        """
         # remove unpicklable attributes
         warnfunc = self._warnfunc
         self.set_warnfunc(None)
@@ -294,6 +332,22 @@ class BuildEnvironment:
         del self.config.values
         domains = self.domains
         del self.domains
+        doctree_cache = self._doctree_cache
+        del self._doctree_cache
+        self._global_toctrees = {}
+        self._current_digests = {}
+        segments = self._segments
+        perdoc = [(attr, getattr(self, attr)) for attr in self._segmented_attrs]
+        if segmented:
+            segdir = segments_dir(filename)
+            self._save_segments(segdir)
+            for attr, _ in perdoc:
+                setattr(self, attr, None)
+        else:
+            # copy() loads all segments and returns a normal dict
+            for attr, value in perdoc:
+                setattr(self, attr, value.copy())
+            self._segments = {}
         # first write to a temporary file, so that if dumping fails,
         # the existing environment won't be overwritten
         picklefile = open(filename + '.tmp', 'wb')
@@ -310,10 +364,101 @@ class BuildEnvironment:
             picklefile.close()
         movefile(filename + '.tmp', filename)
         # reset attributes
+        for attr, value in perdoc:
+            setattr(self, attr, value)
+        if segmented:
+            # the new pickle is in place: remove files of replaced segments
+            used = set(self._segments.itervalues())
+            for fn in os.listdir(segdir):
+                if fn not in used:
+                    os.unlink(path.join(segdir, fn))
+        else:
+            self._segments = segments
+        self._doctree_cache = doctree_cache
         self.domains = domains
         self.config.values = values
         self.set_warnfunc(warnfunc)
 
+    def _init_segments(self, segdir):
+        """Prepare the per-document inventories of an unpickled environment
+        to be loaded lazily from the segment files in *segdir*.
+        """
+        self._segdir = segdir
+        for attr in self._segmented_attrs:
+            if getattr(self, attr) is None:
+                unloaded = set([segment for (segattr, segment)
+                                in self._segments if segattr == attr])
+                setattr(self, attr, SegmentedDict(
+                    self._nsegments, unloaded, self._segment_loader(attr)))
+
+    def _init_doctree_cache(self, config):
+        maxsize = config.doctree_cache_memory
+        if maxsize is not None:
+            maxsize *= 1024 * 1024
+        # the cache holds pickled doctrees: unpickling them is the cheapest
+        # way to give every caller its own copy
+        self._doctree_cache = LRUCache(config.doctree_cache_entries, maxsize)
+
+    def _segment_loader(self, attr):
+        def load_segment(segment):
+            self._load_segment(attr, segment)
+        return load_segment
+
+    def _load_segment(self, attr, segment):
+        inventory = getattr(self, attr)
+        filename = path.join(self._segdir, self._segments[attr, segment])
+        try:
+            segfile = open(filename, 'rb')
+            try:
+                data = pickle.load(segfile)
+            finally:
+                segfile.close()
+        except Exception, err:
+            raise SphinxError('could not load environment segment %s (%s); '
+                              'please rebuild with a fresh environment '
+                              '(-E option)' % (filename, err))
+        inventory.unloaded.discard(segment)
+        dict.update(inventory, data)
+
+    def _save_segments(self, segdir):
+        """Write all loaded segments of the per-document inventories to
+        *segdir*.
+
+        Segment files are named after the hash of their contents: unchanged
+        segments need not be written, and the files used by the previous
+        environment pickle stay intact until it is replaced.
+        """
+        if not self._nsegments:
+            self._nsegments = max(1, min(len(self.all_docs) // ENV_SEGMENT_SIZE,
+                                         ENV_MAX_SEGMENTS))
+        nsegments = self._nsegments
+        buckets = {}
+        for attr in self._segmented_attrs:
+            inventory = getattr(self, attr)
+            unloaded = getattr(inventory, 'unloaded', ())
+            for segment in range(nsegments):
+                if segment not in unloaded:
+                    buckets[attr, segment] = {}
+            # don't trigger loading of the other segments
+            for docname, value in dict.items(inventory):
+                buckets[attr, key_segment(docname, nsegments)][docname] = value
+        ensuredir(segdir)
+        for key, data in buckets.iteritems():
+            if not data:
+                self._segments.pop(key, None)
+                continue
+            data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+            fn = '%s.pickle' % md5(data).hexdigest()
+            segfilename = path.join(segdir, fn)
+            if not path.isfile(segfilename):
+                segfile = open(segfilename + '.tmp', 'wb')
+                try:
+                    segfile.write(data)
+                finally:
+                    segfile.close()
+                movefile(segfilename + '.tmp', segfilename)
+            self._segments[key] = fn
+
     # --------- ENVIRONMENT INITIALIZATION -------------------------------------
 
     def __init__(self, srcdir, doctreedir, config):
@@ -340,6 +485,12 @@ class BuildEnvironment:
         # this is to invalidate old pickles
         self.version = ENV_VERSION
 
+        # (attribute, segment number) -> segment file name, for the pickled
+        # per-document inventories (see topickle)
+        self._nsegments = 0
+        self._segments = {}
+        self._segdir = None
+
         # make this a set for faster testing
         self._nitpick_ignore = set(self.config.nitpick_ignore)
 
@@ -353,6 +504,9 @@ class BuildEnvironment:
                                     # names, relative to documentation root
         self.reread_always = set()  # docnames to re-read unconditionally on
                                     # next build
+        self.digests = {}           # docname -> dict of file name (like in
+                                    # dependencies) -> content digest, for
+                                    # the source and its dependencies
 
         # File metadata
         self.metadata = {}          # docname -> dict of metadata items
@@ -377,11 +531,13 @@ class BuildEnvironment:
         self.domaindata = {}        # domainname -> domain-specific dict
 
         # Other inventories
-        self.citations = {}         # citation name -> docname, labelid
+        self.citations = DocIndexedDict()  # citation name -> docname, labelid
         self.indexentries = {}      # docname -> list of
                                     # (type, string, target, aliasname)
         self.versionchanges = {}    # version -> list of (type, docname,
                                     # lineno, module, descname, content)
+        self.changed_versions = {}  # docname -> set of versions that have
+                                    # changes noted in the document
 
         # these map absolute path -> (docnames, unique filename)
         self.images = FilenameUniqDict()
@@ -390,6 +546,17 @@ class BuildEnvironment:
         # temporary data storage while reading a document
         self.temp_data = {}
 
+        # docname -> pickled doctree, for recently used doctrees
+        self._init_doctree_cache(config)
+
+        # (titles_only, includehidden) -> (builder, list of (toctree node,
+        # TOC entries)) for the master document, see get_toctree_for
+        self._global_toctrees = {}
+
+        # (absolute file name, mtime) -> content digest, for files whose
+        # digest was already computed in this process
+        self._current_digests = {}
+
     def set_warnfunc(self, func):
         self._warnfunc = func
         self.settings['warning_stream'] = WarningStream(func)
@@ -420,33 +587,37 @@ class BuildEnvironment:
 
     def clear_doc(self, docname):
         """Remove all traces of a source file in the inventory."""
+        self._doctree_cache.discard(docname)
+        self._global_toctrees.clear()
         if docname in self.all_docs:
             self.all_docs.pop(docname, None)
             self.reread_always.discard(docname)
             self.metadata.pop(docname, None)
             self.dependencies.pop(docname, None)
+            self.digests.pop(docname, None)
             self.titles.pop(docname, None)
             self.longtitles.pop(docname, None)
             self.tocs.pop(docname, None)
             self.toc_secnumbers.pop(docname, None)
             self.toc_num_entries.pop(docname, None)
-            self.toctree_includes.pop(docname, None)
             self.indexentries.pop(docname, None)
             self.glob_toctrees.discard(docname)
             self.numbered_toctrees.discard(docname)
             self.images.purge_doc(docname)
             self.dlfiles.purge_doc(docname)
 
-            for subfn, fnset in self.files_to_rebuild.items():
-                fnset.discard(docname)
-                if not fnset:
-                    del self.files_to_rebuild[subfn]
-            for key, (fn, _) in self.citations.items():
-                if fn == docname:
-                    del self.citations[key]
-            for version, changes in self.versionchanges.items():
-                new = [change for change in changes if change[1] != docname]
-                changes[:] = new
+            # only look at the entries the document actually contributed
+            for subfn in self.toctree_includes.pop(docname, ()):
+                fnset = self.files_to_rebuild.get(subfn)
+                if fnset is not None:
+                    fnset.discard(docname)
+                    if not fnset:
+                        del self.files_to_rebuild[subfn]
+            self.citations.purge_doc(docname)
+            for version in self.changed_versions.pop(docname, ()):
+                changes = self.versionchanges[version]
+                changes[:] = [change for change in changes
+                              if change[1] != docname]
 
         for domain in self.domains.values():
             domain.clear_doc(docname)
@@ -531,7 +702,8 @@ class BuildEnvironment:
                 # check the mtime of the document
                 mtime = self.all_docs[docname]
                 newmtime = path.getmtime(self.doc2path(docname))
-                if newmtime > mtime:
+                if newmtime > mtime and not self.digest_unchanged(
+                        docname, self.doc2path(docname, None)):
                     changed.add(docname)
                     continue
                 # finally, check the mtime of dependencies
@@ -543,7 +715,8 @@ class BuildEnvironment:
                             changed.add(docname)
                             break
                         depmtime = path.getmtime(deppath)
-                        if depmtime > mtime:
+                        if depmtime > mtime and \
+                               not self.digest_unchanged(docname, dep):
                             changed.add(docname)
                             break
                     except EnvironmentError:
@@ -553,6 +726,32 @@ class BuildEnvironment:
 
         return added, changed, removed
 
+    def get_file_digest(self, filename):
+        """Return the content digest of *filename* (relative to the source
+        directory, or absolute)."""
+        filename = path.join(self.srcdir, filename)
+        key = (filename, path.getmtime(filename))
+        digest = self._current_digests.get(key)
+        if digest is None:
+            digest = self._current_digests[key] = file_digest(filename)
+        return digest
+
+    def digest_unchanged(self, docname, filename):
+        """Return True if content digests are used (see the
+        :confval:`use_content_digests` config value) and *filename* (the source
+        of *docname* or one of its dependencies) has the same content as when
+        *docname* was last read, even though its mtime may be newer.
+        """
+        if not self.config.use_content_digests:
+            return False
+        digest = self.digests.get(docname, {}).get(filename)
+        if digest is None:
+            return False
+        try:
+            return self.get_file_digest(filename) == digest
+        except EnvironmentError:
+            return False
+
     def update(self, config, srcdir, doctreedir, app=None):
         """(Re-)read all files new or changed since last update.
 
@@ -613,9 +812,16 @@ class BuildEnvironment:
                 self.clear_doc(docname)
 
             # read all new and changed files
-            for docname in sorted(added | changed):
-                yield docname
-                self.read_doc(docname, app=app)
+            docnames = sorted(added | changed)
+            if app and app.parallel > 1 and parallel_available and \
+                   len(docnames) > 5 and app.is_parallel_allowed('read'):
+                for docname in self._read_parallel(docnames, app,
+                                                   app.parallel):
+                    yield docname
+            else:
+                for docname in docnames:
+                    yield docname
+                    self.read_doc(docname, app=app)
 
             if config.master_doc not in self.all_docs:
                 self.warn(None, 'master file %s not found' %
@@ -627,6 +833,109 @@ class BuildEnvironment:
 
         return msg, len(added | changed), update_generator()
 
+    def _read_parallel(self, docnames, app, nproc):
+        """Read *docnames* in up to *nproc* worker processes, yielding each
+        docname once its results have been merged into this environment.
+        """
+        # clear all outdated docs at once; the workers fork from this state
+        for docname in docnames:
+            app.emit('env-purge-doc', self, docname)
+            self.clear_doc(docname)
+
+        def read_process(docs):
+            warnings = []
+            self.set_warnfunc(lambda *args: warnings.append(args))
+            for docname in docs:
+                self.read_doc(docname, app=app)
+            # only send back the per-document data of this chunk, and remove
+            # all unpicklable attributes
+            self.set_warnfunc(None)
+            self.app = None
+            del self.domains
+            del self.config
+            del self._doctree_cache
+            docs = set(docs)
+            for attr in self._perdoc_attrs:
+                value = getattr(self, attr)
+                setattr(self, attr, dict((docname, value[docname])
+                                         for docname in docs
+                                         if docname in value))
+            return pickle.dumps((docs, warnings, self),
+                                pickle.HIGHEST_PROTOCOL)
+
+        merged = []
+        warnings = []
+        reread = set()
+        def merge(result):
+            docs, chunk_warnings, other = pickle.loads(result)
+            warnings.extend(chunk_warnings)
+            reread.update(self.merge_info_from(docs, other, app))
+            merged.extend(sorted(docs))
+
+        tasks = ParallelTasks(nproc)
+        for chunk in make_chunks(docnames, nproc):
+            tasks.add_task(read_process, chunk, merge)
+            while merged:
+                yield merged.pop(0)
+        tasks.join()
+        for docname in merged:
+            yield docname
+
+        for warning in warnings:
+            self._warnfunc(*warning)
+        # documents whose download files got a different unique name than
+        # the one their worker assigned must be read again
+        for docname in sorted(reread):
+            self.read_doc(docname, app=app)
+
+    # docname-keyed dictionaries that are filled while reading a document
+    _perdoc_attrs = ['all_docs', 'metadata', 'dependencies', 'digests',
+                     'titles', 'longtitles', 'tocs', 'toc_num_entries',
+                     'toctree_includes', 'indexentries', 'changed_versions']
+
+    def merge_info_from(self, docnames, other, app):
+        """Merge the inventory entries of the documents *docnames*, read by
+        a parallel worker into the environment *other*, into this environment.
+
+        Return a set of docnames that have to be read again.
+        """
+        docnames = set(docnames)
+        self._global_toctrees.clear()
+        for attr in self._perdoc_attrs:
+            mine, theirs = getattr(self, attr), getattr(other, attr)
+            for docname in docnames:
+                if docname in theirs:
+                    mine[docname] = theirs[docname]
+        self.reread_always.update(other.reread_always & docnames)
+        self.glob_toctrees.update(other.glob_toctrees & docnames)
+        self.numbered_toctrees.update(other.numbered_toctrees & docnames)
+        for subfn, fnset in other.files_to_rebuild.iteritems():
+            fnset = fnset & docnames
+            if fnset:
+                self.files_to_rebuild.setdefault(subfn, set()).update(fnset)
+        for label, (docname, labelid) in other.citations.iteritems():
+            if docname not in docnames:
+                continue
+            if label in self.citations:
+                self.warn(docname, 'duplicate citation %s, other instance '
+                          'in %s' % (label, self.doc2path(
+                              self.citations[label][0])))
+            self.citations[label] = (docname, labelid)
+        for version, changes in other.versionchanges.iteritems():
+            self.versionchanges.setdefault(version, []).extend(
+                change for change in changes if change[1] in docnames)
+        self.images.merge_other(docnames, other.images)
+        reread = set()
+        for filename, (docs, unique) in other.dlfiles.iteritems():
+            docs = docs & docnames
+            for docname in docs:
+                if self.dlfiles.add_file(docname, filename) != unique:
+                    reread.add(docname)
+        for domainname, domain in self.domains.iteritems():
+            domain.merge_domaindata(docnames, other.domaindata[domainname])
+        app.emit('env-merge-info', self, docnames, other)
+        return reread
+
     def check_dependents(self, already):
         to_rewrite = self.assign_section_numbers()
         for docname in to_rewrite:
@@ -793,6 +1102,17 @@ class BuildEnvironment:
         self.all_docs[docname] = max(
                 time.time(), path.getmtime(self.doc2path(docname)))
 
+        if self.config.use_content_digests:
+            # store the contents' digests, so that files which only got a
+            # newer mtime (e.g. in a fresh checkout) aren't read again
+            digests = self.digests[docname] = {}
+            for filename in [self.doc2path(docname, None)] + \
+                    sorted(self.dependencies.get(docname, ())):
+                try:
+                    digests[filename] = self.get_file_digest(filename)
+                except EnvironmentError:
+                    pass
+
         if self.versioning_condition:
             # get old doctree
             try:
@@ -829,14 +1149,15 @@ class BuildEnvironment:
             # save the parsed doctree
             doctree_filename = self.doc2path(docname, self.doctreedir,
                                              '.doctree')
-            dirname = path.dirname(doctree_filename)
-            if not path.isdir(dirname):
-                os.makedirs(dirname)
+            ensuredir(path.dirname(doctree_filename))
+            data = pickle.dumps(doctree, pickle.HIGHEST_PROTOCOL)
             f = open(doctree_filename, 'wb')
             try:
-                pickle.dump(doctree, f, pickle.HIGHEST_PROTOCOL)
+                f.write(data)
             finally:
                 f.close()
+            # the writing phase will most likely need it again
+            self._doctree_cache[docname] = data
         else:
             return doctree
 
@@ -871,6 +1192,8 @@ class BuildEnvironment:
         self.reread_always.add(self.docname)
 
     def note_versionchange(self, type, version, node, lineno):
+        self.changed_versions.setdefault(self.temp_data['docname'],
+                                         set()).add(version)
         self.versionchanges.setdefault(version, []).append(
             (type, self.temp_data['docname'], lineno,
              self.temp_data.get('py:module'),
@@ -1184,18 +1507,64 @@ class BuildEnvironment:
             node['refuri'] = node['anchorname'] or '#'
         return toc
 
-    def get_toctree_for(self, docname, builder, collapse, **kwds):
+    def get_toctree_for(self, docname, builder, collapse, maxdepth=0,
+                        titles_only=False, includehidden=True):
         """Return the global TOC nodetree."""
-        doctree = self.get_doctree(self.config.master_doc)
+        # the entries of the master document's toctrees don't depend on the
+        # current document, so they are only collected once per builder
+        cached = self._global_toctrees.get((titles_only, includehidden))
+        if cached is None or cached[0] is not builder:
+            doctree = self.get_doctree(self.config.master_doc)
+            entries = []
+            for toctreenode in doctree.traverse(addnodes.toctree):
+                if toctreenode.get('hidden', False) and not includehidden:
+                    entries.append((toctreenode, None, None))
+                    continue
+                tocentries = self._get_toctree_entries(
+                    builder, toctreenode,
+                    titles_only or toctreenode.get('titlesonly', False),
+                    includehidden) or []
+                # docname -> ids of all nodes containing a reference to it
+                containing = {}
+                for tocentry in tocentries:
+                    for refnode in tocentry.traverse(nodes.reference):
+                        ids = containing.setdefault(refnode['refuri'], set())
+                        node = refnode
+                        while node is not None:
+                            ids.add(id(node))
+                            node = node.parent
+                entries.append((toctreenode, tocentries, containing))
+            cached = (builder, entries)
+            self._global_toctrees[titles_only, includehidden] = cached
+
+        def _copy_pruned(node, depth):
+            # copy the node, but leave out the sub-lists _finish_toctree()
+            # would remove anyway (mirrors the logic of its _walk_depth)
+            copy = node.copy()
+            for subnode in node.children:
+                if isinstance(subnode, nodes.bullet_list):
+                    if (depthlimit > 0 and depth > depthlimit) or \
+                           (collapse and depth > 1 and id(node) not in current):
+                        continue
+                    copy.append(_copy_pruned(subnode, depth+1))
+                elif isinstance(subnode, (addnodes.compact_paragraph,
+                                          nodes.list_item)):
+                    copy.append(_copy_pruned(subnode, depth))
+                else:
+                    copy.append(subnode.deepcopy())
+            return copy
+
         toctrees = []
-        if 'includehidden' not in kwds:
-            kwds['includehidden'] = True
-        if 'maxdepth' not in kwds:
-            kwds['maxdepth'] = 0
-        kwds['collapse'] = collapse
-        for toctreenode in doctree.traverse(addnodes.toctree):
-            toctree = self.resolve_toctree(docname, builder, toctreenode,
-                                           prune=True, **kwds)
+        for toctreenode, tocentries, containing in cached[1]:
+            if tocentries is None:
+                toctrees.append(None)
+                continue
+            depthlimit = maxdepth or toctreenode.get('maxdepth', -1)
+            current = containing.get(docname, ())
+            toctree = self._finish_toctree(
+                docname, builder, toctreenode,
+                [_copy_pruned(tocentry, 2) for tocentry in tocentries],
+                True, maxdepth, collapse)
             toctrees.append(toctree)
         if not toctrees:
             return None
@@ -1217,13 +1586,22 @@ class BuildEnvironment:
     # --------- RESOLVING REFERENCES AND TOCTREES ------------------------------
 
     def get_doctree(self, docname):
-        """Read the doctree for a file from the pickle and return it."""
-        doctree_filename = self.doc2path(docname, self.doctreedir, '.doctree')
-        f = open(doctree_filename, 'rb')
-        try:
-            doctree = pickle.load(f)
-        finally:
-            f.close()
+        """Read the doctree for a file from the pickle and return it.
+
+        Recently used doctrees are cached in memory; every call returns a new
+        copy that the caller may modify.
+        """
+        data = self._doctree_cache.get(docname)
+        if data is None:
+            doctree_filename = self.doc2path(docname, self.doctreedir,
+                                             '.doctree')
+            f = open(doctree_filename, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            self._doctree_cache[docname] = data
+        doctree = pickle.loads(data)
         doctree.settings.env = self
         doctree.reporter = Reporter(self.doc2path(docname), 2, 5,
                                     stream=WarningStream(self._warnfunc))
@@ -1268,65 +1646,18 @@ class BuildEnvironment:
         if toctree.get('hidden', False) and not includehidden:
             return None
 
-        def _walk_depth(node, depth, maxdepth):
-            """Utility: Cut a TOC at a specified depth."""
-
-            # For reading this function, it is useful to keep in mind the node
-            # structure of a toctree (using HTML-like node names for brevity):
-            #
-            # <ul>
-            #   <li>
-            #     <p><a></p>
-            #     <p><a></p>
-            #     ...
-            #     <ul>
-            #       ...
-            #     </ul>
-            #   </li>
-            # </ul>
-
-            for subnode in node.children[:]:
-                if isinstance(subnode, (addnodes.compact_paragraph,
-                                        nodes.list_item)):
-                    # for <p> and <li>, just indicate the depth level and
-                    # recurse to children
-                    subnode['classes'].append('toctree-l%d' % (depth-1))
-                    _walk_depth(subnode, depth, maxdepth)
-
-                elif isinstance(subnode, nodes.bullet_list):
-                    # for <ul>, determine if the depth is too large or if the
-                    # entry is to be collapsed
-                    if maxdepth > 0 and depth > maxdepth:
-                        subnode.parent.replace(subnode, [])
-                    else:
-                        # to find out what to collapse, *first* walk subitems,
-                        # since that determines which children point to the
-                        # current page
-                        _walk_depth(subnode, depth+1, maxdepth)
-                        # cull sub-entries whose parents aren't 'current'
-                        if (collapse and depth > 1 and
-                            'iscurrent' not in subnode.parent):
-                            subnode.parent.remove(subnode)
-
-                elif isinstance(subnode, nodes.reference):
-                    # for <a>, identify which entries point to the current
-                    # document and therefore may not be collapsed
-                    if subnode['refuri'] == docname:
-                        if not subnode['anchorname']:
-                            # give the whole branch a 'current' class
-                            # (useful for styling it differently)
-                            branchnode = subnode
-                            while branchnode:
-                                branchnode['classes'].append('current')
-                                branchnode = branchnode.parent
-                        # mark the list_item as "on current page"
-                        if subnode.parent.parent.get('iscurrent'):
-                            # but only if it's not already done
-                            return
-                        while subnode:
-                            subnode['iscurrent'] = True
-                            subnode = subnode.parent
-
+        if not titles_only and toctree.get('titlesonly', False):
+            titles_only = True
+        tocentries = self._get_toctree_entries(builder, toctree, titles_only,
+                                               includehidden)
+        return self._finish_toctree(docname, builder, toctree, tocentries,
+                                    prune, maxdepth, collapse)
+
+    def _get_toctree_entries(self, builder, toctree, titles_only,
+                             includehidden):
+        """Collect the TOC entries for a *toctree* node, with all sub-toctrees
+        resolved.  The result does not depend on the current document.
+        """
         def _entries_from_toctree(toctreenode, parents,
                                   separate=False, subtree=False):
             """Return TOC entries for a toctree node."""
@@ -1414,17 +1745,80 @@ class BuildEnvironment:
                 return [ret]
             return entries
 
-        maxdepth = maxdepth or toctree.get('maxdepth', -1)
-        if not titles_only and toctree.get('titlesonly', False):
-            titles_only = True
-
         # NOTE: previously, this was separate=True, but that leads to artificial
         # separation when two or more toctree entries form a logical unit, so
         # separating mode is no longer used -- it's kept here for history's sake
-        tocentries = _entries_from_toctree(toctree, [], separate=False)
+        return _entries_from_toctree(toctree, [], separate=False)
+
+    def _finish_toctree(self, docname, builder, toctree, tocentries, prune,
+                        maxdepth, collapse):
+        """Create the toctree for the current document *docname* from the
+        *tocentries* (which are put into the result, not copied): prune and
+        collapse it, mark the current entries and set the target paths.
+        """
         if not tocentries:
             return None
 
+        def _walk_depth(node, depth, maxdepth):
+            """Utility: Cut a TOC at a specified depth."""
+
+            # For reading this function, it is useful to keep in mind the node
+            # structure of a toctree (using HTML-like node names for brevity):
+            #
+            # <ul>
+            #   <li>
+            #     <p><a></p>
+            #     <p><a></p>
+            #     ...
+            #     <ul>
+            #       ...
+            #     </ul>
+            #   </li>
+            # </ul>
+
+            for subnode in node.children[:]:
+                if isinstance(subnode, (addnodes.compact_paragraph,
+                                        nodes.list_item)):
+                    # for <p> and <li>, just indicate the depth level and
+                    # recurse to children
+                    subnode['classes'].append('toctree-l%d' % (depth-1))
+                    _walk_depth(subnode, depth, maxdepth)
+
+                elif isinstance(subnode, nodes.bullet_list):
+                    # for <ul>, determine if the depth is too large or if the
+                    # entry is to be collapsed
+                    if maxdepth > 0 and depth > maxdepth:
+                        subnode.parent.replace(subnode, [])
+                    else:
+                        # to find out what to collapse, *first* walk subitems,
+                        # since that determines which children point to the
+                        # current page
+                        _walk_depth(subnode, depth+1, maxdepth)
+                        # cull sub-entries whose parents aren't 'current'
+                        if (collapse and depth > 1 and
+                            'iscurrent' not in subnode.parent):
+                            subnode.parent.remove(subnode)
+
+                elif isinstance(subnode, nodes.reference):
+                    # for <a>, identify which entries point to the current
+                    # document and therefore may not be collapsed
+                    if subnode['refuri'] == docname:
+                        if not subnode['anchorname']:
+                            # give the whole branch a 'current' class
+                            # (useful for styling it differently)
+                            branchnode = subnode
+                            while branchnode:
+                                branchnode['classes'].append('current')
+                                branchnode = branchnode.parent
+                        # mark the list_item as "on current page"
+                        if subnode.parent.parent.get('iscurrent'):
+                            # but only if it's not already done
+                            return
+                        while subnode:
+                            subnode['iscurrent'] = True
+                            subnode = subnode.parent
+
+        maxdepth = maxdepth or toctree.get('maxdepth', -1)
         newnode = addnodes.compact_paragraph('', '', *tocentries)
         newnode['toctree'] = True
 
@@ -1542,6 +1936,8 @@ class BuildEnvironment:
         """Assign a section number to each heading under a numbered toctree."""
         # a list of all docnames whose section numbers changed
         rewrite_needed = []
+        # the section numbers are stored in the TOC nodes
+        self._global_toctrees.clear()
 
         old_secnumbers = self.toc_secnumbers
         self.toc_secnumbers = {}
@@ -62,3 +62,16 @@ class PycodeError(Exception):
         if len(self.args) > 1:
             res += ' (exception was: %r)' % self.args[1]
         return res
+
+
+class SphinxParallelError(SphinxError):
+    """Raised if an exception occurred in a parallel worker process."""
+    category = 'Sphinx parallel build error'
+
+    def __init__(self, orig_exc, traceback):
+        SphinxError.__init__(self, str(orig_exc))
+        self.orig_exc = orig_exc
+        self.traceback = traceback
+
+    def __str__(self):
+        return self.traceback.rstrip() or SphinxError.__str__(self)
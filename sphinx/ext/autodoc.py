@@ -1364,6 +1364,7 @@ def setup(app):
     app.add_event('autodoc-process-docstring')
     app.add_event('autodoc-process-signature')
     app.add_event('autodoc-skip-member')
+    return {'parallel_read_safe': True}
 
 
 class testcls:
@@ -27,6 +27,7 @@ from sphinx.util import force_decode
 from sphinx.util.nodes import set_source_info
 from sphinx.util.compat import Directive
 from sphinx.util.console import bold
+from sphinx.util.parallel import ParallelTasks, make_chunks
 from sphinx.util.pycompat import bytes
 
 blankline_re = re.compile(r'^\s*<BLANKLINE>', re.MULTILINE)
@@ -185,6 +186,16 @@ class SphinxDocTestRunner(doctest.DocTestRunner):
         return self.save_linecache_getlines(filename, module_globals)
 
 
+class OutputCollector(object):
+    """
+    Collects the texts written to it, e.g. the output of a worker process.
+    """
+
+    def __init__(self):
+        self.texts = []
+        self.write = self.texts.append
+
+
 # the new builder -- use sphinx-build.py -b doctest to run
 
 class DocTestBuilder(Builder):
@@ -192,6 +203,8 @@ class DocTestBuilder(Builder):
     Runs test snippets in the documentation.
     """
     name = 'doctest'
+    # documents are tested in parallel worker processes with -j
+    allow_parallel = True
 
     def init(self):
         # default options
@@ -263,15 +276,77 @@ Doctest summary
         if self.total_failures or self.setup_failures or self.cleanup_failures:
             self.app.statuscode = 1
 
+    def get_counts(self):
+        return (self.total_failures, self.total_tries,
+                self.setup_failures, self.setup_tries,
+                self.cleanup_failures, self.cleanup_tries)
+
+    def has_failures(self):
+        return bool(self.total_failures or self.setup_failures or
+                    self.cleanup_failures)
+
     def write(self, build_docnames, updated_docnames, method='update'):
         if build_docnames is None:
             build_docnames = sorted(self.env.all_docs)
 
         self.info(bold('running tests...'))
-        for docname in build_docnames:
+        self.stopped = False
+        if self.parallel_ok and len(build_docnames) > 5:
+            self._test_parallel(build_docnames, self.app.parallel)
+        else:
+            self._test_serial(build_docnames)
+        if self.stopped:
+            self.info(bold('stopped after the first failure'))
+
+    def _test_serial(self, docnames):
+        for docname in docnames:
             # no need to resolve the doctree
             doctree = self.env.get_doctree(docname)
             self.test_doc(docname, doctree)
+            if self.config.doctest_fail_fast and self.has_failures():
+                self.stopped = True
+                return
+
+    def _test_parallel(self, docnames, nproc):
+        """Test *docnames* in up to *nproc* worker processes.  Their output
+        is written, and their results are counted, in the order of the
+        documents, so that it is the same as when testing serially.
+        """
+        def test_process(docs):
+            warnings = []
+            self.warn = lambda *args: warnings.append(args)
+            self.env.set_warnfunc(self.warn)
+            self.info = lambda *args, **kwds: None
+            self.outfile = OutputCollector()
+            self.total_failures = self.total_tries = 0
+            self.setup_failures = self.setup_tries = 0
+            self.cleanup_failures = self.cleanup_tries = 0
+            self._test_serial(docs)
+            return self.outfile.texts, warnings, self.get_counts(), \
+                   self.stopped
+
+        def merge(result):
+            if self.stopped:
+                # a previous document failed
+                return
+            texts, warnings, counts, stopped = result
+            for text in texts:
+                self.info(text, nonl=True)
+                self.outfile.write(text)
+            for warning in warnings:
+                self.warn(*warning)
+            (self.total_failures, self.total_tries,
+             self.setup_failures, self.setup_tries,
+             self.cleanup_failures, self.cleanup_tries) = \
+                [old + new for (old, new) in zip(self.get_counts(), counts)]
+            self.stopped = stopped
+
+        tasks = ParallelTasks(nproc)
+        for chunk in make_chunks(docnames, nproc):
+            if self.stopped:
+                break
+            tasks.add_task(test_process, chunk, merge)
+        tasks.join()
 
     def test_doc(self, docname, doctree):
         groups = {}
@@ -435,3 +510,5 @@ def setup(app):
     app.add_config_value('doctest_test_doctest_blocks', 'default', False)
     app.add_config_value('doctest_global_setup', '', False)
     app.add_config_value('doctest_global_cleanup', '', False)
+    app.add_config_value('doctest_fail_fast', False, False)
+    return {'parallel_read_safe': True}
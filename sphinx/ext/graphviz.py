@@ -10,6 +10,7 @@
     :license: BSD, see LICENSE for details.
 """
 
+import os
 import re
 import codecs
 import posixpath
@@ -28,6 +29,8 @@ from sphinx.errors import SphinxError
 from sphinx.locale import _
 from sphinx.util.osutil import ensuredir, ENOENT, EPIPE, EINVAL
 from sphinx.util.compat import Directive
+from sphinx.util.rendercache import get_render_cache, get_render_tasks, \
+     wait_for_render, tool_version, track_node_documents, get_node_doctrees
 
 
 mapname_re = re.compile(r'<map id="(.*?)"')
@@ -119,29 +122,40 @@ class GraphvizSimple(Directive):
         return [node]
 
 
-def render_dot(self, code, options, format, prefix='graphviz'):
-    """Render graphviz code into a PNG or PDF output file."""
-    hashkey = (code + str(options) + \
-              str(self.builder.config.graphviz_dot) + \
-              str(self.builder.config.graphviz_dot_args)
-              ).encode('utf-8')
+def get_hashkey(builder, code, options):
+    return (code + str(options) + \
+            str(builder.config.graphviz_dot) + \
+            str(builder.config.graphviz_dot_args)
+            ).encode('utf-8')
 
-    fname = '%s-%s.%s' % (prefix, sha(hashkey).hexdigest(), format)
-    if hasattr(self.builder, 'imgpath'):
-        # HTML
-        relfn = posixpath.join(self.builder.imgpath, fname)
-        outfn = path.join(self.builder.outdir, '_images', fname)
-    else:
-        # LaTeX
-        relfn = fname
-        outfn = path.join(self.builder.outdir, fname)
 
+def get_filename(builder, code, options, format, prefix):
+    hashkey = get_hashkey(builder, code, options)
+    return '%s-%s.%s' % (prefix, sha(hashkey).hexdigest(), format)
+
+
+def run_dot(builder, code, options, format, outfn):
+    """Render graphviz code into *outfn*, unless it exists.  Return false if
+    dot cannot be run.
+    """
     if path.isfile(outfn):
-        return relfn, outfn
+        return True
 
-    if hasattr(self.builder, '_graphviz_warned_dot') or \
-       hasattr(self.builder, '_graphviz_warned_ps2pdf'):
-        return None, None
+    # the files written by dot
+    outfns = [outfn]
+    if format == 'png':
+        outfns.append(outfn + '.map')
+    cache = get_render_cache(builder)
+    if cache is not None:
+        key = cache.key('graphviz', get_hashkey(builder, code, options),
+                        format,
+                        tool_version([builder.config.graphviz_dot, '-V']))
+        if cache.fetch(key, outfns):
+            return True
+
+    if hasattr(builder, '_graphviz_warned_dot') or \
+       hasattr(builder, '_graphviz_warned_ps2pdf'):
+        return False
 
     ensuredir(path.dirname(outfn))
 
@@ -149,8 +163,8 @@ def render_dot(self, code, options, format, prefix='graphviz'):
     if isinstance(code, unicode):
         code = code.encode('utf-8')
 
-    dot_args = [self.builder.config.graphviz_dot]
-    dot_args.extend(self.builder.config.graphviz_dot_args)
+    dot_args = [builder.config.graphviz_dot]
+    dot_args.extend(builder.config.graphviz_dot_args)
     dot_args.extend(options)
     dot_args.extend(['-T' + format, '-o' + outfn])
     if format == 'png':
@@ -160,11 +174,11 @@ def render_dot(self, code, options, format, prefix='graphviz'):
     except OSError, err:
         if err.errno != ENOENT:   # No such file or directory
             raise
-        self.builder.warn('dot command %r cannot be run (needed for graphviz '
-                          'output), check the graphviz_dot setting' %
-                          self.builder.config.graphviz_dot)
-        self.builder._graphviz_warned_dot = True
-        return None, None
+        builder.warn('dot command %r cannot be run (needed for graphviz '
+                     'output), check the graphviz_dot setting' %
+                     builder.config.graphviz_dot)
+        builder._graphviz_warned_dot = True
+        return False
     wentWrong = False
     try:
         # Graphviz may close standard input when an error occurs,
@@ -186,9 +200,58 @@ def render_dot(self, code, options, format, prefix='graphviz'):
     if p.returncode != 0:
         raise GraphvizError('dot exited with error:\n[stderr]\n%s\n'
                             '[stdout]\n%s' % (stderr, stdout))
+    if cache is not None:
+        cache.store(key, outfns)
+    return True
+
+
+def render_dot(self, code, options, format, prefix='graphviz'):
+    """Render graphviz code into a PNG or PDF output file."""
+    fname = get_filename(self.builder, code, options, format, prefix)
+    if hasattr(self.builder, 'imgpath'):
+        # HTML
+        relfn = posixpath.join(self.builder.imgpath, fname)
+        outfn = path.join(self.builder.outdir, '_images', fname)
+    else:
+        # LaTeX
+        relfn = fname
+        outfn = path.join(self.builder.outdir, fname)
+
+    # the file may be rendered in the background already
+    wait_for_render(self.builder, outfn)
+    if not run_dot(self.builder, code, options, format, outfn):
+        return None, None
     return relfn, outfn
 
 
+def prerender_dot(builder, code, options, format, outfn):
+    try:
+        run_dot(builder, code, options, format, outfn)
+    except GraphvizError:
+        # remove partial output; render_dot() will report the error
+        for fn in (outfn, outfn + '.map'):
+            if path.exists(fn):
+                os.unlink(fn)
+
+
+def schedule_dot_html(builder, code, options, prefix='graphviz'):
+    """Start rendering graphviz code for HTML output in the background, if
+    enabled; render_dot_html() then waits for the result.
+    """
+    format = builder.config.graphviz_output_format
+    tasks = get_render_tasks(builder)
+    if tasks is None or format not in ('png', 'svg'):
+        return
+    # if dot is missing, leave it to render_dot() to warn once
+    if not tool_version([builder.config.graphviz_dot, '-V']):
+        return
+    fname = get_filename(builder, code, options, format, prefix)
+    outfn = path.join(builder.outdir, '_images', fname)
+    if not path.isfile(outfn):
+        tasks.add_task(outfn, prerender_dot, builder, code, options,
+                       format, outfn)
+
+
 def render_dot_html(self, node, code, options, prefix='graphviz',
                     imgcls=None, alt=None):
     format = self.builder.config.graphviz_output_format
@@ -245,6 +308,14 @@ def html_visit_graphviz(self, node):
     render_dot_html(self, node, node['code'], node['options'])
 
 
+def schedule_graphviz(app, docnames):
+    if app.builder.format != 'html':
+        return
+    for doctree in get_node_doctrees(app.env, 'graphviz_docs', docnames):
+        for node in doctree.traverse(graphviz):
+            schedule_dot_html(app.builder, node['code'], node['options'])
+
+
 def render_dot_latex(self, node, code, options, prefix='graphviz'):
     try:
         fname, outfn = render_dot(self, code, options, 'pdf', prefix)
@@ -326,3 +397,6 @@ def setup(app):
     app.add_config_value('graphviz_dot', 'dot', 'html')
     app.add_config_value('graphviz_dot_args', [], 'html')
     app.add_config_value('graphviz_output_format', 'png', 'html')
+    track_node_documents(app, 'graphviz_docs', graphviz)
+    app.connect('write-started', schedule_graphviz)
+    return {'parallel_read_safe': True}
@@ -48,9 +48,12 @@ except ImportError:
 from docutils import nodes
 from docutils.parsers.rst import directives
 
+from sphinx import addnodes
+from sphinx.environment import NoUri
 from sphinx.ext.graphviz import render_dot_html, render_dot_latex, \
-    render_dot_texinfo
+    render_dot_texinfo, schedule_dot_html
 from sphinx.util.compat import Directive
+from sphinx.util.rendercache import track_node_documents
 
 
 class_sig_re = re.compile(r'''^([\w.]*\.)?    # module names
@@ -322,10 +325,27 @@ def get_graph_hash(node):
     return md5(encoded).hexdigest()[-10:]
 
 
-def html_visit_inheritance_diagram(self, node):
+def resolve_class_ref(builder, docname, node):
+    """Resolve the pending class reference *node* of the document *docname*
+    like the environment does, and return the new node or None.
     """
-    Output the graph for HTML.  This will insert a PNG with clickable
-    image map.
+    env = builder.env
+    contnode = node[0].deepcopy()
+    try:
+        newnode = env.domains['py'].resolve_xref(
+            env, docname, builder, node['reftype'], node['reftarget'], node,
+            contnode)
+        if newnode is None:
+            newnode = builder.app.emit_firstresult(
+                'missing-reference', env, node, contnode)
+    except NoUri:
+        newnode = None
+    return newnode
+
+
+def get_html_dotcode(builder, node, docname=None):
+    """Return the dot code of the diagram *node* for HTML.  If *docname* is
+    given, *node* is from the unresolved doctree of that document.
     """
     graph = node['graph']
 
@@ -335,12 +355,24 @@ def html_visit_inheritance_diagram(self, node):
     # Create a mapping from fully-qualified class names to URLs.
     urls = {}
     for child in node:
+        if docname is not None and isinstance(child, addnodes.pending_xref):
+            child = resolve_class_ref(builder, docname, child)
+            if child is None:
+                continue
         if child.get('refuri') is not None:
             urls[child['reftitle']] = child.get('refuri')
         elif child.get('refid') is not None:
             urls[child['reftitle']] = '#' + child.get('refid')
 
-    dotcode = graph.generate_dot(name, urls, env=self.builder.env)
+    return graph.generate_dot(name, urls, env=builder.env)
+
+
+def html_visit_inheritance_diagram(self, node):
+    """
+    Output the graph for HTML.  This will insert a PNG with clickable
+    image map.
+    """
+    dotcode = get_html_dotcode(self.builder, node)
     render_dot_html(self, node, dotcode, [], 'inheritance', 'inheritance',
                     alt='Inheritance diagram of ' + node['content'])
     raise nodes.SkipNode
@@ -380,6 +412,18 @@ def skip(self, node):
     raise nodes.SkipNode
 
 
+def schedule_inheritance_diagrams(app, docnames):
+    if app.builder.format != 'html':
+        return
+    docs = getattr(app.env, 'inheritance_docs', set()).intersection(docnames)
+    for docname in sorted(docs):
+        doctree = app.env.get_doctree(docname)
+        for node in doctree.traverse(inheritance_diagram):
+            # the dot code contains the links to the classes
+            dotcode = get_html_dotcode(app.builder, node, docname)
+            schedule_dot_html(app.builder, dotcode, [], 'inheritance')
+
+
 def setup(app):
     app.setup_extension('sphinx.ext.graphviz')
     app.add_node(
@@ -390,6 +434,9 @@ def setup(app):
         man=(skip, None),
         texinfo=(texinfo_visit_inheritance_diagram, None))
     app.add_directive('inheritance-diagram', InheritanceDiagram)
+    track_node_documents(app, 'inheritance_docs', inheritance_diagram)
+    app.connect('write-started', schedule_inheritance_diagrams)
     app.add_config_value('inheritance_graph_attrs', {}, False),
     app.add_config_value('inheritance_node_attrs', {}, False),
     app.add_config_value('inheritance_edge_attrs', {}, False),
+    return {'parallel_read_safe': True}
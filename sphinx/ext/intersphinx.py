@@ -24,19 +24,28 @@
     :license: BSD, see LICENSE for details.
 """
 
+import re
+import sys
 import time
 import zlib
 import codecs
 import urllib2
 import posixpath
+import threading
+import cPickle as pickle
 from os import path
-import re
+try:
+    from hashlib import md5
+except ImportError:
+    # 2.4 compatibility
+    from md5 import md5
 
 from docutils import nodes
 
 from sphinx.locale import _
 from sphinx.builders.html import INVENTORY_FILENAME
-from sphinx.util.pycompat import b
+from sphinx.util.osutil import ensuredir, movefile
+from sphinx.util.pycompat import b, BytesIO
 
 
 handlers = [urllib2.ProxyHandler(), urllib2.HTTPRedirectHandler(),
@@ -50,6 +59,11 @@ urllib2.install_opener(urllib2.build_opener(*handlers))
 
 UTF8StreamReader = codecs.lookup('utf-8')[2]
 
+# version of the parsed inventories stored in the cache directory
+CACHE_VERSION = 1
+# remote inventories fetched at the same time
+FETCH_THREADS = 10
+
 
 def read_inventory_v1(f, uri, join):
     f = UTF8StreamReader(f)
@@ -114,12 +128,28 @@ def read_inventory_v2(f, uri, join, bufsize=16*1024):
     return invdata
 
 
-def fetch_inventory(app, uri, inv):
-    """Fetch, parse and return an intersphinx inventory file."""
-    # both *uri* (base URI of the links to generate) and *inv* (actual
-    # location of the inventory file) can be local or remote URIs
+def read_inventory(f, uri):
+    """Parse an inventory file of any version from the file-like object *f*;
+    the locations are made relative to *uri*.
+    """
+    # *uri* (base URI of the links to generate) can be local or remote
     localuri = uri.find('://') == -1
     join = localuri and path.join or posixpath.join
+    line = f.readline().rstrip().decode('utf-8')
+    try:
+        if line == '# Sphinx inventory version 1':
+            return read_inventory_v1(f, uri, join)
+        elif line == '# Sphinx inventory version 2':
+            return read_inventory_v2(f, uri, join)
+        raise ValueError
+    except ValueError:
+        raise ValueError('unknown or unsupported inventory version')
+
+
+def fetch_inventory(app, uri, inv):
+    """Fetch, parse and return an intersphinx inventory file."""
+    # *inv* (actual location of the inventory file) can be a local or
+    # remote URI
     try:
         if inv.find('://') != -1:
             f = urllib2.urlopen(inv)
@@ -130,18 +160,10 @@ def fetch_inventory(app, uri, inv):
                  '%s: %s' % (inv, err.__class__, err))
         return
     try:
-        line = f.readline().rstrip().decode('utf-8')
         try:
-            if line == '# Sphinx inventory version 1':
-                invdata = read_inventory_v1(f, uri, join)
-            elif line == '# Sphinx inventory version 2':
-                invdata = read_inventory_v2(f, uri, join)
-            else:
-                raise ValueError
-            f.close()
-        except ValueError:
+            invdata = read_inventory(f, uri)
+        finally:
             f.close()
-            raise ValueError('unknown or unsupported inventory version')
     except Exception, err:
         app.warn('intersphinx inventory %r not readable due to '
                  '%s: %s' % (inv, err.__class__.__name__, err))
@@ -149,17 +171,258 @@ def fetch_inventory(app, uri, inv):
         return invdata
 
 
+def fetch_remote_inventory(uri, inv, meta, timeout):
+    """Fetch and parse the remote inventory *inv*, unless it was not modified
+    since it was fetched with the cache metadata *meta*.
+
+    Return a tuple ``(raw, invdata, meta)``; *raw* and *invdata* are None if
+    the inventory was not modified.  Errors are raised as exceptions whose
+    message says whether the inventory wasn't fetchable or readable.
+    """
+    request = urllib2.Request(inv)
+    if meta is not None:
+        if meta.get('etag'):
+            request.add_header('If-None-Match', meta['etag'])
+        if meta.get('last-modified'):
+            request.add_header('If-Modified-Since', meta['last-modified'])
+    kwargs = {}
+    if sys.version_info >= (2, 6) and timeout:
+        kwargs['timeout'] = timeout
+    try:
+        f = urllib2.urlopen(request, **kwargs)
+        try:
+            raw = f.read()
+            headers = f.info()
+        finally:
+            f.close()
+    except urllib2.HTTPError, err:
+        if err.code == 304 and meta is not None:
+            return None, None, meta
+        raise Exception('intersphinx inventory %r not fetchable due to '
+                        '%s: %s' % (inv, err.__class__, err))
+    except Exception, err:
+        raise Exception('intersphinx inventory %r not fetchable due to '
+                        '%s: %s' % (inv, err.__class__, err))
+    try:
+        invdata = read_inventory(BytesIO(raw), uri)
+    except Exception, err:
+        raise Exception('intersphinx inventory %r not readable due to '
+                        '%s: %s' % (inv, err.__class__.__name__, err))
+    meta = {'etag': headers.get('etag'),
+            'last-modified': headers.get('last-modified')}
+    return raw, invdata, meta
+
+
+class InventoryCache(object):
+    """
+    The remote inventories fetched by earlier builds, kept in a directory
+    outside of the environment.  For each inventory, the raw file and a
+    pickle of the parsed data and the metadata (time of the fetch and
+    validators for conditional requests) are stored.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def filename(self, uri, inv):
+        key = md5(('%s\0%s' % (uri, inv)).encode('utf-8')).hexdigest()
+        return path.join(self.dirname, key)
+
+    def load(self, uri, inv):
+        """Return a tuple ``(meta, invdata)`` for the inventory, or None."""
+        filename = self.filename(uri, inv)
+        try:
+            f = open(filename + '.pickle', 'rb')
+            try:
+                version, meta, invdata = pickle.load(f)
+            finally:
+                f.close()
+            if version != CACHE_VERSION:
+                # parsed with an incompatible version; parse again
+                f = open(filename + '.inv', 'rb')
+                try:
+                    invdata = read_inventory(f, uri)
+                finally:
+                    f.close()
+                self.save(uri, inv, meta, invdata)
+        except Exception:
+            return None
+        return meta, invdata
+
+    def save(self, uri, inv, meta, invdata, raw=None):
+        filename = self.filename(uri, inv)
+        try:
+            ensuredir(self.dirname)
+            if raw is not None:
+                self._write(filename + '.inv', raw)
+            self._write(filename + '.pickle', pickle.dumps(
+                (CACHE_VERSION, meta, invdata), pickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError):
+            # the cache is only an optimization
+            pass
+
+    def _write(self, filename, data):
+        f = open(filename + '.tmp', 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        movefile(filename + '.tmp', filename)
+
+
+class Inventory(object):
+    """
+    The objects of one or more intersphinx inventories, indexed by name.
+
+    For every name, a bit mask of the object types it is known as is stored
+    together with its entries, so that resolving a reference takes a single
+    dictionary lookup.  The entries share the project name and version of
+    their inventory.  The store is rebuilt from the inventory cache by every
+    build, and is therefore not pickled with the environment.
+
+    *typebits* maps object types to their bits in the masks; inventories
+    sharing it also share their entries in :meth:`update`.
+
+    For compatibility, an inventory can also be read like the dictionary of
+    the environment's ``intersphinx_inventory`` was before: it maps object
+    types to dictionaries of names to ``(project, version, location,
+    dispname)`` tuples.  These are only built when they are asked for.
+    """
+
+    def __init__(self, typebits=None):
+        if typebits is None:
+            typebits = {}
+        self.typebits = typebits
+        # name -> (type mask, ((type bit, (project, version),
+        #                       location, dispname), ...))
+        self.objects = {}
+        # object type -> {name: entry}, for the dictionary interface
+        self._bytype = None
+
+    def __reduce__(self):
+        # pickle (e.g. with the environment) as an empty inventory
+        return (self.__class__, ())
+
+    def _typebit(self, type):
+        bit = self.typebits.get(type)
+        if bit is None:
+            bit = self.typebits[type] = 1 << len(self.typebits)
+        return bit
+
+    def _insert(self, name, entry):
+        self._bytype = None
+        bit = entry[0]
+        old = self.objects.get(name)
+        if old is None:
+            self.objects[name] = (bit, (entry,))
+        elif old[0] & bit:
+            # shadow the entry of the same type
+            self.objects[name] = (old[0], tuple([oldentry[0] == bit and entry
+                                                 or oldentry
+                                                 for oldentry in old[1]]))
+        else:
+            self.objects[name] = (old[0] | bit, old[1] + (entry,))
+
+    def add(self, invdata):
+        """Add the entries of the parsed inventory *invdata*; they shadow
+        the entries of the same name and type added before.
+        """
+        projects = {}
+        for type, objects in invdata.iteritems():
+            bit = self._typebit(type)
+            for name, (proj, version, location, dispname) in \
+                    objects.iteritems():
+                project = projects.setdefault((proj, version), (proj, version))
+                self._insert(name, (bit, project, location, dispname))
+
+    def update(self, other):
+        """Add the entries of the inventory *other*, sharing them if both
+        have the same type bits.
+        """
+        if other.typebits is not self.typebits:
+            self.add(other._by_type())
+            return
+        for name, (mask, entries) in other.objects.iteritems():
+            for entry in entries:
+                self._insert(name, entry)
+
+    def lookup(self, name, types):
+        """Return the entry ``(project, version, location, dispname)`` of the
+        object *name* for the first of the object *types* it is known as, or
+        None if there is none.
+        """
+        found = self.objects.get(name)
+        if found is None:
+            return None
+        mask, entries = found
+        for type in types:
+            bit = self.typebits.get(type, 0)
+            if mask & bit:
+                for entry in entries:
+                    if entry[0] == bit:
+                        return entry[1] + entry[2:]
+        return None
+
+    # the dictionary interface
+
+    def _by_type(self):
+        if self._bytype is None:
+            types = dict([(bit, type) for (type, bit)
+                          in self.typebits.iteritems()])
+            bytype = {}
+            for name, (mask, entries) in self.objects.iteritems():
+                for entry in entries:
+                    bytype.setdefault(types[entry[0]], {})[name] = \
+                        entry[1] + entry[2:]
+            self._bytype = bytype
+        return self._bytype
+
+    def __getitem__(self, type):
+        return self._by_type()[type]
+
+    def __contains__(self, type):
+        return type in self._by_type()
+
+    def __iter__(self):
+        return iter(self._by_type())
+
+    def __len__(self):
+        return len(self._by_type())
+
+    def get(self, type, default=None):
+        return self._by_type().get(type, default)
+
+    def keys(self):
+        return self._by_type().keys()
+
+    def values(self):
+        return self._by_type().values()
+
+    def items(self):
+        return self._by_type().items()
+
+    def iterkeys(self):
+        return self._by_type().iterkeys()
+
+    def itervalues(self):
+        return self._by_type().itervalues()
+
+    def iteritems(self):
+        return self._by_type().iteritems()
+
+
 def load_mappings(app):
     """Load all intersphinx mappings into the environment."""
     now = int(time.time())
-    cache_time = now - app.config.intersphinx_cache_limit * 86400
+    cache_limit = app.config.intersphinx_cache_limit
+    cache_time = now - cache_limit * 86400
     env = app.builder.env
-    if not hasattr(env, 'intersphinx_cache'):
-        env.intersphinx_cache = {}
-        env.intersphinx_inventory = {}
-        env.intersphinx_named_inventory = {}
-    cache = env.intersphinx_cache
-    update = False
+    # the inventories used to be cached in the environment
+    env.__dict__.pop('intersphinx_cache', None)
+    cache = InventoryCache(path.join(app.doctreedir, 'intersphinx'))
+    # uri -> (name, invdata)
+    loaded = {}
+    to_fetch = []
     for key, value in app.config.intersphinx_mapping.iteritems():
         if isinstance(value, tuple):
             # new format
@@ -169,41 +432,86 @@ def load_mappings(app):
         else:
             # old format, no name
             name, uri, inv = None, key, value
-        # we can safely assume that the uri<->inv mapping is not changed
-        # during partial rebuilds since a changed intersphinx_mapping
-        # setting will cause a full environment reread
         if not inv:
             inv = posixpath.join(uri, INVENTORY_FILENAME)
         # decide whether the inventory must be read: always read local
         # files; remote ones only if the cache time is expired
-        if '://' not in inv or uri not in cache \
-               or cache[uri][1] < cache_time:
+        if '://' not in inv:
             app.info('loading intersphinx inventory from %s...' % inv)
             invdata = fetch_inventory(app, uri, inv)
             if invdata:
-                cache[uri] = (name, now, invdata)
-            else:
-                cache.pop(uri, None)
-            update = True
-    if update:
-        env.intersphinx_inventory = {}
-        env.intersphinx_named_inventory = {}
-        # Duplicate values in different inventories will shadow each
-        # other; which one will override which can vary between builds
-        # since they are specified using an unordered dict.  To make
-        # it more consistent, we sort the named inventories and then
-        # add the unnamed inventories last.  This means that the
-        # unnamed inventories will shadow the named ones but the named
-        # ones can still be accessed when the name is specified.
-        cached_vals = list(cache.itervalues())
-        named_vals = sorted(v for v in cached_vals if v[0])
-        unnamed_vals = [v for v in cached_vals if not v[0]]
-        for name, _, invdata in named_vals + unnamed_vals:
-            if name:
-                env.intersphinx_named_inventory[name] = invdata
-            for type, objects in invdata.iteritems():
-                env.intersphinx_inventory.setdefault(
-                    type, {}).update(objects)
+                loaded[uri] = (name, invdata)
+            continue
+        cached = cache.load(uri, inv)
+        if cached is not None and (cache_limit < 0 or
+                                   cached[0]['time'] >= cache_time):
+            loaded[uri] = (name, cached[1])
+        else:
+            to_fetch.append((name, uri, inv, cached))
+
+    # fetch the expired remote inventories concurrently
+    results = {}
+    def fetch_thread():
+        while to_fetch_queue:
+            try:
+                name, uri, inv, cached = to_fetch_queue.pop()
+            except IndexError:
+                break
+            try:
+                results[uri] = fetch_remote_inventory(
+                    uri, inv, cached and cached[0],
+                    app.config.intersphinx_timeout)
+            except Exception, err:
+                results[uri] = err
+    for name, uri, inv, cached in to_fetch:
+        app.info('loading intersphinx inventory from %s...' % inv)
+    to_fetch_queue = to_fetch[::-1]
+    threads = []
+    for i in range(min(FETCH_THREADS, len(to_fetch))):
+        thread = threading.Thread(target=fetch_thread)
+        thread.setDaemon(True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+
+    for name, uri, inv, cached in to_fetch:
+        result = results[uri]
+        if isinstance(result, Exception):
+            app.warn(str(result))
+            if cached is not None:
+                # better use outdated data than none at all
+                loaded[uri] = (name, cached[1])
+            continue
+        raw, invdata, meta = result
+        meta = dict(meta, time=now)
+        if invdata is None:
+            # not modified
+            invdata = cached[1]
+        cache.save(uri, inv, meta, invdata, raw)
+        loaded[uri] = (name, invdata)
+
+    # the merged and named inventories share their type bits and entries
+    inventory = env.intersphinx_inventory = Inventory()
+    env.intersphinx_named_inventory = {}
+    # Duplicate values in different inventories will shadow each
+    # other; which one will override which can vary between builds
+    # since they are specified using an unordered dict.  To make
+    # it more consistent, we sort the named inventories and then
+    # add the unnamed inventories last.  This means that the
+    # unnamed inventories will shadow the named ones but the named
+    # ones can still be accessed when the name is specified.
+    loaded_vals = list(loaded.itervalues())
+    named_vals = sorted(v for v in loaded_vals if v[0])
+    unnamed_vals = [v for v in loaded_vals if not v[0]]
+    for name, invdata in named_vals + unnamed_vals:
+        if name:
+            named = env.intersphinx_named_inventory[name] = \
+                Inventory(inventory.typebits)
+            named.add(invdata)
+            inventory.update(named)
+        else:
+            inventory.add(invdata)
 
 
 def missing_reference(app, env, node, contnode):
@@ -226,28 +534,28 @@ def missing_reference(app, env, node, contnode):
             in_set = setname
             to_try.append((env.intersphinx_named_inventory[setname], newtarget))
     for inventory, target in to_try:
-        for objtype in objtypes:
-            if objtype not in inventory or target not in inventory[objtype]:
-                continue
-            proj, version, uri, dispname = inventory[objtype][target]
-            newnode = nodes.reference('', '', internal=False, refuri=uri,
-                          reftitle=_('(in %s v%s)') % (proj, version))
-            if node.get('refexplicit'):
-                # use whatever title was given
-                newnode.append(contnode)
-            elif dispname == '-' or \
-                    (domain == 'std' and node['reftype'] == 'keyword'):
-                # use whatever title was given, but strip prefix
-                title = contnode.astext()
-                if in_set and title.startswith(in_set+':'):
-                    newnode.append(contnode.__class__(title[len(in_set)+1:],
-                                                      title[len(in_set)+1:]))
-                else:
-                    newnode.append(contnode)
+        found = inventory.lookup(target, objtypes)
+        if found is None:
+            continue
+        proj, version, uri, dispname = found
+        newnode = nodes.reference('', '', internal=False, refuri=uri,
+                                  reftitle=_('(in %s v%s)') % (proj, version))
+        if node.get('refexplicit'):
+            # use whatever title was given
+            newnode.append(contnode)
+        elif dispname == '-' or \
+                (domain == 'std' and node['reftype'] == 'keyword'):
+            # use whatever title was given, but strip prefix
+            title = contnode.astext()
+            if in_set and title.startswith(in_set+':'):
+                newnode.append(contnode.__class__(title[len(in_set)+1:],
+                                                  title[len(in_set)+1:]))
             else:
-                # else use the given display name (used for :ref:)
-                newnode.append(contnode.__class__(dispname, dispname))
-            return newnode
+                newnode.append(contnode)
+        else:
+            # else use the given display name (used for :ref:)
+            newnode.append(contnode.__class__(dispname, dispname))
+        return newnode
     # at least get rid of the ':' in the target if no explicit title given
     if in_set is not None and not node.get('refexplicit', True):
         if len(contnode) and isinstance(contnode[0], nodes.Text):
@@ -257,5 +565,7 @@ def missing_reference(app, env, node, contnode):
 def setup(app):
     app.add_config_value('intersphinx_mapping', {}, True)
     app.add_config_value('intersphinx_cache_limit', 5, False)
+    app.add_config_value('intersphinx_timeout', None, False)
     app.connect('missing-reference', missing_reference)
     app.connect('builder-inited', load_mappings)
+    return {'parallel_read_safe': True}
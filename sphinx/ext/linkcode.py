@@ -70,3 +70,4 @@ def doctree_read(app, doctree):
 def setup(app):
     app.connect('doctree-read', doctree_read)
     app.add_config_value('linkcode_resolve', None, 'env')
+    return {'parallel_read_safe': True}
@@ -14,7 +14,7 @@ import codecs
 import shutil
 import tempfile
 import posixpath
-from os import path, getcwd, chdir
+from os import path
 from subprocess import Popen, PIPE
 try:
     from hashlib import sha1 as sha
@@ -25,9 +25,12 @@ from docutils import nodes
 
 from sphinx.errors import SphinxError
 from sphinx.util.png import read_png_depth, write_png_depth
-from sphinx.util.osutil import ensuredir, ENOENT
+from sphinx.util.osutil import ensuredir, movefile, ENOENT
 from sphinx.util.pycompat import b
-from sphinx.ext.mathbase import setup_math as mathbase_setup, wrap_displaymath
+from sphinx.util.rendercache import get_render_cache, get_render_tasks, \
+     wait_for_render, tool_version, track_node_documents, get_node_doctrees
+from sphinx.ext.mathbase import setup_math as mathbase_setup, \
+     wrap_displaymath, math as math_node, displaymath as displaymath_node
 
 class MathExtError(SphinxError):
     category = 'Math extension error'
@@ -59,104 +62,167 @@ DOC_BODY_PREVIEW = r'''
 \end{document}
 '''
 
-depth_re = re.compile(b(r'\[\d+ depth=(-?\d+)\]'))
-
-def render_math(self, math):
-    """Render the LaTeX math expression *math* using latex and dvipng.
+# in a batch, every formula is typeset on its own page, numbered in sequence
+DOC_PAGE = r'''
+\setcounter{page}{%d}
+%s
+\clearpage
+'''
 
-    Return the filename relative to the built document and the "depth",
-    that is, the distance of image bottom and baseline in pixels, if the
-    option to use preview_latex is switched on.
+DOC_BODY_PREVIEW_BATCH = r'''
+\usepackage[active]{preview}
+\begin{document}
+%s
+\end{document}
+'''
 
-    Error handling may seem strange, but follows a pattern: if LaTeX or
-    dvipng aren't available, only a warning is generated (since that enables
-    people on machines without these programs to at least build the rest
-    of the docs successfully).  If the programs are there, however, they
-    may not fail since that indicates a problem in the math source.
-    """
-    use_preview = self.builder.config.pngmath_use_preview
+DOC_PAGE_PREVIEW = r'''
+\setcounter{page}{%d}
+\begin{preview}
+%s
+\end{preview}
+'''
 
-    shasum = "%s.png" % sha(math.encode('utf-8')).hexdigest()
-    relfn = posixpath.join(self.builder.imgpath, 'math', shasum)
-    outfn = path.join(self.builder.outdir, '_images', 'math', shasum)
-    if path.isfile(outfn):
-        depth = read_png_depth(outfn)
-        return relfn, depth
+# smallest number of expressions worth a run of latex of their own
+MIN_BATCH_SIZE = 20
 
-    # if latex or dvipng has failed once, don't bother to try again
-    if hasattr(self.builder, '_mathpng_warned_latex') or \
-       hasattr(self.builder, '_mathpng_warned_dvipng'):
-        return None, None
+depth_re = re.compile(b(r'\[\d+ depth=(-?\d+)\]'))
+page_depth_re = re.compile(b(r'\[(\d+) depth=(-?\d+)\]'))
 
-    latex = DOC_HEAD + self.builder.config.pngmath_latex_preamble
-    latex += (use_preview and DOC_BODY_PREVIEW or DOC_BODY) % math
 
+def get_tempdir(builder):
     # use only one tempdir per build -- the use of a directory is cleaner
     # than using temporary files, since we can clean up everything at once
     # just removing the whole directory (see cleanup_tempdir)
-    if not hasattr(self.builder, '_mathpng_tempdir'):
-        tempdir = self.builder._mathpng_tempdir = tempfile.mkdtemp()
-    else:
-        tempdir = self.builder._mathpng_tempdir
+    if not hasattr(builder, '_mathpng_tempdir'):
+        builder._mathpng_tempdir = tempfile.mkdtemp()
+    return builder._mathpng_tempdir
 
-    tf = codecs.open(path.join(tempdir, 'math.tex'), 'w', 'utf-8')
+def run_latex(builder, latex, name):
+    """Write *latex* to the file *name*.tex in the temporary directory and
+    run LaTeX on it.  Return the name of the DVI file, or None if LaTeX
+    cannot be run.
+    """
+    tempdir = get_tempdir(builder)
+    tf = codecs.open(path.join(tempdir, name + '.tex'), 'w', 'utf-8')
     tf.write(latex)
     tf.close()
 
     # build latex command; old versions of latex don't have the
-    # --output-directory option, so we have to manually chdir to the
-    # temp dir to run it.
-    ltx_args = [self.builder.config.pngmath_latex, '--interaction=nonstopmode']
+    # --output-directory option, so we have to run it in the temp dir
+    # (without chdir, since batches may be rendered in several threads)
+    ltx_args = [builder.config.pngmath_latex, '--interaction=nonstopmode']
     # add custom args from the config file
-    ltx_args.extend(self.builder.config.pngmath_latex_args)
-    ltx_args.append('math.tex')
-
-    curdir = getcwd()
-    chdir(tempdir)
+    ltx_args.extend(builder.config.pngmath_latex_args)
+    ltx_args.append(name + '.tex')
 
     try:
-        try:
-            p = Popen(ltx_args, stdout=PIPE, stderr=PIPE)
-        except OSError, err:
-            if err.errno != ENOENT:   # No such file or directory
-                raise
-            self.builder.warn('LaTeX command %r cannot be run (needed for math '
-                              'display), check the pngmath_latex setting' %
-                              self.builder.config.pngmath_latex)
-            self.builder._mathpng_warned_latex = True
-            return None, None
-    finally:
-        chdir(curdir)
+        p = Popen(ltx_args, stdout=PIPE, stderr=PIPE, cwd=tempdir)
+    except OSError, err:
+        if err.errno != ENOENT:   # No such file or directory
+            raise
+        builder.warn('LaTeX command %r cannot be run (needed for math '
+                     'display), check the pngmath_latex setting' %
+                     builder.config.pngmath_latex)
+        builder._mathpng_warned_latex = True
+        return None
 
     stdout, stderr = p.communicate()
     if p.returncode != 0:
         raise MathExtError('latex exited with error:\n[stderr]\n%s\n'
                            '[stdout]\n%s' % (stderr, stdout))
+    return path.join(tempdir, name + '.dvi')
 
-    ensuredir(path.dirname(outfn))
+def run_dvipng(builder, dvifn, outfn):
+    """Convert the DVI file *dvifn* to PNG images named *outfn*.  Return the
+    output of dvipng, or None if dvipng cannot be run.
+    """
     # use some standard dvipng arguments
-    dvipng_args = [self.builder.config.pngmath_dvipng]
+    dvipng_args = [builder.config.pngmath_dvipng]
     dvipng_args += ['-o', outfn, '-T', 'tight', '-z9']
     # add custom ones from config value
-    dvipng_args.extend(self.builder.config.pngmath_dvipng_args)
-    if use_preview:
+    dvipng_args.extend(builder.config.pngmath_dvipng_args)
+    if builder.config.pngmath_use_preview:
         dvipng_args.append('--depth')
     # last, the input file name
-    dvipng_args.append(path.join(tempdir, 'math.dvi'))
+    dvipng_args.append(dvifn)
     try:
         p = Popen(dvipng_args, stdout=PIPE, stderr=PIPE)
     except OSError, err:
         if err.errno != ENOENT:   # No such file or directory
             raise
-        self.builder.warn('dvipng command %r cannot be run (needed for math '
-                          'display), check the pngmath_dvipng setting' %
-                          self.builder.config.pngmath_dvipng)
-        self.builder._mathpng_warned_dvipng = True
-        return None, None
+        builder.warn('dvipng command %r cannot be run (needed for math '
+                     'display), check the pngmath_dvipng setting' %
+                     builder.config.pngmath_dvipng)
+        builder._mathpng_warned_dvipng = True
+        return None
     stdout, stderr = p.communicate()
     if p.returncode != 0:
         raise MathExtError('dvipng exited with error:\n[stderr]\n%s\n'
                            '[stdout]\n%s' % (stderr, stdout))
+    return stdout
+
+def get_outfilename(builder, math):
+    """Return the name of the image file for *math* in the output directory."""
+    shasum = "%s.png" % sha(math.encode('utf-8')).hexdigest()
+    return path.join(builder.outdir, '_images', 'math', shasum)
+
+def get_cache_key(builder, cache, math):
+    """Return the key of the image for *math* in the render cache."""
+    config = builder.config
+    return cache.key('pngmath', math, config.pngmath_latex_preamble,
+                     str(config.pngmath_use_preview),
+                     str(config.pngmath_latex_args),
+                     str(config.pngmath_dvipng_args),
+                     tool_version([config.pngmath_latex, '--version']),
+                     tool_version([config.pngmath_dvipng, '--version']))
+
+def render_math(self, math):
+    """Render the LaTeX math expression *math* using latex and dvipng.
+
+    Return the filename relative to the built document and the "depth",
+    that is, the distance of image bottom and baseline in pixels, if the
+    option to use preview_latex is switched on.
+
+    Error handling may seem strange, but follows a pattern: if LaTeX or
+    dvipng aren't available, only a warning is generated (since that enables
+    people on machines without these programs to at least build the rest
+    of the docs successfully).  If the programs are there, however, they
+    may not fail since that indicates a problem in the math source.
+    """
+    use_preview = self.builder.config.pngmath_use_preview
+
+    outfn = get_outfilename(self.builder, math)
+    relfn = posixpath.join(self.builder.imgpath, 'math', path.basename(outfn))
+    batch = getattr(self.builder, '_mathpng_batches', {}).get(outfn)
+    if batch is not None:
+        wait_for_render(self.builder, batch)
+    if path.isfile(outfn):
+        depth = read_png_depth(outfn)
+        return relfn, depth
+
+    cache = get_render_cache(self.builder)
+    if cache is not None:
+        key = get_cache_key(self.builder, cache, math)
+        if cache.fetch(key, [outfn]):
+            return relfn, read_png_depth(outfn)
+
+    # if latex or dvipng has failed once, don't bother to try again
+    if hasattr(self.builder, '_mathpng_warned_latex') or \
+       hasattr(self.builder, '_mathpng_warned_dvipng'):
+        return None, None
+
+    latex = DOC_HEAD + self.builder.config.pngmath_latex_preamble
+    latex += (use_preview and DOC_BODY_PREVIEW or DOC_BODY) % math
+
+    dvifn = run_latex(self.builder, latex, 'math')
+    if dvifn is None:
+        return None, None
+
+    ensuredir(path.dirname(outfn))
+    stdout = run_dvipng(self.builder, dvifn, outfn)
+    if stdout is None:
+        return None, None
     depth = None
     if use_preview:
         for line in stdout.splitlines():
@@ -165,10 +231,118 @@ def render_math(self, math):
                 depth = int(m.group(1))
                 write_png_depth(outfn, depth)
                 break
+    if cache is not None:
+        cache.store(key, [outfn])
 
     return relfn, depth
 
+def render_math_batch(builder, maths):
+    """Render all the LaTeX math expressions in *maths* that are not rendered
+    yet with a single run of latex and dvipng, one page per expression.  If
+    external programs may run in the background, the batch is run there
+    (large batches split between several runs at once), and render_math()
+    waits for the batch of the expression it is asked for.
+
+    If anything fails, the batch is given up without a message: the
+    expressions left over are then rendered one by one by render_math(),
+    which attributes errors to the right expression.
+    """
+    if hasattr(builder, '_mathpng_warned_latex') or \
+       hasattr(builder, '_mathpng_warned_dvipng'):
+        return
+    cache = get_render_cache(builder)
+    todo = []
+    seen = set()
+    for math in maths:
+        outfn = get_outfilename(builder, math)
+        if outfn in seen or path.isfile(outfn):
+            continue
+        seen.add(outfn)
+        if cache is not None and \
+               cache.fetch(get_cache_key(builder, cache, math), [outfn]):
+            continue
+        todo.append((math, outfn))
+    if len(todo) < 2:
+        return
+
+    tasks = get_render_tasks(builder)
+    if tasks is None:
+        run_batch(builder, todo, 'batch')
+        return
+    # if latex is missing, leave it to render_math() to warn once
+    if not tool_version([builder.config.pngmath_latex, '--version']):
+        return
+    get_tempdir(builder)
+    nbatches = max(1, min(tasks.nthreads, len(todo) // MIN_BATCH_SIZE))
+    if nbatches == 1:
+        names = ['batch']
+    else:
+        names = ['batch%d' % i for i in range(nbatches)]
+    builder._mathpng_batches = {}
+    for i, name in enumerate(names):
+        batch = todo[i::nbatches]
+        for math, outfn in batch:
+            builder._mathpng_batches[outfn] = name
+        tasks.add_task(name, run_batch, builder, batch, name)
+
+def run_batch(builder, todo, name):
+    """Render the math expressions of the ``(math, outfn)`` pairs *todo*,
+    using *name* for the temporary files.
+    """
+    use_preview = builder.config.pngmath_use_preview
+    cache = get_render_cache(builder)
+    page = use_preview and DOC_PAGE_PREVIEW or DOC_PAGE
+    latex = DOC_HEAD + builder.config.pngmath_latex_preamble
+    latex += (use_preview and DOC_BODY_PREVIEW_BATCH or DOC_BODY) % \
+        ''.join([page % (i + 1, math) for i, (math, _) in enumerate(todo)])
+    try:
+        dvifn = run_latex(builder, latex, name)
+        if dvifn is None:
+            return
+        mathdir = path.dirname(todo[0][1])
+        ensuredir(mathdir)
+        stdout = run_dvipng(builder, dvifn,
+                            path.join(mathdir, name + '-%d.png'))
+        if stdout is None:
+            return
+    except MathExtError:
+        return
+    depths = {}
+    if use_preview:
+        for m in page_depth_re.finditer(stdout):
+            depths[int(m.group(1))] = int(m.group(2))
+    for i, (math, outfn) in enumerate(todo):
+        pagefn = path.join(mathdir, '%s-%d.png' % (name, i + 1))
+        if not path.isfile(pagefn):
+            continue
+        if i + 1 in depths:
+            write_png_depth(pagefn, depths[i + 1])
+        movefile(pagefn, outfn)
+        if cache is not None:
+            cache.store(get_cache_key(builder, cache, math), [outfn])
+
+def get_math_source(node):
+    """Return the LaTeX code to render for a math or displaymath node."""
+    if isinstance(node, math_node):
+        return '$' + node['latex'] + '$'
+    if node['nowrap']:
+        return node['latex']
+    return wrap_displaymath(node['latex'], None)
+
+def is_math_node(node):
+    return isinstance(node, (math_node, displaymath_node))
+
+def render_written_math(app, docnames):
+    if not app.builder.config.pngmath_batch or app.builder.format != 'html':
+        return
+    maths = []
+    for doctree in get_node_doctrees(app.env, 'pngmath_docs', docnames):
+        maths.extend([get_math_source(node)
+                      for node in doctree.traverse(is_math_node)])
+    render_math_batch(app.builder, maths)
+
 def cleanup_tempdir(app, exc):
+    wait_for_render(app.builder)
     if exc:
         return
     if not hasattr(app.builder, '_mathpng_tempdir'):
@@ -185,7 +359,7 @@ def get_tooltip(self, node):
 
 def html_visit_math(self, node):
     try:
-        fname, depth = render_math(self, '$'+node['latex']+'$')
+        fname, depth = render_math(self, get_math_source(node))
     except MathExtError, exc:
         msg = unicode(str(exc), 'utf-8', 'replace')
         sm = nodes.system_message(msg, type='WARNING', level=2,
@@ -205,12 +379,8 @@ def html_visit_math(self, node):
     raise nodes.SkipNode
 
 def html_visit_displaymath(self, node):
-    if node['nowrap']:
-        latex = node['latex']
-    else:
-        latex = wrap_displaymath(node['latex'], None)
     try:
-        fname, depth = render_math(self, latex)
+        fname, depth = render_math(self, get_math_source(node))
     except MathExtError, exc:
         sm = nodes.system_message(str(exc), type='WARNING', level=2,
                                   backrefs=[], source=node['latex'])
@@ -242,4 +412,10 @@ def setup(app):
     app.add_config_value('pngmath_latex_args', [], 'html')
     app.add_config_value('pngmath_latex_preamble', '', 'html')
     app.add_config_value('pngmath_add_tooltips', True, 'html')
+    app.add_config_value('pngmath_batch', True, 'html')
+    track_node_documents(app, 'pngmath_docs', is_math_node)
+    app.connect('write-started', render_written_math)
     app.connect('build-finished', cleanup_tempdir)
+    # the LaTeX temporary directory is created per builder process and only
+    # cleaned up in the main process
+    return {'parallel_read_safe': True, 'parallel_write_safe': False}
@@ -147,6 +147,15 @@ def purge_todos(app, env, docname):
                           if todo['docname'] != docname]
 
 
+def merge_info(app, env, docnames, other):
+    if not hasattr(other, 'todo_all_todos'):
+        return
+    if not hasattr(env, 'todo_all_todos'):
+        env.todo_all_todos = []
+    env.todo_all_todos.extend(todo for todo in other.todo_all_todos
+                              if todo['docname'] in docnames)
+
+
 def visit_todo_node(self, node):
     self.visit_admonition(node)
 
@@ -169,4 +178,6 @@ def setup(app):
     app.connect('doctree-read', process_todos)
     app.connect('doctree-resolved', process_todo_nodes)
     app.connect('env-purge-doc', purge_todos)
+    app.connect('env-merge-info', merge_info)
+    return {'parallel_read_safe': True}
 
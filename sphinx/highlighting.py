@@ -19,6 +19,7 @@ except ImportError:
     # parser is not available on Jython
     parser = None
 
+from sphinx import __version__
 from sphinx.util.pycompat import htmlescape
 from sphinx.util.texescape import tex_hl_escape_map_new
 from sphinx.ext import doctest
@@ -77,8 +78,11 @@ class PygmentsBridge(object):
     latex_formatter = LatexFormatter
 
     def __init__(self, dest='html', stylename='sphinx',
-                 trim_doctest_flags=False):
+                 trim_doctest_flags=False, cache=None):
         self.dest = dest
+        # a StringCache for the highlighted blocks, or None
+        self.cache = cache
+        self.stylename = stylename
         if not pygments:
             return
         if stylename is None or stylename == 'sphinx':
@@ -164,7 +168,30 @@ class PygmentsBridge(object):
             source = source.decode()
         if not pygments:
             return self.unhighlighted(source)
+        if self.cache is None:
+            return self._highlight_block(source, lang, warn, force, **kwargs)
 
+        # the result depends on nothing else, so it can be reused in other
+        # builds
+        key = self.cache.key('highlight', __version__, pygments.__version__,
+            self.__class__.__name__, self.formatter.__name__,
+            str(self.stylename), str(self.trim_doctest_flags), str(lang),
+            str(force), repr(sorted(kwargs.items())), source)
+        hlsource = self.cache.get(key)
+        if hlsource is not None:
+            return hlsource
+        warnings = []
+        def record_warning(msg):
+            warnings.append(msg)
+            warn(msg)
+        hlsource = self._highlight_block(source, lang, warn and record_warning,
+                                         force, **kwargs)
+        # a cached result would not give the warning again
+        if isinstance(hlsource, unicode) and not warnings:
+            self.cache.put(key, hlsource)
+        return hlsource
+
+    def _highlight_block(self, source, lang, warn, force, **kwargs):
         # find out which lexer to use
         if lang in ('py', 'python'):
             if source.startswith('>>>'):
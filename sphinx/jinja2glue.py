@@ -18,7 +18,7 @@ from jinja2.utils import open_if_exists
 from jinja2.sandbox import SandboxedEnvironment
 
 from sphinx.application import TemplateBridge
-from sphinx.util.osutil import mtimes_of_files
+from sphinx.util.osutil import mtimes_of_files, digest_of_files
 
 
 def _tobool(val):
@@ -133,6 +133,9 @@ class BuiltinTemplateLoader(TemplateBridge, BaseLoader):
     def newest_template_mtime(self):
         return max(mtimes_of_files(self.pathchain, '.html'))
 
+    def templates_digest(self):
+        return digest_of_files(self.pathchain, '.html')
+
     # Loader interface
 
     def get_source(self, environment, template):
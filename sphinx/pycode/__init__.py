@@ -9,13 +9,23 @@
     :license: BSD, see LICENSE for details.
 """
 
+import os
+import sys
+import cPickle as pickle
 from os import path
+try:
+    from hashlib import md5
+except ImportError:
+    # 2.4 compatibility
+    from md5 import md5
 
+import sphinx
 from sphinx import package_dir
 from sphinx.errors import PycodeError
 from sphinx.pycode import nodes
 from sphinx.pycode.pgen2 import driver, token, tokenize, parse, literals
 from sphinx.util import get_module_source, detect_encoding
+from sphinx.util.osutil import ensuredir, movefile
 from sphinx.util.pycompat import next, StringIO, BytesIO, TextIOWrapper
 from sphinx.util.docstrings import prepare_docstring, prepare_commentdoc
 
@@ -167,6 +177,9 @@ class AttrDocVisitor(nodes.NodeVisitor):
 class ModuleAnalyzer(object):
     # cache for analyzer objects -- caches both by module and file name
     cache = {}
+    # directory where the analysis results for source files are kept
+    # across builds, or None
+    cachedir = None
 
     @classmethod
     def for_string(cls, string, modname, srcname='<string>'):
@@ -183,6 +196,7 @@ class ModuleAnalyzer(object):
         except Exception, err:
             raise PycodeError('error opening %r' % filename, err)
         obj = cls(fileobj, modname, filename)
+        obj.load_results()
         cls.cache['file', filename] = obj
         return obj
 
@@ -219,9 +233,11 @@ class ModuleAnalyzer(object):
         if not decoded:
             self.encoding = detect_encoding(self.source.readline)
             self.source.seek(pos)
-            self.code = self.source.read().decode(self.encoding)
-            self.source.seek(pos)
-            self.source = TextIOWrapper(self.source, self.encoding)
+            data = self.source.read()
+            # don't keep the file open while the analyzer is cached
+            self.source.close()
+            self.code = data.decode(self.encoding)
+            self.source = TextIOWrapper(BytesIO(data), self.encoding)
         else:
             self.encoding = None
             self.code = self.source.read()
@@ -236,6 +252,58 @@ class ModuleAnalyzer(object):
         self.tagorder = None
         # will be filled by find_tags()
         self.tags = None
+        # filename and key of the persistent results, see load_results()
+        self._resultfile = self._resultkey = None
+
+    def load_results(self):
+        """Load the results of :meth:`find_attr_docs` and :meth:`find_tags`
+        from the cache directory, if they were stored for the same contents
+        of the source file.
+        """
+        if self.cachedir is None:
+            return
+        try:
+            stat = os.stat(self.srcname)
+        except OSError:
+            return
+        filename = path.abspath(self.srcname)
+        if isinstance(filename, unicode):
+            filename = filename.encode('utf-8')
+        self._resultkey = (sphinx.__version__, sys.version_info[:2], filename,
+                           stat.st_size, stat.st_mtime,
+                           md5(self.code.encode('utf-8')).hexdigest())
+        self._resultfile = path.join(self.cachedir,
+                                     md5(filename).hexdigest() + '.pickle')
+        try:
+            f = open(self._resultfile, 'rb')
+            try:
+                key, results = pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            # not there or unreadable; will be written once found
+            return
+        if key == self._resultkey:
+            self.attr_docs, self.tagorder, self.tags = results
+
+    def save_results(self):
+        """Store the results found so far in the cache directory."""
+        if self._resultfile is None:
+            return
+        results = (self.attr_docs, self.tagorder, self.tags)
+        try:
+            ensuredir(self.cachedir)
+            tmpname = self._resultfile + '.tmp%d' % os.getpid()
+            f = open(tmpname, 'wb')
+            try:
+                pickle.dump((self._resultkey, results), f,
+                            pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            movefile(tmpname, self._resultfile)
+        except (IOError, OSError):
+            # the cache is only an optimization
+            pass
 
     def tokenize(self):
         """Generate tokens from the source."""
@@ -266,9 +334,14 @@ class ModuleAnalyzer(object):
         # now that we found everything we could in the tree, throw it away
         # (it takes quite a bit of memory for large modules)
         self.parsetree = None
+        # the tags are cheap to find from the tokens we have, so that the
+        # results can be stored complete, and only once
+        if self.tags is None:
+            self.find_tags(save=False)
+        self.save_results()
         return attr_visitor.collected
 
-    def find_tags(self):
+    def find_tags(self, save=True):
         """Find class, function and method definitions and their location."""
         if self.tags is not None:
             return self.tags
@@ -320,6 +393,8 @@ class ModuleAnalyzer(object):
                     defline = False
                     expect_indent = True
         self.tags = result
+        if save:
+            self.save_results()
         return result
 
 
@@ -9,9 +9,10 @@
     :license: BSD, see LICENSE for details.
 """
 import re
+import struct
 import cPickle as pickle
 
-from docutils.nodes import comment, Text, NodeVisitor, SkipNode
+from docutils.nodes import comment, title, Text, NodeVisitor, SkipNode
 
 from sphinx.util import jsdump, rpartition
 
@@ -53,8 +54,13 @@ var Stemmer = function() {
 
     _word_re = re.compile(r'\w+(?u)')
 
+    #: maximum number of words whose index terms are cached
+    term_cache_size = 100000
+
     def __init__(self, options):
         self.options = options
+        # word -> stemmed word, or None if it is not indexed
+        self._term_cache = {}
         self.init(options)
 
     def init(self, options):
@@ -92,6 +98,24 @@ var Stemmer = function() {
             (ord(word[0]) < 256 and (len(word) < 3 or word in self.stopwords or
                                      word.isdigit())))
 
+    def get_term(self, word):
+        """
+        Return the stemmed *word* if it should be registered in the search
+        index, else None.  The results of :meth:`stem` and :meth:`word_filter`
+        are cached, since most words occur many times in a project.
+        """
+        try:
+            return self._term_cache[word]
+        except KeyError:
+            pass
+        stemmed = self.stem(word)
+        if not self.word_filter(stemmed):
+            stemmed = None
+        if len(self._term_cache) >= self.term_cache_size:
+            self._term_cache.clear()
+        self._term_cache[word] = stemmed
+        return stemmed
+
 from sphinx.search import en, ja
 
 languages = {
@@ -109,6 +133,10 @@ class _JavaScriptIndex(object):
     PREFIX = 'Search.setIndex('
     SUFFIX = ')'
 
+    def __init__(self, prefix=None):
+        if prefix is not None:
+            self.PREFIX = prefix
+
     def dumps(self, data):
         return self.PREFIX + jsdump.dumps(data) + self.SUFFIX
 
@@ -120,13 +148,88 @@ class _JavaScriptIndex(object):
         return jsdump.loads(data)
 
     def dump(self, data, f):
-        f.write(self.dumps(data))
+        f.write(self.PREFIX)
+        jsdump.dump(data, f)
+        f.write(self.SUFFIX)
 
     def load(self, f):
         return self.loads(f.read())
 
 
 js_index = _JavaScriptIndex()
+js_terms = _JavaScriptIndex('Search.setTerms(')
+
+
+def encode_postings(files, fn2index):
+    """Encode the mapping *files* of file names to the weights of a term in
+    them as a compact list: the ascending file numbers, each as difference to
+    the previous one, followed by the negated weight if it is not 1.  A single
+    file with weight 1 is encoded as its number.  Return None if none of the
+    files is in *fn2index*.
+    """
+    postings = sorted((fn2index[fn], weight)
+                      for (fn, weight) in files.iteritems() if fn in fn2index)
+    if not postings:
+        return None
+    if len(postings) == 1 and postings[0][1] == 1:
+        return postings[0][0]
+    rv = []
+    last = 0
+    for index, weight in postings:
+        rv.append(index - last)
+        last = index
+        if weight != 1:
+            rv.append(-weight)
+    return rv
+
+
+def decode_postings(postings):
+    """Return the (file number, weight) pairs encoded by
+    :func:`encode_postings`.
+    """
+    if isinstance(postings, (int, long)):
+        return [(postings, 1)]
+    rv = []
+    index = 0
+    for value in postings:
+        if value < 0:
+            rv[-1] = (index, -value)
+        else:
+            index += value
+            rv.append((index, 1))
+    return rv
+
+
+def term_shard(term, nshards):
+    """Return the number of the shard *term* is put in when the terms of the
+    index are split into *nshards* parts.  ``searchtools.js`` computes the
+    same hash over the UTF-16 code units of the term.
+    """
+    hash = 0
+    data = unicode(term).encode('utf-16-be')
+    for unit in struct.unpack('>%dH' % (len(data) // 2), data):
+        hash = (hash * 31 + unit) & 0xffffffff
+    return hash % nshards
+
+
+def split_terms(frozen, nshards):
+    """Move the terms of the *frozen* index into *nshards* shards, to be
+    loaded separately.  Return the list of shard data.
+    """
+    shards = [{'shard': i, 'terms': {}} for i in range(nshards)]
+    for term, files in frozen.pop('terms').iteritems():
+        shards[term_shard(term, nshards)]['terms'][term] = files
+    frozen['termshards'] = nshards
+    return shards
+
+
+def join_terms(frozen, shards):
+    """Put the terms from the *shards* back into the *frozen* index."""
+    if len(shards) != frozen.pop('termshards'):
+        raise ValueError('missing shards')
+    terms = frozen['terms'] = {}
+    for shard in shards:
+        terms.update(shard['terms'])
 
 
 class WordCollector(NodeVisitor):
@@ -137,15 +240,23 @@ class WordCollector(NodeVisitor):
     def __init__(self, document, lang):
         NodeVisitor.__init__(self, document)
         self.found_words = []
+        self.found_title_words = []
         self.lang = lang
 
     def dispatch_visit(self, node):
         if node.__class__ is comment:
             raise SkipNode
+        if node.__class__ is title:
+            self.found_title_words.extend(self.lang.split(node.astext()))
+            raise SkipNode
         if node.__class__ is Text:
             self.found_words.extend(self.lang.split(node.astext()))
 
 
+#: version of the data written by IndexBuilder.dump_state()
+STATE_VERSION = 2
+
+
 class IndexBuilder(object):
     """
     Helper class that creates a searchindex based on the doctrees
@@ -156,12 +267,18 @@ class IndexBuilder(object):
         'pickle':   pickle
     }
 
+    #: how much more an occurrence of a word in a title or heading counts
+    #: than one in the text
+    title_weight = 5
+
     def __init__(self, env, lang, options):
         self.env = env
         # filename -> title
         self._titles = {}
-        # stemmed word -> set(filenames)
+        # stemmed word -> {filename: weight of the word in it}
         self._mapping = {}
+        # filename -> sum of the weights of its words
+        self._doclengths = {}
         # objtype -> index
         self._objtypes = {}
         # objtype index -> (domain, type, objname (localized))
@@ -169,22 +286,29 @@ class IndexBuilder(object):
         # add language-specific SearchLanguage instance
         self.lang = languages[lang](options)
 
-    def load(self, stream, format):
-        """Reconstruct from frozen data."""
+    def load(self, stream, format, load_shard=None):
+        """Reconstruct from frozen data.  If the terms of the index are split
+        into shards, *load_shard* is called with each shard number and must
+        return the data of that shard.
+        """
         if isinstance(format, basestring):
             format = self.formats[format]
         frozen = format.load(stream)
         # if an old index is present, we treat it as not existing.
-        if not isinstance(frozen, dict):
+        if not isinstance(frozen, dict) or 'doclengths' not in frozen:
             raise ValueError('old format')
+        if frozen.get('termshards'):
+            if load_shard is None:
+                raise ValueError('sharded index')
+            join_terms(frozen, [load_shard(i)
+                                for i in range(frozen['termshards'])])
         index2fn = frozen['filenames']
         self._titles = dict(zip(index2fn, frozen['titles']))
+        self._doclengths = dict(zip(index2fn, frozen['doclengths']))
         self._mapping = {}
         for k, v in frozen['terms'].iteritems():
-            if isinstance(v, int):
-                self._mapping[k] = set([index2fn[v]])
-            else:
-                self._mapping[k] = set(index2fn[i] for i in v)
+            self._mapping[k] = dict((index2fn[i], weight)
+                                    for (i, weight) in decode_postings(v))
         # no need to load keywords/objtypes
 
     def dump(self, stream, format):
@@ -193,6 +317,22 @@ class IndexBuilder(object):
             format = self.formats[format]
         format.dump(self.freeze(), stream)
 
+    def dump_state(self, stream):
+        """Pickle the title and word data to a stream.  Unlike the frozen
+        index, it can be read back by :meth:`load_state` without any
+        conversion.
+        """
+        pickle.dump((STATE_VERSION, self.lang.lang, self._titles,
+                     self._mapping, self._doclengths), stream,
+                    pickle.HIGHEST_PROTOCOL)
+
+    def load_state(self, stream):
+        """Reconstruct from data written by :meth:`dump_state`."""
+        state = pickle.load(stream)
+        if state[:2] != (STATE_VERSION, self.lang.lang):
+            raise ValueError('incompatible state')
+        self._titles, self._mapping, self._doclengths = state[2:]
+
     def get_objects(self, fn2index):
         rv = {}
         otypes = self._objtypes
@@ -231,18 +371,16 @@ class IndexBuilder(object):
     def get_terms(self, fn2index):
         rv = {}
         for k, v in self._mapping.iteritems():
-            if len(v) == 1:
-                fn, = v
-                if fn in fn2index:
-                    rv[k] = fn2index[fn]
-            else:
-                rv[k] = [fn2index[fn] for fn in v if fn in fn2index]
+            postings = encode_postings(v, fn2index)
+            if postings is not None:
+                rv[k] = postings
         return rv
 
     def freeze(self):
         """Create a usable data structure for serializing."""
         filenames = self._titles.keys()
         titles = self._titles.values()
+        doclengths = [self._doclengths.get(fn, 0) for fn in filenames]
         fn2index = dict((f, i) for (i, f) in enumerate(filenames))
         terms = self.get_terms(fn2index)
         objects = self.get_objects(fn2index)  # populates _objtypes
@@ -250,17 +388,47 @@ class IndexBuilder(object):
                         for (k, v) in self._objtypes.iteritems())
         objnames = self._objnames
         return dict(filenames=filenames, titles=titles, terms=terms,
-                    objects=objects, objtypes=objtypes, objnames=objnames)
+                    objects=objects, objtypes=objtypes, objnames=objnames,
+                    doclengths=doclengths)
 
     def prune(self, filenames):
         """Remove data for all filenames not in the list."""
+        filenames = set(filenames)
         new_titles = {}
         for filename in filenames:
             if filename in self._titles:
                 new_titles[filename] = self._titles[filename]
         self._titles = new_titles
-        for wordnames in self._mapping.itervalues():
-            wordnames.intersection_update(filenames)
+        for filename in self._doclengths.keys():
+            if filename not in filenames:
+                del self._doclengths[filename]
+        for word, wordfiles in self._mapping.items():
+            for filename in [fn for fn in wordfiles if fn not in filenames]:
+                del wordfiles[filename]
+            if not wordfiles:
+                del self._mapping[word]
+
+    def new_fragment(self):
+        """Return a new, empty IndexBuilder with the same settings, e.g. to
+        index a part of the documents in a worker process.
+        """
+        return self.__class__(self.env, self.lang.lang, self.lang.options)
+
+    def get_fragment(self):
+        """Return the picklable title and word data of this index, to be
+        given to :meth:`merge_fragment`.
+        """
+        return self._titles, self._mapping, self._doclengths
+
+    def merge_fragment(self, fragment):
+        """Merge the data returned by :meth:`get_fragment` of another index
+        into this one.
+        """
+        titles, mapping, doclengths = fragment
+        self._titles.update(titles)
+        self._doclengths.update(doclengths)
+        for word, wordfiles in mapping.iteritems():
+            self._mapping.setdefault(word, {}).update(wordfiles)
 
     def feed(self, filename, title, doctree):
         """Feed a doctree to the index."""
@@ -269,19 +437,32 @@ class IndexBuilder(object):
         visitor = WordCollector(doctree, self.lang)
         doctree.walk(visitor)
 
-        def add_term(word, stem=self.lang.stem):
-            word = stem(word)
-            if self.lang.word_filter(word):
-                self._mapping.setdefault(word, set()).add(filename)
-
-        for word in self.lang.split(title):
-            add_term(word)
-
+        # count the occurrences of the words, those in headings and in the
+        # document title (if it doesn't appear as a heading) several times
+        counts = {}
         for word in visitor.found_words:
-            add_term(word)
+            counts[word] = counts.get(word, 0) + 1
+        title_words = visitor.found_title_words
+        title_words.extend(set(self.lang.split(title)).difference(title_words))
+        title_weight = self.title_weight
+        for word in title_words:
+            counts[word] = counts.get(word, 0) + title_weight
+
+        # every word needs to be looked at only once per document
+        get_term = self.lang.get_term
+        mapping = self._mapping
+        length = 0
+        for word, count in counts.iteritems():
+            term = get_term(word)
+            if term is not None:
+                wordfiles = mapping.setdefault(term, {})
+                wordfiles[filename] = wordfiles.get(filename, 0) + count
+                length += count
+        self._doclengths[filename] = length
 
     def context_for_searchtool(self):
         return dict(
             search_language_stemming_code = self.lang.js_stemmer_code,
             search_language_stop_words = jsdump.dumps(self.lang.stopwords),
         )
+
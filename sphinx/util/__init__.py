@@ -12,6 +12,7 @@
 import os
 import re
 import sys
+import zlib
 import shutil
 import fnmatch
 import tempfile
@@ -97,8 +98,10 @@ class FilenameUniqDict(dict):
     """
     def __init__(self):
         self._existing = set()
+        self._docfiles = {}  # docname -> set of filenames
 
     def add_file(self, docname, newfile):
+        self._docfiles.setdefault(docname, set()).add(newfile)
         if newfile in self:
             self[newfile][0].add(docname)
             return self[newfile][1]
@@ -113,17 +116,313 @@ class FilenameUniqDict(dict):
         return uniquename
 
     def purge_doc(self, docname):
-        for filename, (docs, unique) in self.items():
+        for filename in self._docfiles.pop(docname, ()):
+            docs, unique = self[filename]
             docs.discard(docname)
             if not docs:
                 del self[filename]
                 self._existing.discard(unique)
 
+    def merge_other(self, docnames, other):
+        for filename, (docs, unique) in other.items():
+            for doc in docs & docnames:
+                self.add_file(doc, filename)
+
     def __getstate__(self):
         return self._existing
 
     def __setstate__(self, state):
+        # the items are already restored at this point
         self._existing = state
+        self._docfiles = {}
+        for filename, (docs, unique) in self.iteritems():
+            for docname in docs:
+                self._docfiles.setdefault(docname, set()).add(filename)
+
+
+class DocIndexedDict(dict):
+    """
+    A dictionary whose values are docnames or tuples starting with a docname,
+    such as the object inventories of domains.  It keeps an index of the keys
+    belonging to each document, so that :meth:`purge_doc` only needs to look
+    at the entries of that document.
+    """
+    def __init__(self, *args, **kwds):
+        dict.__init__(self)
+        self._bydoc = {}
+        self.update(*args, **kwds)
+
+    def _docname(self, value):
+        if isinstance(value, basestring):
+            return value
+        return value[0]
+
+    def _unindex(self, key, value):
+        docname = self._docname(value)
+        keys = self._bydoc.get(docname)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._bydoc[docname]
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self._unindex(key, self[key])
+        dict.__setitem__(self, key, value)
+        self._bydoc.setdefault(self._docname(value), set()).add(key)
+
+    def __delitem__(self, key):
+        self._unindex(key, self[key])
+        dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self._unindex(key, value)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwds):
+        for key, value in dict(*args, **kwds).iteritems():
+            self[key] = value
+
+    def clear(self):
+        dict.clear(self)
+        self._bydoc.clear()
+
+    def copy(self):
+        return self.__class__(self)
+
+    def keys_for_doc(self, docname):
+        """Return the keys of all entries belonging to *docname*."""
+        return set(self._bydoc.get(docname, ()))
+
+    def purge_doc(self, docname):
+        """Remove all entries belonging to *docname*."""
+        for key in self._bydoc.pop(docname, ()):
+            dict.__delitem__(self, key)
+
+    def __reduce__(self):
+        # the index is rebuilt when unpickling
+        return (self.__class__, (dict(self),))
+
+
+class LRUCache(object):
+    """
+    A mapping that holds at most *maxentries* items, whose sizes as measured
+    by *sizefunc* add up to at most *maxsize*.  If it grows beyond these
+    limits, the least recently used items are dropped.  A limit of ``None``
+    means no limit.
+    """
+    def __init__(self, maxentries=None, maxsize=None, sizefunc=len):
+        self.maxentries = maxentries
+        self.maxsize = maxsize
+        self.sizefunc = sizefunc
+        self.clear()
+
+    def clear(self):
+        # key -> [previous item, next item, key, value, size]; the items are
+        # linked in a ring with a root item, from the least to the most
+        # recently used
+        self._items = {}
+        root = self._root = []
+        root[:] = [root, root, None, None, 0]
+        self.size = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def _unlink(self, item):
+        item[0][1] = item[1]
+        item[1][0] = item[0]
+
+    def _append(self, item):
+        root = self._root
+        item[0] = root[0]
+        item[1] = root
+        root[0][1] = item
+        root[0] = item
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            return default
+        self._unlink(item)
+        self._append(item)
+        return item[3]
+
+    def __setitem__(self, key, value):
+        self.discard(key)
+        size = self.sizefunc(value)
+        if self.maxentries == 0 or \
+               (self.maxsize is not None and size > self.maxsize):
+            # not cacheable at all
+            return
+        item = [None, None, key, value, size]
+        self._items[key] = item
+        self._append(item)
+        self.size += size
+        while (self.maxentries is not None and
+               len(self._items) > self.maxentries) or \
+              (self.maxsize is not None and self.size > self.maxsize):
+            self.discard(self._root[1][2])
+
+    def discard(self, key):
+        item = self._items.pop(key, None)
+        if item is not None:
+            self._unlink(item)
+            self.size -= item[4]
+
+
+def key_segment(key, nsegments):
+    """Return the segment number (below *nsegments*) of a string key."""
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return (zlib.crc32(key) & 0xffffffff) % nsegments
+
+
+class SegmentedDict(dict):
+    """
+    A dictionary with string keys, whose items are distributed over
+    *nsegments* segments by :func:`key_segment`, and that loads the items of a
+    segment only when they are needed.  Used for the per-document inventories
+    of a pickled environment.
+
+    *unloaded* is the set of segment numbers that are not loaded yet.
+    *loadfunc* is called with a segment number, and must remove it from
+    *unloaded* and put its items into the dictionary using ``dict.update()``.
+    """
+    def __init__(self, nsegments, unloaded, loadfunc):
+        dict.__init__(self)
+        self.nsegments = nsegments
+        self.unloaded = unloaded
+        self.loadfunc = loadfunc
+
+    def _load(self, key):
+        if self.unloaded:
+            segment = key_segment(key, self.nsegments)
+            if segment in self.unloaded:
+                self.loadfunc(segment)
+
+    def _load_all(self):
+        while self.unloaded:
+            self.loadfunc(min(self.unloaded))
+
+    # access to a single key only loads the segment of that key
+
+    def __getitem__(self, key):
+        self._load(key)
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        self._load(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._load(key)
+        dict.__delitem__(self, key)
+
+    def __contains__(self, key):
+        self._load(key)
+        return dict.__contains__(self, key)
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        self._load(key)
+        return dict.get(self, key, default)
+
+    def pop(self, key, *default):
+        self._load(key)
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key, default=None):
+        self._load(key)
+        return dict.setdefault(self, key, default)
+
+    def update(self, other=(), **kwds):
+        if hasattr(other, 'keys'):
+            other = [(key, other[key]) for key in other.keys()]
+        for key, value in other:
+            self[key] = value
+        for key, value in kwds.iteritems():
+            self[key] = value
+
+    # everything else needs all segments
+
+    def __iter__(self):
+        self._load_all()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._load_all()
+        return dict.__len__(self)
+
+    def __eq__(self, other):
+        self._load_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self._load_all()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        # pickle as a complete, normal dictionary
+        self._load_all()
+        return dict, (dict.copy(self),)
+
+    def keys(self):
+        self._load_all()
+        return dict.keys(self)
+
+    def values(self):
+        self._load_all()
+        return dict.values(self)
+
+    def items(self):
+        self._load_all()
+        return dict.items(self)
+
+    def iterkeys(self):
+        self._load_all()
+        return dict.iterkeys(self)
+
+    def itervalues(self):
+        self._load_all()
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self._load_all()
+        return dict.iteritems(self)
+
+    def popitem(self):
+        self._load_all()
+        return dict.popitem(self)
+
+    def copy(self):
+        self._load_all()
+        return dict.copy(self)
+
+    def clear(self):
+        self._load_all()
+        dict.clear(self)
 
 
 def copy_static_entry(source, targetdir, builder, context={},
@@ -15,7 +15,7 @@ import re
 from sphinx.util.pycompat import u
 
 _str_re  = re.compile(r'"(\\\\|\\"|[^"])*"')
-_int_re  = re.compile(r'\d+')
+_int_re  = re.compile(r'-?\d+')
 _name_re = re.compile(r'[a-zA-Z]\w*')
 _nameonly_re = re.compile(r'[a-zA-Z]\w*$')
 
@@ -97,8 +97,44 @@ def dumps(obj, key=False):
         return encode_string(obj)
     raise TypeError(type(obj))
 
+def _dump(obj, parts, flush):
+    # like dumps(), but appends the pieces to *parts* and lets *flush*
+    # write them out once there are enough of them
+    if isinstance(obj, dict):
+        parts.append('{')
+        first = True
+        for key, value in obj.iteritems():
+            if not first:
+                parts.append(',')
+            first = False
+            parts.append(dumps(key, True))
+            parts.append(':')
+            _dump(value, parts, flush)
+        parts.append('}')
+    elif isinstance(obj, (tuple, list, set)):
+        parts.append('[')
+        first = True
+        for value in obj:
+            if not first:
+                parts.append(',')
+            first = False
+            _dump(value, parts, flush)
+        parts.append(']')
+    else:
+        parts.append(dumps(obj))
+    if len(parts) > 4096:
+        flush()
+
 def dump(obj, f):
-    f.write(dumps(obj))
+    """Write the serialization of *obj* to the file *f*, in pieces instead of
+    building it as one string.
+    """
+    parts = []
+    def flush():
+        f.write(''.join(parts))
+        del parts[:]
+    _dump(obj, parts, flush)
+    flush()
 
 
 def loads(x):
@@ -16,6 +16,11 @@ import time
 import errno
 import shutil
 from os import path
+try:
+    from hashlib import md5
+except ImportError:
+    # 2.4 compatibility
+    from md5 import md5
 
 # Errnos that we need.
 EEXIST = getattr(errno, 'EEXIST', 0)
@@ -102,6 +107,42 @@ def mtimes_of_files(dirnames, suffix):
                         pass
 
 
+def file_digest(filename):
+    """Return the MD5 hex digest of the contents of *filename*."""
+    digest = md5()
+    f = open(filename, 'rb')
+    try:
+        while True:
+            data = f.read(65536)
+            if not data:
+                break
+            digest.update(data)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def digest_of_files(dirnames, suffix):
+    """Return an MD5 hex digest of the relative names and the contents of all
+    files with the given *suffix* in *dirnames*.
+    """
+    digest = md5()
+    for dirname in dirnames:
+        for root, dirs, files in os.walk(dirname):
+            dirs.sort()
+            for sfile in sorted(files):
+                if sfile.endswith(suffix):
+                    filename = path.join(root, sfile)
+                    try:
+                        filedigest = file_digest(filename)
+                    except EnvironmentError:
+                        continue
+                    relname = filename[len(dirname):]
+                    digest.update(('%r %s\n' % (relname, filedigest))
+                                  .encode('utf-8'))
+    return digest.hexdigest()
+
+
 def movefile(source, dest):
     """Move a file, removing the destination if it exists."""
     if os.path.exists(dest):
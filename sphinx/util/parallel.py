@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx.util.parallel
+    ~~~~~~~~~~~~~~~~~~~~
+
+    Parallel building utilities.
+
+    :copyright: Copyright 2007-2011 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+import errno
+import select
+import threading
+import traceback
+from collections import deque
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+from sphinx.errors import SphinxParallelError
+
+# our parallel functionality only works for the forking Process
+parallel_available = multiprocessing and (os.name == 'posix')
+
+
+class ParallelTasks(object):
+    """Executes *nproc* tasks in parallel after forking.
+
+    Results are handed to the *result_func* of each task in the order the
+    tasks were added, regardless of the order in which the worker processes
+    finish, so that merging results is deterministic.
+    """
+
+    def __init__(self, nproc):
+        self.nproc = nproc
+        # task id -> (process, receiving end of its pipe)
+        self._running = {}
+        # task id -> result_func
+        self._result_funcs = {}
+        # task id -> result, for finished tasks waiting for their turn
+        self._finished = {}
+        # next task id to hand out, and next one to deliver results for
+        self._taskid = 0
+        self._nextid = 0
+
+    def _process(self, pipe, func, arg):
+        try:
+            if arg is None:
+                ret = func()
+            else:
+                ret = func(arg)
+            pipe.send((False, ret))
+        except BaseException, err:
+            pipe.send((True, (err, traceback.format_exc())))
+
+    def add_task(self, task_func, arg=None, result_func=None):
+        # wait for a free worker slot before starting a new process
+        while len(self._running) >= self.nproc:
+            self._join_one()
+        tid = self._taskid
+        self._taskid += 1
+        self._result_funcs[tid] = result_func or (lambda arg: None)
+        precv, psend = multiprocessing.Pipe(False)
+        proc = multiprocessing.Process(target=self._process,
+                                       args=(psend, task_func, arg))
+        self._running[tid] = (proc, precv)
+        proc.start()
+        # only the child may keep the sending end open: then the pipe of a
+        # child that exits without sending a result is at EOF
+        psend.close()
+        self._deliver()
+
+    def join(self):
+        while self._running:
+            self._join_one()
+        self._deliver()
+
+    def _join_one(self):
+        # wait for a child to send its result or to exit, and receive before
+        # joining: a full pipe would block the child forever
+        fds = dict((precv.fileno(), tid)
+                   for (tid, (proc, precv)) in self._running.iteritems())
+        while True:
+            try:
+                ready = select.select(list(fds), [], [])[0]
+                break
+            except select.error, err:
+                if err.args[0] != errno.EINTR:
+                    raise
+        tid = min([fds[fd] for fd in ready])
+        proc, precv = self._running.pop(tid)
+        try:
+            exc, result = precv.recv()
+        except EOFError:
+            precv.close()
+            proc.join()
+            raise SphinxParallelError(
+                RuntimeError('worker process exited with code %s' %
+                             proc.exitcode), '')
+        precv.close()
+        proc.join()
+        if exc:
+            raise SphinxParallelError(*result)
+        self._finished[tid] = result
+        self._deliver()
+
+    def _deliver(self):
+        while self._nextid in self._finished:
+            result = self._finished.pop(self._nextid)
+            self._result_funcs.pop(self._nextid)(result)
+            self._nextid += 1
+
+
+class BackgroundTasks(object):
+    """Executes tasks in up to *nthreads* threads in the background, e.g. to
+    wait for several external programs at once.
+
+    Every task has a key with which its completion can be waited for.  The
+    results of the tasks and their exceptions are discarded: tasks must leave
+    their results e.g. in files, and the caller must detect failed tasks.
+    """
+
+    def __init__(self, nthreads):
+        self.nthreads = nthreads
+        self._cond = threading.Condition()
+        # (key, func, args) of the tasks not started yet
+        self._queue = deque()
+        # keys of the tasks not finished yet
+        self._pending = set()
+        self._nrunning = 0
+
+    def add_task(self, key, task_func, *args):
+        """Start ``task_func(*args)`` as task *key*, unless a task with that key
+        is already pending.
+        """
+        self._cond.acquire()
+        try:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            self._queue.append((key, task_func, args))
+            if self._nrunning < self.nthreads:
+                self._nrunning += 1
+                thread = threading.Thread(target=self._run)
+                thread.setDaemon(True)
+                thread.start()
+        finally:
+            self._cond.release()
+
+    def _run(self):
+        while True:
+            self._cond.acquire()
+            try:
+                if not self._queue:
+                    self._nrunning -= 1
+                    return
+                key, task_func, args = self._queue.popleft()
+            finally:
+                self._cond.release()
+            try:
+                task_func(*args)
+            except Exception:
+                pass
+            self._cond.acquire()
+            try:
+                self._pending.discard(key)
+                self._cond.notifyAll()
+            finally:
+                self._cond.release()
+
+    def wait(self, key=None):
+        """Wait until the task *key*, or all tasks if it is None, finished."""
+        self._cond.acquire()
+        try:
+            while (key is None and self._pending) or key in self._pending:
+                self._cond.wait()
+        finally:
+            self._cond.release()
+
+
+def make_chunks(arguments, nproc, maxbatch=10):
+    """Partition *arguments* into chunks to be processed by one task each."""
+    nargs = len(arguments)
+    chunksize = min(nargs // nproc, maxbatch)
+    if chunksize == 0:
+        chunksize = 1
+    nchunks, rest = divmod(nargs, chunksize)
+    if rest:
+        nchunks += 1
+    return [arguments[i*chunksize:(i+1)*chunksize] for i in range(nchunks)]
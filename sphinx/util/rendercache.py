@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -*-
+"""
+    sphinx.util.rendercache
+    ~~~~~~~~~~~~~~~~~~~~~~~
+
+    Running external programs that render files, and a cache of the files
+    shared between builders and output directories.
+
+    :copyright: Copyright 2007-2011 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+import time
+import shutil
+import cPickle as pickle
+from os import path
+from subprocess import Popen, PIPE
+try:
+    from hashlib import sha1 as sha
+except ImportError:
+    from sha import sha
+
+from sphinx.util.osutil import ensuredir, movefile
+from sphinx.util.parallel import BackgroundTasks
+
+
+# program command line -> version output
+_tool_versions = {}
+
+def tool_version(args):
+    """Return the output of the program invocation *args* (which should make
+    the program print its version), or an empty string if it cannot be run.
+    The output is remembered for the rest of the process.
+    """
+    args = tuple(args)
+    if args not in _tool_versions:
+        try:
+            p = Popen(args, stdout=PIPE, stderr=PIPE)
+            stdout, stderr = p.communicate()
+            _tool_versions[args] = stdout + stderr
+        except OSError:
+            _tool_versions[args] = ''
+    return _tool_versions[args]
+
+
+def digest(*parts):
+    """Return a digest of the strings *parts*."""
+    hash = sha()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        hash.update(str(len(part)) + ':' + part)
+    return hash.hexdigest()
+
+
+def link_or_copy(source, dest):
+    """Hard-link *source* to *dest* if possible, else copy it."""
+    tmpdest = dest + '.tmp'
+    if path.exists(tmpdest):
+        os.unlink(tmpdest)
+    if hasattr(os, 'link'):
+        try:
+            os.link(source, tmpdest)
+        except OSError:
+            # e.g. different file systems
+            shutil.copyfile(source, tmpdest)
+    else:
+        shutil.copyfile(source, tmpdest)
+    movefile(tmpdest, dest)
+
+
+class RenderCache(object):
+    """
+    A directory of the output files of external programs such as ``dot`` or
+    ``latex``, addressed by a digest of everything that influenced them.
+    Unlike the output directories, it can be shared between builders and
+    projects.  When its total size exceeds *maxsize* bytes, the least
+    recently used files are removed.
+    """
+
+    def __init__(self, dirname, maxsize):
+        self.dirname = dirname
+        self.maxsize = maxsize
+        # total size of the files, computed on the first store()
+        self.size = None
+
+    def key(self, *parts):
+        """Return the key for the inputs *parts* (strings)."""
+        return digest(*parts)
+
+    def _filename(self, key, outfn):
+        # the extension distinguishes the files stored for a key
+        return path.join(self.dirname, key + path.splitext(outfn)[1])
+
+    def fetch(self, key, outfns):
+        """Put the files stored for *key* in place as *outfns*.  Return false
+        if they are not all in the cache.
+        """
+        cachefns = [self._filename(key, outfn) for outfn in outfns]
+        for cachefn in cachefns:
+            if not path.isfile(cachefn):
+                return False
+        try:
+            now = time.time()
+            for cachefn, outfn in zip(cachefns, outfns):
+                ensuredir(path.dirname(outfn))
+                link_or_copy(cachefn, outfn)
+                # the modification time marks the files as recently used
+                os.utime(cachefn, (now, now))
+        except (IOError, OSError):
+            return False
+        return True
+
+    def store(self, key, outfns):
+        """Store the rendered files *outfns* for *key*."""
+        try:
+            ensuredir(self.dirname)
+            for outfn in outfns:
+                cachefn = self._filename(key, outfn)
+                link_or_copy(outfn, cachefn)
+                if self.size is not None:
+                    self.size += path.getsize(cachefn)
+        except (IOError, OSError):
+            # the cache is only an optimization
+            return
+        if self.size is None or self.size > self.maxsize:
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used files until the cache is not larger
+        than its maximum size.
+        """
+        files = []
+        self.size = 0
+        for fn in os.listdir(self.dirname):
+            fn = path.join(self.dirname, fn)
+            try:
+                st = os.stat(fn)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, fn))
+            self.size += st.st_size
+        files.sort()
+        for mtime, size, fn in files:
+            if self.size <= self.maxsize:
+                break
+            try:
+                os.unlink(fn)
+            except OSError:
+                continue
+            self.size -= size
+
+
+class StringCache(object):
+    """
+    Strings computed by a builder, e.g. highlighted code blocks, addressed by
+    a digest of their inputs like in the :class:`RenderCache`.  They are kept
+    in the single pickle file *filename*, which is read when the cache is
+    created and written by :meth:`save`.  Only the strings used since then
+    are saved, so that the file stays as large as one build needs.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._stored = {}
+        try:
+            f = open(filename, 'rb')
+            try:
+                self._stored = pickle.load(f)
+            finally:
+                f.close()
+        except Exception:
+            # missing or unreadable: start with an empty cache
+            pass
+        # keys of the stored strings that were used, and the new strings
+        self._used = set()
+        self._added = {}
+
+    def key(self, *parts):
+        """Return the key for the inputs *parts* (strings)."""
+        return digest(*parts)
+
+    def get(self, key):
+        """Return the string stored for *key*, or None."""
+        data = self._added.get(key)
+        if data is None:
+            data = self._stored.get(key)
+            if data is not None:
+                self._used.add(key)
+        return data
+
+    def put(self, key, data):
+        """Store the string *data* for *key*."""
+        self._added[key] = data
+
+    def new_fragment(self):
+        """Forget the use of the cache so far, e.g. in a worker process that
+        will return its use with :meth:`get_fragment`.
+        """
+        self._used = set()
+        self._added = {}
+
+    def get_fragment(self):
+        """Return the (picklable) use of the cache since it was created or
+        :meth:`new_fragment` was called.
+        """
+        return self._used, self._added
+
+    def merge_fragment(self, fragment):
+        """Merge the use of the cache in a worker process."""
+        used, added = fragment
+        self._used.update(used)
+        self._added.update(added)
+
+    def save(self):
+        """Write the used and new strings to the file, if they differ from
+        what it contains.
+        """
+        if not self._added and len(self._used) == len(self._stored):
+            return
+        entries = dict([(key, self._stored[key]) for key in self._used])
+        entries.update(self._added)
+        tmpfn = '%s.%d.tmp' % (self.filename, os.getpid())
+        try:
+            ensuredir(path.dirname(self.filename))
+            f = open(tmpfn, 'wb')
+            try:
+                pickle.dump(entries, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            movefile(tmpfn, self.filename)
+        except (IOError, OSError):
+            # the cache is only an optimization
+            return
+        self._stored = entries
+        self._used = set(entries)
+        self._added = {}
+
+
+def get_render_cache(builder):
+    """Return the render cache configured for *builder*, or None if it is
+    switched off.
+    """
+    if not hasattr(builder, '_render_cache'):
+        config = builder.config
+        if not config.render_cache_size:
+            builder._render_cache = None
+        else:
+            dirname = config.render_cache_dir
+            if dirname is None:
+                dirname = path.join(builder.doctreedir, 'render')
+            else:
+                dirname = path.join(builder.confdir, dirname)
+            builder._render_cache = RenderCache(
+                dirname, config.render_cache_size * 1024 * 1024)
+    return builder._render_cache
+
+
+def get_string_cache(builder, name):
+    """Return the :class:`StringCache` of *builder* for the strings called
+    *name*, or None if the caches are switched off.
+    """
+    if not hasattr(builder, '_string_caches'):
+        builder._string_caches = {}
+    caches = builder._string_caches
+    if name not in caches:
+        if not builder.config.render_cache_size:
+            caches[name] = None
+        else:
+            caches[name] = StringCache(
+                path.join(builder.doctreedir, name + '.pickle'))
+    return caches[name]
+
+
+def save_string_caches(builder):
+    """Save the string caches *builder* used."""
+    for cache in getattr(builder, '_string_caches', {}).itervalues():
+        if cache is not None:
+            cache.save()
+
+
+def get_render_tasks(builder):
+    """Return the tasks running external programs in the background for
+    *builder*, or None if they are to be run one at a time.
+    """
+    if not hasattr(builder, '_render_tasks'):
+        nthreads = builder.config.render_workers
+        if nthreads is None:
+            nthreads = cpu_count()
+        if nthreads > 1:
+            builder._render_tasks = BackgroundTasks(nthreads)
+        else:
+            builder._render_tasks = None
+    return builder._render_tasks
+
+
+def wait_for_render(builder, key=None):
+    """Wait until the background task *key* of *builder*, or all of them,
+    finished.
+    """
+    tasks = getattr(builder, '_render_tasks', None)
+    if tasks is not None:
+        tasks.wait(key)
+
+
+def track_node_documents(app, attrname, condition):
+    """Keep the names of the documents containing nodes matching *condition*
+    (a node class or a callable as for ``traverse()``) in the set
+    ``env.<attrname>``, so that :func:`get_node_doctrees` needn't load every
+    doctree to find the things to render before writing.
+    """
+    def doctree_read(app, doctree):
+        for node in doctree.traverse(condition):
+            if not hasattr(app.env, attrname):
+                setattr(app.env, attrname, set())
+            getattr(app.env, attrname).add(app.env.docname)
+            break
+    def purge_doc(app, env, docname):
+        getattr(env, attrname, set()).discard(docname)
+    def merge_info(app, env, docnames, other):
+        if not hasattr(other, attrname):
+            return
+        if not hasattr(env, attrname):
+            setattr(env, attrname, set())
+        getattr(env, attrname).update(getattr(other, attrname))
+    app.connect('doctree-read', doctree_read)
+    app.connect('env-purge-doc', purge_doc)
+    app.connect('env-merge-info', merge_info)
+
+
+def get_node_doctrees(env, attrname, docnames):
+    """Return the (unresolved) doctrees of the documents in *docnames* noted
+    by :func:`track_node_documents` under *attrname*.
+    """
+    docs = getattr(env, attrname, set()).intersection(docnames)
+    return [env.get_doctree(docname) for docname in sorted(docs)]
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
@@ -10,9 +10,10 @@
     :license: BSD, see LICENSE for details.
 """
 from uuid import uuid4
-from operator import itemgetter
+from math import ceil
+from difflib import SequenceMatcher
 
-from sphinx.util.pycompat import product, zip_longest, all
+from sphinx.util.pycompat import all
 
 
 # anything below that ratio is considered equal/changed
@@ -44,84 +45,126 @@ def merge_doctrees(old, new, condition):
     :param condition:
         A callable which returns either ``True`` or ``False`` for a given node.
     """
-    old_iter = old.traverse(condition)
-    new_iter = new.traverse(condition)
-    old_nodes = []
-    new_nodes = []
-    ratios = {}
-    seen = set()
-    # compare the nodes each doctree in order
-    for old_node, new_node in zip_longest(old_iter, new_iter):
-        if old_node is None:
-            new_nodes.append(new_node)
+    old_nodes = list(old.traverse(condition))
+    new_nodes = list(new.traverse(condition))
+    # align the sequences of node texts: the nodes of equal runs keep their
+    # uids, the other old nodes are candidates for the other new nodes
+    matcher = SequenceMatcher(None, [node.rawsource for node in old_nodes],
+                              [node.rawsource for node in new_nodes])
+    candidates = []
+    # (new node, old node at the same place or None)
+    unmatched = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            for old_node, new_node in zip(old_nodes[i1:i2], new_nodes[j1:j2]):
+                if new_node.rawsource:
+                    new_node.uid = old_node.uid
+                else:
+                    # empty nodes are never considered equal
+                    unmatched.append((new_node, None))
             continue
-        if new_node is None:
-            old_nodes.append(old_node)
-            continue
-        ratio = get_ratio(old_node.rawsource, new_node.rawsource)
-        if ratio == 0:
-            new_node.uid = old_node.uid
-            seen.add(new_node)
-        else:
-            ratios[old_node, new_node] = ratio
-            old_nodes.append(old_node)
-            new_nodes.append(new_node)
-    # calculate the ratios for each unequal pair of nodes, should we stumble
-    # on a pair which is equal we set the uid and add it to the seen ones
-    for old_node, new_node in product(old_nodes, new_nodes):
-        if new_node in seen or (old_node, new_node) in ratios:
-            continue
-        ratio = get_ratio(old_node.rawsource, new_node.rawsource)
-        if ratio == 0:
-            new_node.uid = old_node.uid
-            seen.add(new_node)
-        else:
-            ratios[old_node, new_node] = ratio
-    # choose the old node with the best ratio for each new node and set the uid
-    # as long as the ratio is under a certain value, in which case we consider
+        candidates.extend(old_nodes[i1:i2])
+        for j in range(j1, j2):
+            aligned = None
+            if i1 + j - j1 < i2:
+                aligned = old_nodes[i1 + j - j1]
+            unmatched.append((new_nodes[j], aligned))
+    # nodes that were moved keep their uid as well
+    by_source = {}
+    for old_node in candidates:
+        if old_node.rawsource:
+            by_source.setdefault(old_node.rawsource, old_node)
+    # for the other new nodes, choose the old node with the best ratio, trying
+    # the aligned node first so that the others can be dismissed early, as
+    # long as the ratio is under a certain value, in which case we consider
     # them not changed but different
-    ratios = sorted(ratios.iteritems(), key=itemgetter(1))
-    for (old_node, new_node), ratio in ratios:
-        if new_node in seen:
+    for new_node, aligned in unmatched:
+        if new_node.rawsource in by_source:
+            new_node.uid = by_source[new_node.rawsource].uid
             continue
+        best_node = None
+        best_ratio = VERSIONING_RATIO
+        if aligned is not None:
+            order = [aligned] + [node for node in candidates
+                                 if node is not aligned]
         else:
-            seen.add(new_node)
-        if ratio < VERSIONING_RATIO:
-            new_node.uid = old_node.uid
+            order = candidates
+        for old_node in order:
+            ratio = get_ratio(old_node.rawsource, new_node.rawsource,
+                              best_ratio)
+            if ratio < best_ratio:
+                best_node, best_ratio = old_node, ratio
+        if best_node is not None:
+            new_node.uid = best_node.uid
         else:
             new_node.uid = uuid4().hex
             yield new_node
-    # create new uuids for any new node we left out earlier, this happens
-    # if one or more nodes are simply added.
-    for new_node in set(new_nodes) - seen:
-        new_node.uid = uuid4().hex
-        yield new_node
 
 
-def get_ratio(old, new):
+def get_ratio(old, new, limit=None):
     """Return a "similiarity ratio" (in percent) representing the similarity
     between the two strings where 0 is equal and anything above less than equal.
+
+    If *limit* is given, the computation is cut short as soon as the ratio is
+    known not to be below *limit*, which is returned in that case.
     """
     if not all([old, new]):
         return VERSIONING_RATIO
-    return levenshtein_distance(old, new) / (len(old) / 100.0)
-
-
-def levenshtein_distance(a, b):
-    """Return the Levenshtein edit distance between two strings *a* and *b*."""
+    if limit is None:
+        return levenshtein_distance(old, new) / (len(old) / 100.0)
+    # the largest distance that gives a ratio below the limit
+    maxdist = int(ceil(limit * len(old) / 100.0)) - 1
+    if maxdist < 0:
+        return limit
+    ratio = levenshtein_distance(old, new, maxdist) / (len(old) / 100.0)
+    if ratio < limit:
+        return ratio
+    return limit
+
+
+def levenshtein_distance(a, b, maxdist=None):
+    """Return the Levenshtein edit distance between two strings *a* and *b*.
+
+    If *maxdist* is given, distances larger than it are not computed, and
+    ``maxdist + 1`` is returned for them instead.
+    """
     if a == b:
         return 0
     if len(a) < len(b):
         a, b = b, a
     if not a:
         return len(b)
-    previous_row = xrange(len(b) + 1)
+    if maxdist is None:
+        previous_row = xrange(len(b) + 1)
+        for i, column1 in enumerate(a):
+            current_row = [i + 1]
+            for j, column2 in enumerate(b):
+                insertions = previous_row[j + 1] + 1
+                deletions = current_row[j] + 1
+                substitutions = previous_row[j] + (column1 != column2)
+                current_row.append(min(insertions, deletions, substitutions))
+            previous_row = current_row
+        return previous_row[-1]
+
+    # only the cells at most maxdist away from the diagonal can have a value
+    # up to maxdist; all other values are capped to maxdist + 1
+    toobig = maxdist + 1
+    lenb = len(b)
+    if len(a) - lenb > maxdist:
+        return toobig
+    previous_row = [min(j, toobig) for j in xrange(lenb + 1)]
     for i, column1 in enumerate(a):
-        current_row = [i + 1]
-        for j, column2 in enumerate(b):
-            insertions = previous_row[j + 1] + 1
-            deletions = current_row[j] + 1
-            substitutions = previous_row[j] + (column1 != column2)
-            current_row.append(min(insertions, deletions, substitutions))
+        current_row = [toobig] * (lenb + 1)
+        current_row[0] = rowmin = min(i + 1, toobig)
+        for j in xrange(max(1, i + 1 - maxdist),
+                        min(lenb, i + 1 + maxdist) + 1):
+            value = min(previous_row[j] + 1, current_row[j - 1] + 1,
+                        previous_row[j - 1] + (column1 != b[j - 1]), toobig)
+            current_row[j] = value
+            if value < rowmin:
+                rowmin = value
+        if rowmin >= toobig:
+            # the distance can only grow from here
+            return toobig
         previous_row = current_row
     return previous_row[-1]
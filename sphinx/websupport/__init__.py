@@ -9,9 +9,11 @@
     :license: BSD, see LICENSE for details.
 """
 
+import os
 import sys
 import cPickle as pickle
 import posixpath
+import threading
 from os import path
 
 from jinja2 import Environment, FileSystemLoader
@@ -19,6 +21,7 @@ from jinja2 import Environment, FileSystemLoader
 from docutils.core import publish_parts
 
 from sphinx.application import Sphinx
+from sphinx.util import LRUCache
 from sphinx.util.osutil import ensuredir
 from sphinx.util.jsonimpl import dumps as dump_json
 from sphinx.util.pycompat import htmlescape
@@ -45,6 +48,7 @@ class WebSupport(object):
                  allow_anonymous_comments=True,
                  docroot='',
                  staticroot='static',
+                 cache_size=100,  # number of documents kept in memory
                  ):
         # directories
         self.srcdir = srcdir
@@ -68,6 +72,14 @@ class WebSupport(object):
 
         self._globalcontext = None
 
+        # loaded documents and comment metadata; the documents are checked
+        # against the modification time of their pickle for every request
+        self._cache_lock = threading.Lock()
+        # docname -> (pickle filename, docname, mtime, document)
+        self._document_cache = LRUCache(cache_size, sizefunc=lambda v: 1)
+        # (docname, moderator) -> metadata
+        self._metadata_cache = LRUCache(cache_size, sizefunc=lambda v: 1)
+
         self._make_base_comment_options()
 
     def _init_storage(self, storage):
@@ -125,6 +137,7 @@ class WebSupport(object):
         self.storage.pre_build()
         app.build()
         self.storage.post_build()
+        self._clear_caches()
 
     def get_globalcontext(self):
         """Load and return the "global context" pickle."""
@@ -174,13 +187,41 @@ class WebSupport(object):
 
         :param docname: the name of the document to load.
         """
+        infilename, docname, document = self._load_document(docname)
+        metadata = self._get_cached(self._metadata_cache,
+                                    (docname, moderator))
+        if metadata is None:
+            metadata = self.storage.get_metadata(docname, moderator)
+            self._set_cached(self._metadata_cache, (docname, moderator),
+                             metadata)
+
+        comment_opts = self._make_comment_options(username, moderator)
+        comment_meta = self._make_metadata(metadata)
+
+        document = document.copy()
+        document['script'] = comment_opts + comment_meta + document['script']
+        return document
+
+    def _load_document(self, docname):
+        """Return the pickle filename, the full docname and the unpickled
+        document for *docname*, from the cache if its pickle did not change.
+        """
+        cached = self._get_cached(self._document_cache, docname)
+        if cached is not None:
+            infilename, fulldocname, mtime, document = cached
+            try:
+                if os.stat(infilename).st_mtime == mtime:
+                    return infilename, fulldocname, document
+            except OSError:
+                pass
+        fulldocname = docname
         docpath = path.join(self.datadir, 'pickles', docname)
         if path.isdir(docpath):
             infilename = docpath + '/index.fpickle'
             if not docname:
-                docname = 'index'
+                fulldocname = 'index'
             else:
-                docname += '/index'
+                fulldocname += '/index'
         else:
             infilename = docpath + '.fpickle'
 
@@ -188,18 +229,41 @@ class WebSupport(object):
             f = open(infilename, 'rb')
         except IOError:
             raise errors.DocumentNotFoundError(
-                'The document "%s" could not be found' % docname)
+                'The document "%s" could not be found' % fulldocname)
         try:
+            mtime = os.fstat(f.fileno()).st_mtime
             document = pickle.load(f)
         finally:
             f.close()
+        self._set_cached(self._document_cache, docname,
+                         (infilename, fulldocname, mtime, document))
+        return infilename, fulldocname, document
 
-        comment_opts = self._make_comment_options(username, moderator)
-        comment_meta = self._make_metadata(
-            self.storage.get_metadata(docname, moderator))
+    def _get_cached(self, cache, key):
+        self._cache_lock.acquire()
+        try:
+            return cache.get(key)
+        finally:
+            self._cache_lock.release()
 
-        document['script'] = comment_opts + comment_meta + document['script']
-        return document
+    def _set_cached(self, cache, key, value):
+        self._cache_lock.acquire()
+        try:
+            cache[key] = value
+        finally:
+            self._cache_lock.release()
+
+    def _clear_caches(self, documents=True):
+        """Forget the cached comment metadata, and the cached documents if
+        *documents* is true.
+        """
+        self._cache_lock.acquire()
+        try:
+            self._metadata_cache.clear()
+            if documents:
+                self._document_cache.clear()
+        finally:
+            self._cache_lock.release()
 
     def get_search_results(self, q):
         """Perform a search for the query `q`, and create a set
@@ -287,7 +351,10 @@ class WebSupport(object):
         :param username: the username requesting the deletion.
         :param moderator: whether the requestor is a moderator.
         """
-        return self.storage.delete_comment(comment_id, username, moderator)
+        try:
+            return self.storage.delete_comment(comment_id, username, moderator)
+        finally:
+            self._clear_caches(documents=False)
 
     def add_comment(self, text, node_id='', parent_id='', displayed=True,
                     username=None, time=None, proposal=None,
@@ -325,6 +392,7 @@ class WebSupport(object):
         comment = self.storage.add_comment(parsed, displayed, username,
                                            time, proposal, node_id,
                                            parent_id, moderator)
+        self._clear_caches(documents=False)
         comment['original_text'] = text
         if not displayed and self.moderation_callback:
             self.moderation_callback(comment)
@@ -383,6 +451,7 @@ class WebSupport(object):
         if not moderator:
             raise errors.UserNotAuthorizedError()
         self.storage.accept_comment(comment_id)
+        self._clear_caches(documents=False)
 
     def _make_base_comment_options(self):
         """Helper method to create the part of the COMMENT_OPTIONS javascript
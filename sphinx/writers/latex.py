@@ -26,6 +26,7 @@ from sphinx.locale import admonitionlabels, versionlabels, _
 from sphinx.util import split_into
 from sphinx.util.osutil import ustrftime
 from sphinx.util.pycompat import any
+from sphinx.util.rendercache import get_string_cache
 from sphinx.util.texescape import tex_escape_map, tex_replace_map
 from sphinx.util.smartypants import educate_quotes_latex
 
@@ -222,7 +223,8 @@ class LaTeXTranslator(nodes.NodeVisitor):
                                              self.elements['extraclassoptions']
 
         self.highlighter = highlighting.PygmentsBridge('latex',
-            builder.config.pygments_style, builder.config.trim_doctest_flags)
+            builder.config.pygments_style, builder.config.trim_doctest_flags,
+            get_string_cache(builder, 'highlight-latex'))
         self.context = []
         self.descstack = []
         self.bibitems = []
@@ -2,3 +2,4 @@
 
 def setup(app):
     app.add_config_value('value_from_ext', [], False)
+    return {'parallel_read_safe': True}
@@ -21,6 +21,7 @@ except ImportError:
     pygments = None
 
 from sphinx import __version__
+from sphinx.util.parallel import parallel_available
 from util import *
 from etree13 import ElementTree as ET
 
@@ -338,3 +339,31 @@ def test_html(app):
             yield check_xpath, etree, fname, path, check
 
     check_static_entries(app.builder.outdir)
+
+@skip_unless(parallel_available, 'parallel writing is not available')
+@with_tempdir
+def test_parallel_write(tempdir):
+    # build the test root itself: copies of it would import its modules from
+    # a temporary directory for the rest of the test run
+    sapp = TestApp(buildername='html', warning=StringIO(), freshenv=True,
+                   outdir=tempdir / 'serial',
+                   doctreedir=tempdir / 'serial-doctrees')
+    papp = TestApp(buildername='html', warning=StringIO(), freshenv=True,
+                   outdir=tempdir / 'parallel',
+                   doctreedir=tempdir / 'parallel-doctrees', parallel=2)
+    try:
+        assert papp.builder.parallel_ok
+        sapp.builder.build_all()
+        papp.builder.build_all()
+        # the unique image names depend on the order of reading
+        assert set(papp.builder.images) == set(sapp.builder.images)
+        for fname in papp.builder.images.itervalues():
+            assert (papp.outdir / '_images' / fname).isfile()
+        for docname in sapp.env.all_docs:
+            assert (papp.outdir / (docname + '.html')).isfile()
+        sindexer, pindexer = sapp.builder.indexer, papp.builder.indexer
+        assert pindexer._titles == sindexer._titles
+        assert pindexer._mapping == sindexer._mapping
+    finally:
+        sapp.cleanup()
+        papp.cleanup()
@@ -14,6 +14,8 @@ import StringIO
 
 from util import *
 
+from sphinx.util.parallel import parallel_available
+
 status = StringIO.StringIO()
 cleanup_called = 0
 
@@ -32,3 +34,74 @@ def test_build(app):
 def cleanup_call():
     global cleanup_called
     cleanup_called += 1
+
+
+def make_project(tempdir, **conf):
+    conf['extensions'] = ['sphinx.ext.doctest']
+    (tempdir / 'conf.py').write_text(''.join(['%s = %r\n' % item
+                                              for item in conf.items()]))
+    docnames = ['doc%d' % i for i in range(8)]
+    (tempdir / 'contents.rst').write_text(
+        'Contents\n========\n\n.. toctree::\n\n' +
+        ''.join(['   %s\n' % docname for docname in docnames]))
+    for i, docname in enumerate(docnames):
+        # the tests of the fourth document fail
+        (tempdir / (docname + '.rst')).write_text('''\
+Document %d
+===========
+
+.. doctest::
+
+   >>> x = %d
+   >>> x * 2
+   %d
+
+.. doctest:: other
+
+   >>> x
+   Traceback (most recent call last):
+     ...
+   NameError: name 'x' is not defined
+''' % (i, i, i == 3 and 7 or i * 2))
+
+
+def build_doctest(tempdir, parallel):
+    app = TestApp(srcdir=tempdir, buildername='doctest', parallel=parallel,
+                  status=StringIO.StringIO())
+    app.builder.build_all()
+    output = (app.outdir / 'output.txt').text()
+    # strip the date
+    return app, output.split('\n', 2)[2]
+
+
+@skip_unless(parallel_available, 'parallel testing is not available')
+@with_tempdir
+def test_parallel(tempdir):
+    make_project(tempdir)
+    sapp, soutput = build_doctest(tempdir, 1)
+    papp, poutput = build_doctest(tempdir, 2)
+    assert papp.builder.parallel_ok
+    # the results are the same, and in the same order
+    assert poutput == soutput
+    assert '   24 tests\n    1 failure in tests\n' in poutput
+    assert poutput.index('Document: doc2') < poutput.index('Document: doc5')
+    assert papp.statuscode == sapp.statuscode == 1
+
+
+@with_tempdir
+def test_fail_fast(tempdir):
+    make_project(tempdir, doctest_fail_fast=True)
+    sapp, soutput = build_doctest(tempdir, 1)
+    assert 'Document: doc3' in soutput
+    assert 'Document: doc4' not in soutput
+    assert '   12 tests\n    1 failure in tests\n' in soutput
+    assert sapp.statuscode == 1
+
+
+@skip_unless(parallel_available, 'parallel testing is not available')
+@with_tempdir
+def test_fail_fast_parallel(tempdir):
+    make_project(tempdir, doctest_fail_fast=True)
+    sapp, soutput = build_doctest(tempdir, 1)
+    papp, poutput = build_doctest(tempdir, 2)
+    assert poutput == soutput
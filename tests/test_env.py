@@ -8,12 +8,15 @@
     :copyright: Copyright 2007-2011 by the Sphinx team, see AUTHORS.
     :license: BSD, see LICENSE for details.
 """
+import os
 import sys
 
 from util import *
 
 from sphinx.builders.html import StandaloneHTMLBuilder
 from sphinx.builders.latex import LaTeXBuilder
+from sphinx.errors import SphinxError
+from sphinx.util.parallel import parallel_available
 
 app = env = None
 warnings = []
@@ -118,3 +121,296 @@ def test_object_inventory():
 
     assert env.domains['py'].data is env.domaindata['py']
     assert env.domains['c'].data is env.domaindata['c']
+
+    # fuzzy searching finds the same objects as scanning all of them
+    pydomain = env.domains['py']
+    for name in ('meth1', 'Cls.meth2', 'func_in_module', 'Error', 'nothing'):
+        expected = sorted(oname for oname in refs
+                          if oname.endswith('.' + name))
+        matches = pydomain.find_obj(env, None, None, name, 'obj', 1)
+        assert [match[0] for match in matches] == expected
+    assert pydomain.find_obj(env, None, None, 'meths', 'meth', 1) == \
+        [('mod.Cls.meths', ('objects', 'staticmethod'))]
+    # the index follows documents being removed and read again
+    modules = env.domaindata['py']['modules']
+    saved = dict((oname, refs[oname]) for oname in refs.keys_for_doc('objects'))
+    savedmods = dict((modname, modules[modname])
+                     for modname in modules.keys_for_doc('objects'))
+    pydomain.clear_doc('objects')
+    assert not pydomain.find_obj(env, None, None, 'meth1', 'meth', 1)
+    refs.update(saved)
+    modules.update(savedmods)
+    pydomain.process_doc(env, 'objects', None)
+    assert pydomain.find_obj(env, None, None, 'meth1', 'meth', 1) == \
+        [('mod.Cls.meth1', ('objects', 'method'))]
+
+def test_global_toctree():
+    from sphinx import addnodes
+    builder = StandaloneHTMLBuilder(app)
+    master = env.get_doctree('contents')
+    for docname in ['contents', 'images', 'subdir/images']:
+        for collapse in (True, False):
+            # must be the same as resolving the master's toctree directly
+            expected = env.resolve_toctree(
+                docname, builder, master.traverse(addnodes.toctree)[0],
+                collapse=collapse, includehidden=True)
+            toctree = env.get_toctree_for(docname, builder, collapse)
+            assert toctree.pformat() == expected.pformat()
+    # the collected entries are cached, results are not shared
+    assert len(env._global_toctrees) == 1
+    assert env.get_toctree_for('images', builder, True) is not \
+        env.get_toctree_for('images', builder, True)
+
+def test_doctree_cache():
+    from sphinx.util import LRUCache
+    cache = LRUCache(maxentries=2, maxsize=10)
+    cache['a'] = 'aaa'
+    cache['b'] = 'bbb'
+    assert cache.get('a') == 'aaa'
+    cache['c'] = 'ccc'
+    # 'b' was least recently used
+    assert 'b' not in cache and 'a' in cache and 'c' in cache
+    cache['d'] = 'dddddd'
+    assert 'a' not in cache and len(cache) == 2 and cache.size == 9
+    cache['e'] = 'e' * 11
+    assert 'e' not in cache
+    # setting an item again makes it the most recently used one
+    cache['c'] = 'c'
+    cache['f'] = 'f'
+    assert 'd' not in cache and cache.get('c') == 'c' and cache.size == 2
+    cache.clear()
+    assert len(cache) == cache.size == 0 and cache.get('c') is None
+
+    # doctrees written in the update are cached, and callers get copies
+    assert 'contents' in env._doctree_cache
+    doctree = env.get_doctree('contents')
+    assert doctree is not env.get_doctree('contents')
+    assert doctree.astext() == env.get_doctree('contents').astext()
+
+def test_segmented_pickle():
+    from sphinx import environment
+    from sphinx.environment import BuildEnvironment, segments_dir
+    filename = app.doctreedir / 'segmented.pickle'
+    segdir = segments_dir(filename)
+    old_size = environment.ENV_SEGMENT_SIZE
+    environment.ENV_SEGMENT_SIZE = 2
+    try:
+        env.topickle(filename)
+    finally:
+        environment.ENV_SEGMENT_SIZE = old_size
+    segfiles = set(os.listdir(segdir))
+    assert len(segfiles) > 1
+
+    # segments are only loaded when a key in them is accessed
+    env2 = BuildEnvironment.frompickle(app.config, filename)
+    env2.domains = {}
+    nsegments = len(env2.metadata.unloaded)
+    assert nsegments > 1
+    assert env2.metadata['contents'] == env.metadata['contents']
+    assert len(env2.metadata.unloaded) == nsegments - 1
+    # the other inventories have their own segments
+    assert len(env2.titles.unloaded) == nsegments
+    # only the loaded and changed segment is written again
+    env2.metadata['contents'] = {'changed': 'yes'}
+    env2.topickle(filename)
+    newfiles = set(os.listdir(segdir))
+    assert len(newfiles - segfiles) == len(segfiles - newfiles) == 1
+    # iterating over one inventory doesn't load the others
+    env2 = BuildEnvironment.frompickle(app.config, filename)
+    assert len(env2.tocs) == len(env.tocs)
+    assert not env2.tocs.unloaded
+    assert len(env2.titles.unloaded) == nsegments
+
+    # everything is still there after loading the changed pickle
+    env3 = BuildEnvironment.frompickle(app.config, filename)
+    assert env3.metadata['contents'] == {'changed': 'yes'}
+    assert set(env3.tocs) == set(env.tocs)
+    assert env3.toc_num_entries == env.toc_num_entries
+    assert not env3.toc_num_entries.unloaded
+
+    # a missing segment file makes the whole pickle unusable, and a segment
+    # that disappears after loading the pickle gives a clear error
+    env4 = BuildEnvironment.frompickle(app.config, filename)
+    for segfile in os.listdir(segdir):
+        os.remove(os.path.join(segdir, segfile))
+    raises(IOError, BuildEnvironment.frompickle, app.config, filename)
+    segment = iter(env4.metadata.unloaded).next()
+    raises(SphinxError, env4._load_segment, 'metadata', segment)
+    assert segment in env4.metadata.unloaded
+
+@with_tempdir
+def test_segments_incremental(tempdir):
+    from sphinx.environment import BuildEnvironment
+    docnames = ['doc%d' % i for i in range(100)]
+    (tempdir / 'conf.py').write_text('html_use_index = True\n')
+    (tempdir / 'contents.rst').write_text(
+        'Contents\n========\n\n.. toctree::\n\n' +
+        ''.join(['   %s\n' % docname for docname in docnames]))
+    for docname in docnames + ['extra']:
+        (tempdir / (docname + '.rst')).write_text(
+            '%s\n=====\n\n.. index:: %s\n\nText.\n' % (docname, docname))
+    (tempdir / 'extra.rst').write_text(':orphan:\n\n' +
+                                      (tempdir / 'extra.rst').text())
+    TestApp(srcdir=tempdir).builder.build_update()
+
+    # a document outside of the toctrees: only it and the master are written
+    mtime = os.stat(tempdir / 'extra.rst').st_mtime + 10
+    os.utime(tempdir / 'extra.rst', (mtime, mtime))
+    loaded = []
+    orig_load_segment = BuildEnvironment._load_segment
+    def load_segment(self, attr, segment):
+        loaded.append(attr)
+        orig_load_segment(self, attr, segment)
+    BuildEnvironment._load_segment = load_segment
+    try:
+        uapp = TestApp(srcdir=tempdir)
+        nsegments = len(uapp.env.titles.unloaded)
+        uapp.builder.build_update()
+    finally:
+        BuildEnvironment._load_segment = orig_load_segment
+    assert nsegments > 1
+    # the general index is complete, but only the titles of the written
+    # documents (the changed one and the master) were needed; the master's
+    # toctree needs all TOCs
+    genindex = (uapp.outdir / 'genindex.html').text()
+    assert 'doc42' in genindex and 'extra' in genindex
+    assert 0 < loaded.count('titles') < nsegments
+    assert 0 < loaded.count('metadata') < nsegments
+    assert uapp.env.titles.unloaded
+    assert not uapp.env.tocs.unloaded
+
+def test_content_digests():
+    dapp = TestApp(srcdir='(temp)', freshenv=True,
+                   confoverrides={'use_content_digests': True})
+    try:
+        denv = dapp.env
+        msg, num, it = denv.update(dapp.config, dapp.srcdir, dapp.doctreedir,
+                                   dapp)
+        list(it)
+        assert 'markup.txt' in denv.digests['markup']
+        assert 'img.png' in denv.digests['markup']
+        later = denv.all_docs['markup'] + 10
+        # a newer mtime alone doesn't make the document outdated
+        os.utime(denv.doc2path('markup'), (later, later))
+        os.utime(dapp.srcdir / 'img.png', (later, later))
+        added, changed, removed = denv.get_outdated_files(False)
+        assert 'markup' not in changed
+        # but a changed content does
+        (dapp.srcdir / 'img.png').write_text('changed')
+        os.utime(dapp.srcdir / 'img.png', (later + 1, later + 1))
+        added, changed, removed = denv.get_outdated_files(False)
+        assert 'markup' in changed
+        # without digests, only the mtime counts
+        denv.config.use_content_digests = False
+        os.utime(denv.doc2path('contents'), (later, later))
+        added, changed, removed = denv.get_outdated_files(False)
+        assert 'contents' in changed
+    finally:
+        dapp.cleanup()
+
+@skip_unless(parallel_available, 'parallel tasks are not available')
+def test_parallel_tasks():
+    import time
+    from sphinx.errors import SphinxParallelError
+    from sphinx.util.parallel import ParallelTasks
+    def exit_task(code):
+        os._exit(code)
+    # results are delivered in order, also when the workers have finished
+    # long before they are waited for
+    results = []
+    tasks = ParallelTasks(2)
+    for i in range(4):
+        tasks.add_task(abs, -i, results.append)
+    time.sleep(0.2)
+    tasks.join()
+    assert results == range(4)
+    # a worker that exits without a result is a failure, whatever its code
+    for code in (0, 1):
+        tasks = ParallelTasks(2)
+        tasks.add_task(exit_task, code)
+        raises_msg(SphinxParallelError, 'exited with code %d' % code,
+                   tasks.join)
+    tasks = ParallelTasks(2)
+    tasks.add_task(int, 'x')
+    raises_msg(SphinxParallelError, 'invalid literal', tasks.join)
+
+@skip_unless(parallel_available, 'parallel reading is not available')
+def test_parallel_read():
+    sapp = TestApp(srcdir='(temp)', freshenv=True)
+    papp = TestApp(srcdir='(temp)', freshenv=True, parallel=2)
+    try:
+        for tapp in (sapp, papp):
+            msg, num, it = tapp.env.update(tapp.config, tapp.srcdir,
+                                           tapp.doctreedir, tapp)
+            assert sorted(it) == sorted(tapp.env.found_docs)
+        senv, penv = sapp.env, papp.env
+        assert set(penv.all_docs) == set(senv.all_docs)
+        for docname in senv.all_docs:
+            assert penv.titles[docname].astext() == \
+                senv.titles[docname].astext()
+            assert penv.tocs[docname].astext() == \
+                senv.tocs[docname].astext()
+            assert penv.metadata[docname] == senv.metadata[docname]
+            assert penv.indexentries[docname] == senv.indexentries[docname]
+        assert penv.toctree_includes == senv.toctree_includes
+        assert penv.files_to_rebuild == senv.files_to_rebuild
+        assert penv.citations == senv.citations
+        assert set(penv.images) == set(senv.images)
+        assert penv.domaindata == senv.domaindata
+        assert len(penv.todo_all_todos) == len(senv.todo_all_todos)
+    finally:
+        sapp.cleanup()
+        papp.cleanup()
+
+def test_clear_doc():
+    from sphinx.util import DocIndexedDict
+    import cPickle as pickle
+    index = DocIndexedDict({'a': ('doc1', 'x'), 'b': 'doc2'})
+    index['c'] = ('doc1', 'y')
+    index['b'] = ('doc1', 'z')
+    assert index.keys_for_doc('doc1') == set('abc')
+    assert index.keys_for_doc('doc2') == set()
+    index = pickle.loads(pickle.dumps(index, pickle.HIGHEST_PROTOCOL))
+    assert isinstance(index, DocIndexedDict)
+    del index['a']
+    index.purge_doc('doc1')
+    assert index == {}
+
+    def referenced_docs(data):
+        docnames = set()
+        for value in data.itervalues():
+            if isinstance(value, basestring):
+                docnames.add(value)
+            else:
+                docnames.add(value[0])
+        return docnames
+
+    # clear documents in an environment of its own, so that the module's one
+    # stays intact for the other tests
+    capp = TestApp(srcdir='(temp)', freshenv=True)
+    try:
+        cenv = capp.env
+        msg, num, it = cenv.update(capp.config, capp.srcdir, capp.doctreedir,
+                                   capp)
+        list(it)
+        assert 'contents' in referenced_docs(cenv.citations)
+        assert 'contents' in cenv.toctree_includes
+        assert 'markup' in cenv.changed_versions
+        assert 'objects' in referenced_docs(cenv.domaindata['py']['objects'])
+        for docname in ('contents', 'markup', 'objects', 'images'):
+            cenv.clear_doc(docname)
+            assert docname not in referenced_docs(cenv.citations)
+            for domaindata in cenv.domaindata.itervalues():
+                for value in domaindata.itervalues():
+                    if isinstance(value, dict):
+                        assert docname not in referenced_docs(value)
+            for fnset in cenv.files_to_rebuild.itervalues():
+                assert docname not in fnset
+            for changes in cenv.versionchanges.itervalues():
+                for change in changes:
+                    assert change[1] != docname
+            for docs, unique in cenv.images.itervalues():
+                assert docname not in docs
+        assert 'contents' not in cenv.files_to_rebuild.get('images', ())
+    finally:
+        capp.cleanup()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+    test_graphviz
+    ~~~~~~~~~~~~~
+
+    Test the graphviz extension with a stand-in for dot.
+
+    :copyright: Copyright 2007-2011 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+import sys
+
+from util import *
+
+from sphinx.util.parallel import parallel_available
+
+
+# "dot" logs its calls, fails for graphs named "bad" and writes the image
+# and an empty image map
+fake_dot = '''\
+import sys, shutil
+if sys.argv[1:] == ['-V']:
+    sys.stderr.write('dot - fake version\\n')
+    sys.exit(0)
+code = sys.stdin.read()
+open(%(log)r, 'a').write('dot\\n')
+if 'bad' in code:
+    sys.stderr.write('syntax error')
+    sys.exit(1)
+outfns = [arg[2:] for arg in sys.argv if arg.startswith('-o')]
+shutil.copy(%(png)r, outfns[0])
+open(outfns[1], 'w').write('<map id="g" name="g">\\n</map>\\n')
+'''
+
+
+def make_project(tempdir, **conf):
+    log = tempdir / 'log'
+    write_file(tempdir / 'dot', '#!%s\n' % sys.executable + fake_dot % {
+        'log': str(log), 'png': str(test_root / 'img.png')})
+    os.chmod(tempdir / 'dot', 0755)
+    conf.update(extensions=['sphinx.ext.graphviz'],
+                graphviz_dot=str(tempdir / 'dot'))
+    write_file(tempdir / 'conf.py', ''.join(['%s = %r\n' % item
+                                             for item in conf.items()]))
+    write_file(tempdir / 'contents.rst', '''\
+Graphs
+======
+
+.. digraph:: one
+
+   a -> b
+
+.. digraph:: two
+
+   b -> c
+
+.. digraph:: bad
+
+   c -> d
+''')
+    return log
+
+
+@with_tempdir
+def test_render_in_background(tempdir):
+    log = make_project(tempdir, render_workers=2)
+    app = TestApp(srcdir=tempdir)
+    app.builder.build_all()
+    # the failed graph is rendered again to report the error
+    assert log.text() == 'dot\n' * 4
+    html = (app.outdir / 'contents.html').text()
+    assert html.count('<img src="_images/graphviz-') == 2
+    assert len(app._warning.content) == 1
+    assert 'syntax error' in app._warning.content[0]
+    assert not [fn for fn in os.listdir(app.outdir / '_images')
+                if fn.endswith('.tmp')]
+
+    # the render cache has the images for another output directory
+    app = TestApp(srcdir=tempdir, outdir=tempdir / 'other')
+    app.builder.build_all()
+    assert log.text() == 'dot\n' * 6
+    html = (app.outdir / 'contents.html').text()
+    assert html.count('<img src="_images/graphviz-') == 2
+
+
+@skip_unless(parallel_available, 'parallel writing is not available')
+@with_tempdir
+def test_render_parallel_write(tempdir):
+    log = make_project(tempdir, render_workers=2)
+    docnames = ['doc%d' % i for i in range(6)]
+    (tempdir / 'contents.rst').write_text(
+        (tempdir / 'contents.rst').text() + '\n.. toctree::\n\n' +
+        ''.join(['   %s\n' % docname for docname in docnames]))
+    for docname in docnames:
+        write_file(tempdir / (docname + '.rst'),
+                   '%s\n=====\n\n.. digraph:: %s\n\n   a -> %s\n'
+                   % (docname, docname, docname))
+    app = TestApp(srcdir=tempdir, parallel=2)
+    assert app.builder.parallel_ok
+    app.builder.build_all()
+    # the images are rendered before writing, and the workers use them
+    assert log.text() == 'dot\n' * 10
+    for docname in docnames:
+        html = (app.outdir / (docname + '.html')).text()
+        assert html.count('<img src="_images/graphviz-') == 1
+
+
+@with_tempdir
+def test_inheritance_diagram(tempdir):
+    log = make_project(tempdir, render_workers=2)
+    write_file(tempdir / 'inhmod.py',
+               'class Base(object): pass\nclass Derived(Base): pass\n')
+    write_file(tempdir / 'conf.py', 'import sys\n'
+               'sys.path.insert(0, %r)\n' % str(tempdir) +
+               (tempdir / 'conf.py').text().replace(
+                   'sphinx.ext.graphviz', 'sphinx.ext.inheritance_diagram'))
+    write_file(tempdir / 'contents.rst', '''\
+Diagram
+=======
+
+.. inheritance-diagram:: inhmod.Derived
+
+.. toctree::
+
+   classes
+''')
+    write_file(tempdir / 'classes.rst', '''\
+Classes
+=======
+
+.. py:class:: inhmod.Base
+
+.. py:class:: inhmod.Derived
+''')
+    app = TestApp(srcdir=tempdir)
+    app.builder.build_all()
+    # the diagram is rendered before writing, with the same links
+    assert log.text() == 'dot\n'
+    html = (app.outdir / 'contents.html').text()
+    assert html.count('<img src="_images/inheritance-') == 1
@@ -9,6 +9,8 @@
     :license: BSD, see LICENSE for details.
 """
 
+import os
+
 from util import *
 
 try:
@@ -83,3 +85,41 @@ def test_trim_doctest_flags():
         assert ret == '>>> 1+2 \n3\n'
     finally:
         PygmentsBridge.html_formatter = HtmlFormatter
+
+@with_tempdir
+def test_cache(tempdir):
+    from sphinx.util.rendercache import StringCache
+    cachefn = tempdir / 'highlight.pickle'
+    cache = StringCache(cachefn)
+    bridge = PygmentsBridge('html', cache=cache)
+    ret = bridge.highlight_block('print 1\n', 'python')
+
+    # the cached result is used, by other bridges too
+    bridge = PygmentsBridge('html', cache=cache)
+    bridge._highlight_block = None
+    assert bridge.highlight_block('print 1\n', 'python') == ret
+
+    # but not for other sources or options
+    bridge = PygmentsBridge('html', cache=cache)
+    assert bridge.highlight_block('print 1\n', 'python', linenos=True) != ret
+    bridge.highlight_block('print 2\n', 'python')
+    PygmentsBridge('latex', cache=cache).highlight_block('print 1\n', 'python')
+    assert len(cache.get_fragment()[1]) == 4
+
+    # results that came with a warning are not cached
+    warnings = []
+    bridge.highlight_block('print 1\n', 'nolexer', warn=warnings.append)
+    assert len(warnings) == 1
+    assert len(cache.get_fragment()[1]) == 4
+
+    # everything is written to one file, and read back from it
+    cache.save()
+    assert os.listdir(tempdir) == ['highlight.pickle']
+    cache = StringCache(cachefn)
+    bridge = PygmentsBridge('html', cache=cache)
+    bridge._highlight_block = None
+    assert bridge.highlight_block('print 1\n', 'python') == ret
+
+    # only the results used since loading are kept
+    cache.save()
+    assert len(StringCache(cachefn)._stored) == 1
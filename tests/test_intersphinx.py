@@ -9,8 +9,13 @@
     :license: BSD, see LICENSE for details.
 """
 
+import os
 import zlib
+import time
 import posixpath
+import threading
+import BaseHTTPServer
+import cPickle as pickle
 try:
     from io import BytesIO
 except ImportError:
@@ -20,7 +25,7 @@ from docutils import nodes
 
 from sphinx import addnodes
 from sphinx.ext.intersphinx import read_inventory_v1, read_inventory_v2, \
-     load_mappings, missing_reference
+     load_mappings, missing_reference, Inventory
 
 from util import *
 
@@ -81,6 +86,47 @@ def test_read_inventory_v2():
            '/util/glossary.html#term-a-term'
 
 
+def test_inventory():
+    f = BytesIO(inventory_v2)
+    f.readline()
+    invdata = read_inventory_v2(f, '/util', posixpath.join)
+    inv = Inventory()
+    inv.add(invdata)
+    assert len(inv.objects) == 5
+    assert inv.lookup('module2', ['py:class', 'py:module']) == \
+           ('foo', '2.0', '/util/foo.html#module-module2', '-')
+    assert inv.lookup('module2', ['py:function']) is None
+    assert inv.lookup('module2', ['unknown:type']) is None
+    assert inv.lookup('unknown', ['py:module']) is None
+
+    # entries of the same name and type are shadowed, others are kept
+    other = Inventory()
+    other.add({'py:module': {'module2': ('bar', '1.0', 'bar.html', '-')},
+               'py:class': {'module2': ('bar', '1.0', 'cls.html', '-')}})
+    inv.update(other)
+    assert inv.lookup('module2', ['py:module'])[2] == 'bar.html'
+    assert inv.lookup('module2', ['py:class', 'py:module'])[2] == 'cls.html'
+    assert inv.lookup('module1', ['py:module'])[0] == 'foo'
+    assert len(inv.objects['module2'][1]) == 2
+    # with other type bits, the entries are added again
+    assert other.typebits is not inv.typebits
+    assert inv.objects['module2'][1][0] is not other.objects['module2'][1][0]
+    shared = Inventory(inv.typebits)
+    shared.update(inv)
+    assert shared.objects['module2'][1][0] is inv.objects['module2'][1][0]
+
+    # the inventory reads like a dictionary of the inventory data
+    assert set(inv) == set(invdata) | set(['py:class'])
+    assert inv['py:module']['module1'] == invdata['py:module']['module1']
+    assert inv['py:module']['module2'] == ('bar', '1.0', 'bar.html', '-')
+    assert inv['py:class'] == {'module2': ('bar', '1.0', 'cls.html', '-')}
+    assert inv.get('unknown:type') is None
+    assert 'py:function' in inv and len(inv) == len(invdata) + 1
+
+    # the inventory is not pickled
+    assert len(pickle.loads(pickle.dumps(inv, pickle.HIGHEST_PROTOCOL))) == 0
+
+
 @with_app(confoverrides={'extensions': 'sphinx.ext.intersphinx'})
 @with_tempdir
 def test_missing_reference(tempdir, app):
@@ -96,7 +142,7 @@ def test_missing_reference(tempdir, app):
     load_mappings(app)
     inv = app.env.intersphinx_inventory
 
-    assert inv['py:module']['module2'] == \
+    assert inv.lookup('module2', ['py:module']) == \
            ('foo', '2.0', 'http://docs.python.org/foo.html#module-module2', '-')
 
     # create fake nodes and check referencing
@@ -180,3 +226,61 @@ def test_load_mappings_warnings(tempdir, app):
     assert len(app._warning.content) == 2
 
 
+class InventoryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == '"inv"':
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', '"inv"')
+        self.send_header('Content-Length', str(len(inventory_v2)))
+        self.end_headers()
+        self.wfile.write(inventory_v2)
+
+
+@with_app(confoverrides={'extensions': 'sphinx.ext.intersphinx'})
+def test_load_mappings_remote(app):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), InventoryHandler)
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    try:
+        base = 'http://127.0.0.1:%d/' % server.server_address[1]
+        app.config.intersphinx_mapping = {
+            'one': (base + 'one/', None),
+            'two': (base + 'two/', None),
+        }
+        app.config.intersphinx_cache_limit = 5
+        app.config.intersphinx_timeout = 10
+        load_mappings(app)
+        inv = app.env.intersphinx_inventory
+        assert inv.lookup('module2', ['py:module'])[2] in (
+            base + 'one/foo.html#module-module2',
+            base + 'two/foo.html#module-module2')
+        assert server.requests == [None, None]
+        # the inventories are cached outside of the environment
+        assert not hasattr(app.env, 'intersphinx_cache')
+        assert len(os.listdir(app.doctreedir / 'intersphinx')) == 4
+
+        # within the cache limit, nothing is fetched
+        load_mappings(app)
+        assert len(server.requests) == 2
+        named = app.env.intersphinx_named_inventory
+        assert named['two'].lookup('module2', ['py:module'])[2] == \
+            base + 'two/foo.html#module-module2'
+
+        # afterwards, the inventories are revalidated
+        app.config.intersphinx_cache_limit = 0
+        time.sleep(1)
+        load_mappings(app)
+        assert server.requests[2:] == ['"inv"', '"inv"']
+        assert inv.objects == app.env.intersphinx_inventory.objects
+    finally:
+        server.shutdown()
+        (app.doctreedir / 'intersphinx').rmtree(True)
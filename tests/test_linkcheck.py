@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+    test_linkcheck
+    ~~~~~~~~~~~~~~
+
+    Test the linkcheck builder against a local HTTP server.
+
+    :copyright: Copyright 2007-2011 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import time
+import threading
+import SocketServer
+import BaseHTTPServer
+
+from util import *
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def do_GET(self):
+        self.respond(True)
+
+    def respond(self, send_body):
+        server = self.server
+        server.lock.acquire()
+        server.requests.append((self.command, self.path))
+        server.times.append((self.path, time.time()))
+        server.clients.add(self.client_address)
+        server.active += 1
+        server.maxactive = max(server.maxactive, server.active)
+        server.lock.release()
+        try:
+            headers = {}
+            body = '<html><body><p id="here">content</p></body></html>'
+            if self.path.startswith('/slow'):
+                time.sleep(0.05)
+            if self.path == '/redirect':
+                status = 302
+                headers['Location'] = '/ok'
+            elif self.path == '/busy' and \
+                     server.requests.count((self.command, self.path)) == 1:
+                status = 429
+                headers['Retry-After'] = server.retry_after
+            elif self.path == '/ok' and \
+                     self.headers.get('If-None-Match') == '"v1"':
+                status = 304
+                send_body = False
+                server.conditional.append(self.path)
+            elif self.path in ('/ok', '/busy', '/page') or \
+                     self.path.startswith('/slow'):
+                status = 200
+                if self.path == '/ok':
+                    headers['ETag'] = '"v1"'
+            else:
+                status = 404
+            self.send_response(status)
+            for key, value in headers.iteritems():
+                self.send_header(key, value)
+            if status != 304:
+                self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+        finally:
+            server.lock.acquire()
+            server.active -= 1
+            server.lock.release()
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.lock = threading.Lock()
+        self.requests = []
+        self.times = []
+        self.conditional = []
+        self.retry_after = '0'
+        self.clients = set()
+        self.active = self.maxactive = 0
+
+
+def start_server():
+    server = Server()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server
+
+
+def make_project(tempdir, port):
+    base = 'http://127.0.0.1:%d' % port
+    (tempdir / 'conf.py').write_text('')
+    (tempdir / 'contents.rst').write_text('''\
+Links
+=====
+
+* `working <%(base)s/ok>`_
+* `again <%(base)s/ok>`_
+* `redirect <%(base)s/redirect>`_
+* `missing <%(base)s/missing>`_
+* `busy <%(base)s/busy>`_
+* `anchor <%(base)s/page#here>`_
+* `no anchor <%(base)s/page#nowhere>`_
+* `slow1 <%(base)s/slow1>`_
+* `slow2 <%(base)s/slow2>`_
+* `slow3 <%(base)s/slow3>`_
+
+.. toctree::
+
+   other
+''' % {'base': base})
+    (tempdir / 'other.rst').write_text('''\
+Other
+=====
+
+Another `link <%s/ok>`_.
+''' % base)
+
+
+@with_tempdir
+def test_linkcheck_local(tempdir):
+    server = start_server()
+    try:
+        make_project(tempdir, server.server_address[1])
+        app = TestApp(srcdir=tempdir, buildername='linkcheck', freshenv=True,
+                      confoverrides={'linkcheck_host_workers': 1})
+        app.builder.build_all()
+        output = (app.outdir / 'output.txt').text()
+    finally:
+        server.shutdown()
+
+    assert '/redirect to http://127.0.0.1:%d/ok' % \
+        server.server_address[1] in output
+    assert '/missing: HTTP Error 404: Not Found' in output
+    assert "/page#nowhere: Anchor 'nowhere' not found" in output
+    assert '/busy' not in output
+    assert 'page#here' not in output
+    assert app.statuscode == 1
+    # every link is checked once, and only once more if the server asks
+    assert server.requests.count(('HEAD', '/ok')) == 2  # once via redirect
+    assert server.requests.count(('HEAD', '/busy')) == 2
+    assert server.requests.count(('HEAD', '/slow1')) == 1
+    assert server.requests.count(('GET', '/page')) == 1
+    # connections are kept alive, and the host limit is obeyed
+    assert len(server.clients) == 1
+    assert server.maxactive == 1
+
+
+@with_tempdir
+def test_linkcheck_retry_after(tempdir):
+    server = start_server()
+    server.retry_after = '1'
+    try:
+        (tempdir / 'conf.py').write_text('')
+        (tempdir / 'contents.rst').write_text(
+            '`busy <http://127.0.0.1:%d/busy>`_\n' % server.server_address[1])
+        app = TestApp(srcdir=tempdir, buildername='linkcheck', freshenv=True,
+                      confoverrides={'linkcheck_workers': 2,
+                                     'linkcheck_host_workers': 2})
+        app.builder.build_all()
+    finally:
+        server.shutdown()
+
+    # the other worker doesn't check the link again before the delay is over
+    times = [t for (path, t) in server.times if path == '/busy']
+    assert len(times) == 2
+    assert times[1] - times[0] >= 0.9
+    assert app.statuscode == 0
+
+
+@with_tempdir
+def test_linkcheck_cache(tempdir):
+    server = start_server()
+    def build(**confoverrides):
+        del server.requests[:]
+        app = TestApp(srcdir=tempdir, buildername='linkcheck',
+                      confoverrides=confoverrides)
+        app.builder.build_all()
+        return (app.outdir / 'output.txt').text()
+    try:
+        make_project(tempdir, server.server_address[1])
+        build()
+        assert ('HEAD', '/ok') in server.requests
+        assert not server.conditional
+
+        # without a TTL, links are checked again, conditionally if possible
+        output = build()
+        assert ('HEAD', '/ok') in server.requests
+        assert server.conditional == ['/ok']
+        assert '/missing: HTTP Error 404' in output
+
+        # results are trusted for the given time
+        output = build(linkcheck_cache_ttl={'working': 3600})
+        assert server.requests.count(('HEAD', '/ok')) == 1  # via redirect
+        assert ('HEAD', '/missing') in server.requests
+        assert '/missing: HTTP Error 404' in output
+
+        # only new links are checked
+        (tempdir / 'other.rst').write_text(
+            'Other\n=====\n\nA `link <http://127.0.0.1:%d/new>`_.\n' %
+            server.server_address[1])
+        output = build(linkcheck_only_new=True)
+        assert server.requests == [('HEAD', '/new')]
+        assert '/missing: HTTP Error 404' in output
+        assert '/new: HTTP Error 404' in output
+    finally:
+        server.shutdown()
+
+
+def test_page_anchors():
+    from StringIO import StringIO
+    from sphinx.builders.linkcheck import PageAnchors
+    released = []
+    page = PageAnchors()
+    page.response = StringIO('<p id="first">1</p>' + 'x' * 20000 +
+                             '<p name="last">2</p>')
+    page.release = lambda: released.append(True)
+    # the page is only read as far as necessary
+    assert page.find('first')
+    assert page.response.tell() == 8192
+    assert not page.complete
+    assert page.find('last')
+    assert not page.find('other')
+    assert page.complete
+    assert released == [True]
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+"""
+    test_pngmath
+    ~~~~~~~~~~~~
+
+    Test the pngmath extension with stand-ins for latex and dvipng.
+
+    :copyright: Copyright 2007-2011 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+import sys
+
+from util import *
+
+
+# "latex" logs its calls, fails on \bad and copies the source to the DVI file
+fake_latex = '''\
+import sys
+texfn = sys.argv[-1]
+source = open(texfn).read()
+open(%(log)r, 'a').write('latex %%s\\n' %% texfn)
+if '\\\\bad' in source:
+    sys.exit(1)
+open(texfn[:-4] + '.dvi', 'w').write(source)
+'''
+
+# "dvipng" writes one image per page and reports the page numbers as depths
+fake_dvipng = '''\
+import re, sys, shutil
+args = sys.argv[1:]
+source = open(args[-1]).read()
+outfn = args[args.index('-o') + 1]
+open(%(log)r, 'a').write('dvipng\\n')
+pages = [int(n) for n in re.findall(r'setcounter{page}{(\\d+)}', source)]
+for page in pages or [1]:
+    shutil.copy(%(png)r, '%%' in outfn and outfn %% page or outfn)
+    sys.stdout.write('[%%d depth=%%d] ' %% (page, page))
+'''
+
+
+def make_project(tempdir, **conf):
+    log = tempdir / 'log'
+    for name, script in [('latex', fake_latex), ('dvipng', fake_dvipng)]:
+        write_file(tempdir / name, '#!%s\n' % sys.executable + script % {
+            'log': str(log), 'png': str(test_root / 'img.png')})
+        os.chmod(tempdir / name, 0755)
+    conf.update(extensions=['sphinx.ext.pngmath'],
+                pngmath_latex=str(tempdir / 'latex'),
+                pngmath_dvipng=str(tempdir / 'dvipng'),
+                pngmath_use_preview=True)
+    write_file(tempdir / 'conf.py', ''.join(['%s = %r\n' % item
+                                             for item in conf.items()]))
+    write_file(tempdir / 'contents.rst', '''\
+Math
+====
+
+Inline :math:`a^2`, :math:`b^2` and :math:`a^2` again.
+
+.. math::
+
+   a^2 + b^2 = c^2
+''')
+    return log
+
+
+@with_tempdir
+def test_batch(tempdir):
+    log = make_project(tempdir)
+    app = TestApp(srcdir=tempdir)
+    app.builder.build_all()
+    # one latex and dvipng run for the three distinct formulas
+    assert log.text() == 'latex batch.tex\ndvipng\n'
+    images = os.listdir(app.outdir / '_images' / 'math')
+    assert len(images) == 3
+    html = (app.outdir / 'contents.html').text()
+    # the depths of the pages are stored with the images
+    assert html.count('style="vertical-align: -1px"') == 2
+    assert html.count('style="vertical-align: -2px"') == 1
+
+    # rendered formulas are not rendered again
+    app = TestApp(srcdir=tempdir)
+    app.builder.build_all()
+    assert log.text() == 'latex batch.tex\ndvipng\n'
+
+    # not even for another output directory, thanks to the render cache
+    app = TestApp(srcdir=tempdir, outdir=tempdir / 'other')
+    app.builder.build_all()
+    assert log.text() == 'latex batch.tex\ndvipng\n'
+    assert len(os.listdir(app.outdir / '_images' / 'math')) == 3
+    html = (app.outdir / 'contents.html').text()
+    assert html.count('style="vertical-align: -1px"') == 2
+
+
+@with_tempdir
+def test_batch_documents(tempdir):
+    log = make_project(tempdir)
+    (tempdir / 'contents.rst').write_text(
+        'Math\n====\n\n.. toctree::\n\n   other\n\n:math:`a^2`\n')
+    (tempdir / 'other.rst').write_text('Other\n=====\n\n:math:`b^2`\n')
+    app = TestApp(srcdir=tempdir)
+    app.builder.build_all()
+    # the formulas of all documents are rendered before writing them
+    assert log.text() == 'latex batch.tex\ndvipng\n'
+    assert 'vertical-align: -2px' in (app.outdir / 'other.html').text()
+
+    # a document read again is found by its new formulas
+    (tempdir / 'other.rst').write_text('Other\n=====\n\n:math:`c^2`\n')
+    mtime = os.stat(tempdir / 'other.rst').st_mtime + 10
+    os.utime(tempdir / 'other.rst', (mtime, mtime))
+    app = TestApp(srcdir=tempdir)
+    app.builder.build_update()
+    assert 'c^2' in (app.outdir / 'other.html').text()
+    assert log.text() == 'latex batch.tex\ndvipng\nlatex math.tex\ndvipng\n'
+
+
+@with_tempdir
+def test_batch_error(tempdir):
+    log = make_project(tempdir)
+    (tempdir / 'contents.rst').write_text(
+        'Math\n====\n\n:math:`a^2`, :math:`\\bad` and :math:`b^2`.\n')
+    app = TestApp(srcdir=tempdir)
+    app.builder.build_all()
+    # after the failed batch, the formulas are rendered one by one
+    assert log.text() == 'latex batch.tex\n' + \
+           'latex math.tex\ndvipng\nlatex math.tex\nlatex math.tex\ndvipng\n'
+    assert len(os.listdir(app.outdir / '_images' / 'math')) == 2
+    assert '\\bad' in app._warning.content[-1]
+
+
+@with_tempdir
+def test_parallel_batches(tempdir):
+    log = make_project(tempdir, render_workers=2)
+    (tempdir / 'contents.rst').write_text('Math\n====\n\n' + ''.join(
+        [':math:`x_{%d}`\n' % i for i in range(45)]))
+    app = TestApp(srcdir=tempdir)
+    app.builder.build_all()
+    # the formulas are split between two runs at once
+    assert sorted(log.text().splitlines()) == ['dvipng', 'dvipng',
+                                   'latex batch0.tex', 'latex batch1.tex']
+    assert len(os.listdir(app.outdir / '_images' / 'math')) == 45
+    html = (app.outdir / 'contents.html').text()
+    assert html.count('style="vertical-align: -23px"') == 1
+    assert html.count('style="vertical-align: -22px"') == 2
+
+
+@with_tempdir
+def test_no_batch(tempdir):
+    log = make_project(tempdir, pngmath_batch=False)
+    app = TestApp(srcdir=tempdir)
+    app.builder.build_all()
+    assert log.text() == 'latex math.tex\ndvipng\n' * 3
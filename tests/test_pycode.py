@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+    test_pycode
+    ~~~~~~~~~~~
+
+    Test the Python source code analyzer.
+
+    :copyright: Copyright 2007-2011 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+
+from util import *
+
+from sphinx.pycode import ModuleAnalyzer
+
+
+source = '''\
+class Foo(object):
+    #: doc of attr
+    attr = 1
+
+    def meth(self):
+        pass
+'''
+
+
+@with_tempdir
+def test_persistent_results(tempdir):
+    srcfile = tempdir / 'mod.py'
+    write_file(srcfile, source)
+    oldcachedir = ModuleAnalyzer.cachedir
+    ModuleAnalyzer.cachedir = tempdir / 'cache'
+    try:
+        analyzer = ModuleAnalyzer.for_file(srcfile, 'mod')
+        attr_docs = analyzer.find_attr_docs()
+        tags = analyzer.find_tags()
+        assert attr_docs == {('Foo', 'attr'): ['doc of attr', '']}
+        assert tags == {'Foo': ('class', 1, 7), 'Foo.meth': ('def', 5, 7)}
+
+        # a new analyzer for the same file needn't tokenize it again
+        fileobj = open(srcfile, 'rb')
+        analyzer = ModuleAnalyzer(fileobj, 'mod', srcfile)
+        analyzer.load_results()
+        # nor keep the file open
+        assert fileobj.closed
+        assert analyzer.find_attr_docs() == attr_docs
+        assert analyzer.find_tags() == tags
+        assert analyzer.tokens is None
+
+        # but it must if the file was changed
+        write_file(srcfile, source.replace('meth', 'other'))
+        stat = os.stat(srcfile)
+        os.utime(srcfile, (stat.st_atime, stat.st_mtime + 1))
+        analyzer = ModuleAnalyzer(open(srcfile, 'rb'), 'mod', srcfile)
+        analyzer.load_results()
+        assert analyzer.find_tags() == {'Foo': ('class', 1, 7),
+                                        'Foo.other': ('def', 5, 7)}
+        assert analyzer.tokens is not None
+    finally:
+        ModuleAnalyzer.cachedir = oldcachedir
+        ModuleAnalyzer.cache.pop(('file', srcfile), None)
+
+
+@with_tempdir
+def test_results_saved_once(tempdir):
+    srcfile = tempdir / 'mod.py'
+    write_file(srcfile, source)
+    saved = []
+    oldcachedir = ModuleAnalyzer.cachedir
+    ModuleAnalyzer.cachedir = tempdir / 'cache'
+    try:
+        analyzer = ModuleAnalyzer(open(srcfile, 'rb'), 'mod', srcfile)
+        analyzer.load_results()
+        save_results = analyzer.save_results
+        analyzer.save_results = lambda: saved.append(save_results())
+        analyzer.find_attr_docs()
+        analyzer.find_tags()
+        assert len(saved) == 1
+    finally:
+        ModuleAnalyzer.cachedir = oldcachedir
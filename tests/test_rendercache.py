@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+    test_rendercache
+    ~~~~~~~~~~~~~~~~
+
+    Test the cache of rendered files.
+
+    :copyright: Copyright 2007-2011 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import os
+
+from util import *
+
+from sphinx.util.rendercache import RenderCache
+
+
+@with_tempdir
+def test_render_cache(tempdir):
+    cache = RenderCache(tempdir / 'cache', 250)
+    key = cache.key('dot', u'digraph { a -> b }', '-Tpng')
+    assert key != cache.key('dot', u'digraph { a -> b }-', 'Tpng')
+    outfns = [tempdir / 'out' / 'graph.png', tempdir / 'out' / 'graph.png.map']
+    assert not cache.fetch(key, outfns)
+
+    (tempdir / 'out').makedirs()
+    write_file(outfns[0], 'x' * 100)
+    write_file(outfns[1], '<map></map>')
+    cache.store(key, outfns)
+    assert sorted(os.listdir(tempdir / 'cache')) == [key + '.map', key + '.png']
+
+    # files are put in place for another output directory
+    otherfns = [tempdir / 'other' / 'graph.png',
+                tempdir / 'other' / 'graph.png.map']
+    assert cache.fetch(key, otherfns)
+    assert otherfns[0].text() == 'x' * 100
+    assert otherfns[1].text() == '<map></map>'
+    # only if all of them are there
+    assert not cache.fetch(cache.key('other'), otherfns)
+
+    # the least recently used files are evicted
+    stat = os.stat(tempdir / 'cache' / key + '.png')
+    for fn in os.listdir(tempdir / 'cache'):
+        os.utime(tempdir / 'cache' / fn, (stat.st_atime, stat.st_mtime - 10))
+    write_file(tempdir / 'new.png', 'y' * 200)
+    newkey = cache.key('new')
+    cache.store(newkey, [tempdir / 'new.png'])
+    assert os.listdir(tempdir / 'cache') == [newkey + '.png']
+    assert cache.size == 200
+
+
+def test_background_tasks():
+    import time
+    import threading
+    from sphinx.util.parallel import BackgroundTasks
+    tasks = BackgroundTasks(2)
+    done = []
+    running = []
+    maxrunning = []
+    lock = threading.Lock()
+    def task(i):
+        lock.acquire()
+        running.append(i)
+        maxrunning.append(len(running))
+        lock.release()
+        time.sleep(0.01)
+        lock.acquire()
+        running.remove(i)
+        done.append(i)
+        lock.release()
+        if i == 3:
+            raise RuntimeError('errors are ignored')
+    for i in range(6):
+        tasks.add_task(i, task, i)
+    tasks.wait(0)
+    assert 0 in done
+    tasks.wait()
+    assert sorted(done) == range(6)
+    assert max(maxrunning) <= 2
+    # a task can be added again once it finished
+    tasks.add_task(0, task, 0)
+    tasks.wait()
+    assert len(done) == 7
@@ -9,10 +9,17 @@
     :license: BSD, see LICENSE for details.
 """
 
+import os
+from StringIO import StringIO
+
 from docutils import frontend, utils
 from docutils.parsers import rst
 
-from sphinx.search import IndexBuilder
+from util import *
+
+from sphinx.search import IndexBuilder, js_index, js_terms, term_shard, \
+     encode_postings, decode_postings
+from sphinx.util import jsdump
 from sphinx.util.pycompat import b
 
 
@@ -40,3 +47,151 @@ def test_wordcollector():
     ix.feed('filename', 'title', doc)
     assert 'boson' not in ix._mapping
     assert 'fermion' in ix._mapping
+    assert 'test' in ix._mapping
+    assert 'index' in ix._mapping  # stemmed from "indexed"
+
+
+class FakeEnv(object):
+    domains = {}
+
+
+def test_weights():
+    doc = utils.new_document(b('test data'), settings)
+    parser.parse('Fermions\n========\n\nA fermion and a boson, '
+                 'and another boson.\n', doc)
+    ix = IndexBuilder(FakeEnv(), 'en', {})
+    ix.feed('filename', 'Particles', doc)
+    # words in headings count more, as does the document title
+    assert ix._mapping['fermion'] == {'filename': 6}
+    assert ix._mapping['boson'] == {'filename': 2}
+    assert ix._mapping['particl'] == {'filename': 5}
+    assert ix._doclengths['filename'] == 14
+
+    # the weights survive freezing and loading
+    frozen = ix.freeze()
+    assert frozen['terms']['fermion'] == [0, -6]
+    assert frozen['doclengths'] == [14]
+    f = StringIO()
+    ix.dump(f, 'pickle')
+    f.seek(0)
+    ix2 = IndexBuilder(FakeEnv(), 'en', {})
+    ix2.load(f, 'pickle')
+    assert ix2._mapping == ix._mapping
+    assert ix2._doclengths == ix._doclengths
+
+
+def test_postings():
+    fn2index = {'a': 0, 'b': 1, 'c': 5, 'd': 6}
+    assert encode_postings({'b': 1}, fn2index) == 1
+    assert encode_postings({'b': 2}, fn2index) == [1, -2]
+    assert encode_postings({'x': 1}, fn2index) is None
+    postings = encode_postings({'a': 1, 'c': 3, 'd': 1, 'x': 2}, fn2index)
+    assert postings == [0, 5, -3, 1]
+    assert decode_postings(postings) == [(0, 1), (5, 3), (6, 1)]
+    assert decode_postings(7) == [(7, 1)]
+
+
+def test_term_shard():
+    # the same values as the hash in searchtools.js, which works on the
+    # UTF-16 code units of the term
+    assert term_shard(u'python', 1000) == 3321770204 % 1000
+    assert term_shard(u'\U0001d11ex', 1000) == 54944334 % 1000
+    assert term_shard('python', 7) == 4
+
+
+def test_term_cache():
+    ix = IndexBuilder(None, 'en', {})
+    lang = ix.lang
+    lang.term_cache_size = 3
+    assert lang.get_term('Indexed') == 'index'
+    assert lang.get_term('the') is None
+    assert lang._term_cache == {'Indexed': 'index', 'the': None}
+    lang.get_term('fermions')
+    lang.get_term('bosons')
+    # the cache doesn't grow beyond its size
+    assert len(lang._term_cache) <= 3
+
+
+def test_jsdump_stream():
+    data = {'terms': dict(('word%d' % i, [i, i + 1]) for i in range(5000)),
+            'titles': [u'T\xe4st', None, True], 'objects': {}}
+    f = StringIO()
+    jsdump.dump(data, f)
+    assert f.getvalue() == jsdump.dumps(data)
+    assert jsdump.loads(f.getvalue()) == jsdump.loads(jsdump.dumps(data))
+
+
+def touch(filename):
+    # make sure the file is seen as changed
+    stat = os.stat(filename)
+    os.utime(filename, (stat.st_atime, stat.st_mtime + 10))
+
+
+@with_tempdir
+def test_indexer_state(tempdir):
+    loaded = []
+    orig_loads = jsdump.loads
+    def loads(s):
+        loaded.append(True)
+        return orig_loads(s)
+    def build(word):
+        (tempdir / 'contents.rst').write_text('Contents\n========\n\n'
+            '.. toctree::\n\n   other\n\n%s\n' % word)
+        touch(tempdir / 'contents.rst')
+        del loaded[:]
+        app = TestApp(srcdir=tempdir)
+        app.builder.build_update()
+        return (app.outdir / 'searchindex.js').text()
+
+    (tempdir / 'conf.py').write_text('')
+    (tempdir / 'other.rst').write_text('Other\n=====\n\nboson\n')
+    jsdump.loads = loads
+    try:
+        assert 'boson' in build('fermion')
+
+        # the state is loaded instead of the index itself
+        index = build('lepton')
+        assert 'boson' in index and 'lepton' in index
+        assert not loaded
+
+        # but not if it doesn't belong to the index
+        touch(tempdir / '_build' / 'html' / 'searchindex.js')
+        index = build('quark')
+        assert 'boson' in index and 'quark' in index
+        assert loaded
+    finally:
+        jsdump.loads = orig_loads
+
+
+@with_tempdir
+def test_sharded_index(tempdir):
+    (tempdir / 'conf.py').write_text('html_search_shards = 3\n')
+    (tempdir / 'contents.rst').write_text('Contents\n========\n\n'
+        '.. toctree::\n\n   other\n\nfermion lepton quark\n')
+    (tempdir / 'other.rst').write_text('Other\n=====\n\nboson gluon\n')
+    app = TestApp(srcdir=tempdir)
+    app.builder.build_update()
+    index = js_index.loads((app.outdir / 'searchindex.js').text())
+    assert index['termshards'] == 3
+    assert 'terms' not in index
+    terms = {}
+    for i in range(3):
+        shard = js_terms.loads((app.outdir / ('searchindex-%d.js' % i)).text())
+        assert shard['shard'] == i
+        for term in shard['terms']:
+            assert term_shard(term, 3) == i
+        terms.update(shard['terms'])
+    assert set(['fermion', 'quark', 'boson', 'gluon']) <= set(terms)
+
+    # the shards are read back if the indexer state is missing
+    os.unlink(app.builder.get_indexer_state_filename())
+    (tempdir / 'contents.rst').write_text('Contents\n========\n\n'
+        '.. toctree::\n\n   other\n\nphoton\n')
+    touch(tempdir / 'contents.rst')
+    app = TestApp(srcdir=tempdir)
+    app.builder.build_update()
+    assert not app._warning.content
+    app.builder.indexer.load(open(app.outdir / 'searchindex.js'), js_index,
+                             app.builder.load_searchindex_shard)
+    assert 'photon' in app.builder.indexer._mapping
+    assert app.builder.indexer._mapping['gluon'] == {'other': 1}
@@ -113,3 +113,42 @@ def test_insert_similar():
     assert new_nodes[0].rawsource == u'Anyway I need more'
     assert original_uids[0] == uids[0]
     assert original_uids[1:] == uids[2:]
+
+def test_levenshtein_distance():
+    import random
+    from sphinx.versioning import levenshtein_distance
+    rand = random.Random(42)
+    for i in range(200):
+        a = ''.join(rand.choice('abc') for j in range(rand.randint(0, 12)))
+        b = ''.join(rand.choice('abc') for j in range(rand.randint(0, 12)))
+        distance = levenshtein_distance(a, b)
+        for maxdist in range(8):
+            assert levenshtein_distance(a, b, maxdist) == \
+                   min(distance, maxdist + 1)
+
+def test_get_ratio_limit():
+    old = 'the quick brown fox'
+    new = 'the quick brown cat'
+    ratio = get_ratio(old, new)
+    assert get_ratio(old, new, 65) == ratio
+    assert get_ratio(old, new, ratio) == ratio
+    assert get_ratio(old, 'something else entirely', 65) == 65
+
+def test_moved():
+    from docutils import nodes
+    def make_doctree(texts):
+        doctree = nodes.section()
+        for text in texts:
+            doctree += nodes.paragraph(text, text)
+        return doctree
+    first = 'A paragraph that is moved to the end of the document.'
+    second = 'Another paragraph that stays where it is, more or less.'
+    third = 'And a third one that is changed a bit in the new version.'
+    old = make_doctree([first, second, third])
+    old_uids = [n.uid for n in add_uids(old, is_paragraph)]
+    new = make_doctree([second, third.replace('bit', 'little'), first, ''])
+    new_nodes = list(merge_doctrees(old, new, is_paragraph))
+    uids = [n.uid for n in new.traverse(is_paragraph)]
+    assert uids[:3] == [old_uids[1], old_uids[2], old_uids[0]]
+    # empty paragraphs are always new
+    assert new_nodes == [new[3]]
@@ -273,3 +273,59 @@ def test_differ():
         'sed do eiusmod tempor incididunt ut labore et dolore magna aliqua.'
     differ = CombinedHtmlDiff(source, prop)
     differ.make_html()
+
+
+class CountingStorage(StorageBackend):
+    def __init__(self):
+        self.metadata_calls = []
+
+    def get_metadata(self, docname, moderator):
+        self.metadata_calls.append((docname, moderator))
+        return {'node': len(self.metadata_calls)}
+
+    def add_comment(self, *args):
+        return {}
+
+    def accept_comment(self, comment_id):
+        pass
+
+
+@with_tempdir
+def test_document_cache(tempdir):
+    import cPickle as pickle
+    (tempdir / 'data' / 'pickles').makedirs()
+    picklefile = tempdir / 'data' / 'pickles' / 'doc.fpickle'
+    def write_document(body, mtime):
+        write_file(picklefile, pickle.dumps({'body': body, 'script': ''}))
+        os.utime(picklefile, (mtime, mtime))
+    write_document('first', 1000000000)
+    storage = CountingStorage()
+    support = WebSupport(builddir=tempdir, storage=storage)
+
+    document = support.get_document('doc')
+    assert document['body'] == 'first'
+    assert 'COMMENT_METADATA' in document['script']
+    document['script'] = 'modified'
+    # an unchanged pickle is not loaded again, and metadata is cached
+    write_document('second', 1000000000)
+    document = support.get_document('doc')
+    assert document['body'] == 'first'
+    assert document['script'] != 'modified'
+    assert storage.metadata_calls == [('doc', False)]
+    support.get_document('doc', moderator=True)
+    assert storage.metadata_calls == [('doc', False), ('doc', True)]
+
+    # a new pickle is loaded
+    write_document('second', 1000000001)
+    assert support.get_document('doc')['body'] == 'second'
+    assert len(storage.metadata_calls) == 2
+
+    # changed comments invalidate the metadata
+    support.add_comment('text', node_id='node')
+    assert '"node": 3' in support.get_document('doc')['script']
+    support.get_document('doc')
+    support.accept_comment('1', moderator=True)
+    support.get_document('doc')
+    assert len(storage.metadata_calls) == 4
+
+    raises(DocumentNotFoundError, support.get_document, 'nonexisting')
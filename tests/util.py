@@ -127,7 +127,7 @@ class TestApp(application.Sphinx):
                  buildername='html', confoverrides=None,
                  status=None, warning=None, freshenv=None,
                  warningiserror=None, tags=None,
-                 confname='conf.py', cleanenv=False):
+                 confname='conf.py', cleanenv=False, parallel=0):
 
         application.CONFIG_FILENAME = confname
 
@@ -168,7 +168,7 @@ class TestApp(application.Sphinx):
 
         application.Sphinx.__init__(self, srcdir, confdir, outdir, doctreedir,
                                     buildername, confoverrides, status, warning,
-                                    freshenv, warningiserror, tags)
+                                    freshenv, warningiserror, tags, parallel)
 
     def cleanup(self, doctrees=False):
         Theme.themes.clear()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Search indexing benchmark
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Index documents made of the messages of the Japanese catalog, using the
+    English originals or the translations, and print the indexing speed.
+
+    :copyright: Copyright 2007-2011 by the Sphinx team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+import time
+from os import path
+
+from docutils import nodes
+from docutils.utils import new_document
+
+from sphinx import package_dir
+from sphinx.search import IndexBuilder
+
+
+def read_messages():
+    pofile = path.join(package_dir, 'locale', 'ja', 'LC_MESSAGES',
+                       'sphinx.po')
+    messages = {'msgid': [], 'msgstr': []}
+    current = None
+    for line in open(pofile):
+        line = line.strip()
+        if line.startswith('msgid ') or line.startswith('msgstr '):
+            current, line = line.split(' ', 1)
+            messages[current].append('')
+        if current and line.startswith('"'):
+            messages[current][-1] += line[1:-1].decode('utf-8')
+    return messages
+
+
+def main():
+    messages = read_messages()
+    for lang, key in [('en', 'msgid'), ('ja', 'msgstr')]:
+        texts = [text for text in messages[key] if text]
+        builder = IndexBuilder(None, lang, {})
+        doctrees = []
+        nwords = 0
+        for i in range(200):
+            doctree = new_document('doc%d' % i)
+            for text in texts[i % 10::10]:
+                doctree += nodes.paragraph('', '', nodes.Text(text))
+                nwords += len(builder.lang.split(text))
+            doctrees.append(doctree)
+        t0 = time.time()
+        for i, doctree in enumerate(doctrees):
+            builder.feed('doc%d' % i, 'Document %d' % i, doctree)
+        t1 = time.time()
+        print '%s: indexed %d words in %.3f s, %d words/s' % (
+            lang, nwords, t1 - t0, nwords / (t1 - t0))
+
+
+if __name__ == '__main__':
+    main()